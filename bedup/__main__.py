@@ -20,6 +20,7 @@
 
 import argparse
 import collections
+import json
 import os
 import sqlalchemy
 import sys
@@ -28,17 +29,34 @@ import xdg.BaseDirectory  # pyxdg, apt:python-xdg
 from contextlib import closing
 from sqlalchemy.orm import sessionmaker
 
+from .analyze import (
+    estimate_savings, describe_estimate, DEFAULT_SAMPLE_FRACTION)
 from .btrfs import find_new, get_root_generation
+from .chunks import dedup_chunks, CHUNK_ALIGN, DEFAULT_CHUNK_SIZE
 from .dedup import dedup_same, FilesInUseError
+from .hashing import available_providers, default_provider_name, get_provider
 from .ioprio import set_idle_priority
-from .model import META
+from .logModel import LOG
+from .parallel import track_updated_files_parallel, dedup_parallel
+from .plan import PlanWriter, apply_plan, map_volumes
+from .model import (
+    META, MiniHashSampling, DEFAULT_MINI_HASH_SAMPLING, SchemaError,
+    upgrade_schema)
+from .stats import (
+    PERIODS, query_stats, describe_stats, show_stats, query_runs, show_runs)
 from .syncfs import syncfs
 from .termupdates import TermTemplate
+from .throttle import ReadThrottle
 from .tracking import (
-    show_vols, get_vol, track_updated_files, dedup_tracked, dedup_tracked2, forget_vol)
+    show_vols, get_vol, get_fs_vols, track_updated_files, dedup_tracked,
+    dedup_tracked2, forget_vol, set_path_filters, start_run, finish_run,
+    DedupOptions)
 
 
 APP_NAME = 'bedup'
+# Seconds to wait for a lock on the database, which is shared
+# by worker processes with --jobs.
+SQLITE_BUSY_TIMEOUT = 600
 
 
 def cmd_dedup_files(args):
@@ -64,6 +82,24 @@ def cmd_show_vols(args):
     show_vols(sess)
 
 
+def cmd_stats(args):
+    sess = get_session(args)
+    if args.runs:
+        entries = query_runs(sess, args.days)
+        show = show_runs
+    else:
+        log_sess = get_log_sessionmaker(args)()
+        entries = describe_stats(sess, query_stats(
+            log_sess, args.period, args.days,
+            per_volume=args.per_volume, per_size=args.per_size))
+        show = show_stats
+    if args.json:
+        json.dump(entries, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        show(entries, sys.stdout)
+
+
 def sql_setup(dbapi_con, con_record):
     cur = dbapi_con.cursor()
     # Uncripple the SQL implementation
@@ -80,43 +116,147 @@ def sql_setup(dbapi_con, con_record):
     assert val == ('wal',), val
 
 
+def get_engine(args, db_path):
+    url = sqlalchemy.engine.url.URL('sqlite', database=db_path)
+    engine = sqlalchemy.engine.create_engine(
+        url, echo=args.verbose_sql,
+        connect_args=dict(timeout=SQLITE_BUSY_TIMEOUT))
+    sqlalchemy.event.listen(engine, 'connect', sql_setup)
+    return engine
+
+
 def get_session(args):
     if args.db_path is None:
         data_dir = xdg.BaseDirectory.save_data_path(APP_NAME)
         args.db_path = os.path.join(data_dir, 'db.sqlite')
-    url = sqlalchemy.engine.url.URL('sqlite', database=args.db_path)
-    engine = sqlalchemy.engine.create_engine(url, echo=args.verbose_sql)
-    sqlalchemy.event.listen(engine, 'connect', sql_setup)
+    engine = get_engine(args, args.db_path)
     Session = sessionmaker(bind=engine)
     sess = Session()
     META.create_all(engine)
+    upgrade_schema(engine, META)
     return sess
 
 
+def get_index_dir(args):
+    # Inode indexes (see inodeindex) are kept next to the database
+    # they go with; get_session sets db_path.
+    return args.db_path + '.inodes'
+
+
+def get_log_sessionmaker(args):
+    # Dedup events go to their own database, see eventlog.EventLog
+    if args.log_db_path is None:
+        data_dir = xdg.BaseDirectory.save_data_path(APP_NAME)
+        args.log_db_path = os.path.join(data_dir, 'log.sqlite')
+    engine = get_engine(args, args.log_db_path)
+    LOG.create_all(engine)
+    upgrade_schema(engine, LOG)
+    # Worker processes open their own connections
+    engine.dispose()
+    return sessionmaker(bind=engine)
+
+
+# Commands that scan the volumes first
+SCAN_COMMANDS = ('scan-vol', 'dedup-vol', 'analyze')
+
+
 def vol_cmd(args):
     sess = get_session(args)
 
-    volumes = set(
-        get_vol(sess, volpath, args.size_cutoff) for volpath in args.volume)
+    if args.command in SCAN_COMMANDS and args.subvols:
+        volumes = set()
+        for volpath in args.volume:
+            volumes.update(get_fs_vols(
+                sess, volpath, args.size_cutoff,
+                include=args.include_subvol, exclude=args.exclude_subvol))
+    else:
+        volumes = set(
+            get_vol(sess, volpath, args.size_cutoff)
+            for volpath in args.volume)
     vols_by_fs = collections.defaultdict(list)
 
+    if args.command in SCAN_COMMANDS and (
+        args.include_path or args.exclude_path or args.clear_path_filters
+    ):
+        for vol in volumes:
+            set_path_filters(
+                sess, vol, args.include_path, args.exclude_path)
+
     with closing(TermTemplate()) as tt:
         if args.command == 'forget-vol':
             for vol in volumes:
                 forget_vol(sess, vol)
 
-        if args.command in ('scan-vol', 'dedup-vol'):
+        if args.command in SCAN_COMMANDS:
             set_idle_priority()
             for vol in volumes:
                 if args.flush:
                     syncfs(vol.fd)
-                # May raise IOError
-                track_updated_files(sess, vol, tt)
                 vols_by_fs[vol.fs].append(vol)
+            # May raise IOError
+            if args.jobs > 1:
+                track_updated_files_parallel(
+                    sess, volumes, tt, args.jobs, get_index_dir(args))
+            else:
+                for vol in volumes:
+                    track_updated_files(sess, vol, tt, get_index_dir(args))
 
         if args.command == 'dedup-vol':
+            opts = DedupOptions(
+                throttle=get_throttle(args),
+                mini_hash_sampling=MiniHashSampling(
+                    samples=args.mini_hash_samples,
+                    block=args.mini_hash_block),
+                hasher=get_provider(args.hash),
+                chunk_size=args.chunk_size,
+                make_log_session=get_log_sessionmaker(args),
+                settle_time=args.settle_time)
+            if args.hash == 'auto':
+                tt.notify('Hashing file contents with %s' % opts.hasher.name)
+            if args.plan is not None:
+                with open(args.plan, 'w') as ofile:
+                    opts.plan = PlanWriter(ofile)
+                    for volset in vols_by_fs.itervalues():
+                        dedup_tracked2(sess, volset, tt, opts)
+                tt.notify('Wrote %d duplicate sets to %r' % (
+                    opts.plan.entries, args.plan))
+            elif args.jobs > 1 or args.jobs_per_fs > 1:
+                dedup_parallel(
+                    lambda: get_session(args), vols_by_fs.values(), tt, opts,
+                    args.jobs, args.jobs_per_fs, args.partial)
+            else:
+                for volset in vols_by_fs.itervalues():
+                    run = start_run(sess, volset)
+                    dedup_tracked2(sess, volset, tt, opts, run_id=run.id)
+                    if args.partial:
+                        dedup_chunks(sess, volset, tt, opts)
+                    finish_run(sess, run, volset, tt, opts)
+
+        if args.command == 'analyze':
+            opts = DedupOptions(throttle=get_throttle(args))
             for volset in vols_by_fs.itervalues():
-                dedup_tracked2(sess, volset, tt)
+                estimate = estimate_savings(
+                    sess, volset, tt, opts, args.sample_fraction, args.seed)
+                tt.notify('%s: %s' % (
+                    volset[0].fs.uuid, describe_estimate(estimate)))
+
+
+def cmd_dedup_apply(args):
+    sess = get_session(args)
+    opts = DedupOptions(
+        throttle=get_throttle(args),
+        make_log_session=get_log_sessionmaker(args))
+    targets = map_volumes(sess, args.map_volume)
+    with closing(TermTemplate()) as tt:
+        set_idle_priority()
+        apply_plan(sess, args.plan, tt, opts, targets)
+
+
+def get_throttle(args):
+    return ReadThrottle(
+        max_rate=args.max_read_rate,
+        max_iops=args.max_read_iops,
+        max_pressure=args.max_io_pressure)
 
 
 def cmd_generation(args):
@@ -131,6 +271,10 @@ def sql_flags(parser):
     parser.add_argument(
         '--db-path', dest='db_path',
         help='Override the location of the sqlite database')
+    parser.add_argument(
+        '--log-db-path', dest='log_db_path',
+        help='Override the location of the sqlite database '
+        'where dedup events are logged')
     parser.add_argument(
         '--verbose-sql', action='store_true', dest='verbose_sql',
         help='print SQL statements being executed')
@@ -143,7 +287,15 @@ def vol_flags(parser):
         '--size-cutoff', type=int, dest='size_cutoff',
         help='Change the minimum size (in bytes) of tracked files '
         'for the listed volumes. '
-        'Lowering the cutoff will trigger a partial rescan of older files.')
+        'Lowering the cutoff takes the newly tracked files from the '
+        'inode index kept by earlier scans; without one, it triggers '
+        'a partial rescan of older files.')
+
+
+def path_pattern(val):
+    if not val.startswith('/'):
+        raise argparse.ArgumentTypeError('must start with /')
+    return val
 
 
 def scan_flags(parser):
@@ -151,6 +303,130 @@ def scan_flags(parser):
     parser.add_argument(
         '--flush', action='store_true', dest='flush',
         help='Flush outstanding data using syncfs before scanning volumes')
+    parser.add_argument(
+        '--subvols', action='store_true', dest='subvols',
+        help='Work on all the subvolumes of the filesystems the listed '
+        'volumes are on')
+    parser.add_argument(
+        '--include-subvol', action='append', dest='include_subvol',
+        default=[], metavar='PATTERN',
+        help='With --subvols, only keep subvolumes whose path (relative '
+        'to the top-level volume, starting with /) matches this pattern; '
+        'can be repeated')
+    parser.add_argument(
+        '--exclude-subvol', action='append', dest='exclude_subvol',
+        default=[], metavar='PATTERN',
+        help='With --subvols, leave out subvolumes whose path matches '
+        'this pattern; can be repeated')
+    parser.add_argument(
+        '--include-path', action='append', dest='include_path',
+        type=path_pattern, default=[], metavar='PATTERN',
+        help='Only track files whose path (relative to the volume, '
+        'starting with /), or the path of one of their directories, '
+        'matches this pattern; a pattern ending with / matches '
+        'a directory and everything under it.  Can be repeated')
+    parser.add_argument(
+        '--exclude-path', action='append', dest='exclude_path',
+        type=path_pattern, default=[], metavar='PATTERN',
+        help='Don\'t track files whose path, or the path of one of their '
+        'directories, matches this pattern; can be repeated')
+    parser.add_argument(
+        '--clear-path-filters', action='store_true',
+        dest='clear_path_filters',
+        help='Forget the --include-path and --exclude-path rules '
+        'of the listed volumes')
+    parser.add_argument(
+        '--jobs', type=int, dest='jobs', default=1,
+        help='Scan this many volumes at a time, in worker processes; '
+        'with dedup-vol, also deduplicate this many filesystems at a time')
+
+
+def chunk_size(val):
+    size = int(val)
+    if size <= 0 or size % CHUNK_ALIGN:
+        raise argparse.ArgumentTypeError(
+            'must be a positive multiple of %d' % CHUNK_ALIGN)
+    return size
+
+
+def mini_hash_samples(val):
+    samples = int(val)
+    if samples < 0:
+        raise argparse.ArgumentTypeError('must not be negative')
+    return samples
+
+
+def mini_hash_block(val):
+    block = int(val)
+    if block < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return block
+
+
+def sample_fraction(val):
+    fraction = float(val)
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError('must be between 0 and 1')
+    return fraction
+
+
+def read_flags(parser):
+    parser.add_argument(
+        '--max-read-rate', type=int, dest='max_read_rate',
+        help='Limit reads of file contents (hashing and comparison) '
+        'to this many bytes per second')
+    parser.add_argument(
+        '--max-read-iops', type=int, dest='max_read_iops',
+        help='Limit reads of file contents to this many '
+        'read calls per second')
+    parser.add_argument(
+        '--max-io-pressure', type=float, dest='max_io_pressure',
+        help='Pause reads while the share of time tasks are stalled on io '
+        '(the avg10 figure of /proc/pressure/io, in percent) '
+        'is above this value')
+
+
+def dedup_flags(parser):
+    read_flags(parser)
+    parser.add_argument(
+        '--mini-hash-samples', type=mini_hash_samples,
+        dest='mini_hash_samples',
+        default=DEFAULT_MINI_HASH_SAMPLING.samples,
+        help='Number of blocks read (at the head, the tail and in between) '
+        'to tell apart files of the same size before hashing them in full')
+    parser.add_argument(
+        '--mini-hash-block', type=mini_hash_block, dest='mini_hash_block',
+        default=DEFAULT_MINI_HASH_SAMPLING.block,
+        help='Size in bytes of the blocks read for the mini-hash')
+    parser.add_argument(
+        '--hash', dest='hash', default=default_provider_name(),
+        choices=['auto'] + [
+            provider.name for provider in available_providers()],
+        help='Hash used to find identical files before comparing them; '
+        'auto picks the fastest one after a quick benchmark')
+    parser.add_argument(
+        '--partial', action='store_true', dest='partial',
+        help='Also deduplicate identical ranges of files that differ '
+        'as a whole (disk images, database dumps, appended logs)')
+    parser.add_argument(
+        '--chunk-size', type=chunk_size, dest='chunk_size',
+        default=DEFAULT_CHUNK_SIZE,
+        help='Size in bytes of the ranges compared by --partial, '
+        'a multiple of %d' % CHUNK_ALIGN)
+    parser.add_argument(
+        '--jobs-per-fs', type=int, dest='jobs_per_fs', default=1,
+        help='Number of processes deduplicating a single filesystem; '
+        'more than one only helps on storage that handles parallel reads '
+        'well (SSDs, arrays)')
+    parser.add_argument(
+        '--plan', dest='plan', metavar='FILE',
+        help='Find duplicates without cloning anything, and write them '
+        'to FILE for dedup-apply')
+    parser.add_argument(
+        '--settle-time', type=int, dest='settle_time', default=0,
+        metavar='SECONDS',
+        help='Leave files modified less than this many seconds ago '
+        '(logs, downloads, running VM images) for a later run')
 
 
 def main(argv):
@@ -166,6 +442,40 @@ Scans listed volumes to keep track of potentially duplicated files.""")
 Runs scan-vol, then deduplicates identical files.""")
     sp_dedup_vol.set_defaults(action=vol_cmd)
     scan_flags(sp_dedup_vol)
+    dedup_flags(sp_dedup_vol)
+
+    sp_analyze = commands.add_parser('analyze', description="""
+Runs scan-vol, then estimates how much space dedup-vol would reclaim,
+reading a sample of the candidate files.  Files are opened read-only
+and nothing is deduplicated.""")
+    sp_analyze.set_defaults(action=vol_cmd)
+    scan_flags(sp_analyze)
+    read_flags(sp_analyze)
+    sp_analyze.add_argument(
+        '--sample-fraction', type=sample_fraction, dest='sample_fraction',
+        default=DEFAULT_SAMPLE_FRACTION,
+        help='Read about this fraction of the bytes dedup-vol could read '
+        '(more gives a narrower confidence interval)')
+    sp_analyze.add_argument(
+        '--seed', type=int, dest='seed',
+        help='Seed for picking the sample, for repeatable estimates')
+
+    sp_dedup_apply = commands.add_parser('dedup-apply', description="""
+Deduplicates the files listed in a plan written by dedup-vol --plan,
+leaving out those that changed since.  Files of read-only snapshots
+can't be deduplicated; with --map-volume, the same files in the volume
+the snapshot was taken from are, if they haven't changed since the
+snapshot.""")
+    sp_dedup_apply.set_defaults(action=cmd_dedup_apply)
+    sp_dedup_apply.add_argument(
+        'plan', metavar='FILE', help='plan written by dedup-vol --plan')
+    sp_dedup_apply.add_argument(
+        '--map-volume', nargs=2, action='append', default=[],
+        dest='map_volume', metavar=('SNAPSHOT', 'TARGET'),
+        help='Apply what the plan lists for the read-only snapshot '
+        'SNAPSHOT to the writable volume TARGET it was taken from')
+    sql_flags(sp_dedup_apply)
+    read_flags(sp_dedup_apply)
 
     sp_forget_vol = commands.add_parser('forget-vol', description="""
 Forget tracking data for the listed volumes. Mostly useful for testing.""")
@@ -177,6 +487,29 @@ Shows known volumes.""")
     sp_show_vols.set_defaults(action=cmd_show_vols)
     sql_flags(sp_show_vols)
 
+    sp_stats = commands.add_parser('stats', description="""
+Shows how much deduplication did, per day or week.""")
+    sp_stats.set_defaults(action=cmd_stats)
+    sql_flags(sp_stats)
+    sp_stats.add_argument(
+        '--period', choices=PERIODS, default='day', dest='period',
+        help='Length of the time buckets')
+    sp_stats.add_argument(
+        '--days', type=int, default=30, dest='days',
+        help='Show this many days of history')
+    sp_stats.add_argument(
+        '--per-volume', action='store_true', dest='per_volume',
+        help='Break down by volume (where space was reclaimed)')
+    sp_stats.add_argument(
+        '--per-size', action='store_true', dest='per_size',
+        help='Break down by file size, in powers of two')
+    sp_stats.add_argument(
+        '--runs', action='store_true', dest='runs',
+        help='List the dedup runs instead, with their mini-hash counters')
+    sp_stats.add_argument(
+        '--json', action='store_true', dest='json',
+        help='Output JSON')
+
     sp_dedup_files = commands.add_parser(
         'dedup-files', description="""
 Freezes files, checks them for being identical,
@@ -220,7 +553,16 @@ modified to include directories as well.""")
         help='only show items modified at generation or a newer transaction')
 
     args = parser.parse_args(argv[1:])
-    return args.action(args)
+    if args.command == 'dedup-vol' and args.plan is not None:
+        if args.partial or args.jobs > 1 or args.jobs_per_fs > 1:
+            parser.error(
+                '--plan can\'t be used with --partial, --jobs '
+                'or --jobs-per-fs')
+    try:
+        return args.action(args)
+    except SchemaError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
 
 
 def script_main():
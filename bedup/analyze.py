@@ -0,0 +1,231 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import math
+import random
+
+from contextlib import closing
+
+from .btrfs import lookup_ino_path_one
+from .grouping import size_groups
+from .model import Inode, mini_hash_offsets
+from .openat import fopenat
+from .stats import size_class
+from .tracking import load_records, digest_name, full_digest, sparse_digest
+
+# Savings estimates.
+# Size groups are stratified by size class (powers of two) and sampled
+# at random within each class, until the reads spent on the class
+# reach a fraction of what a full dedup run could read.  Sampled
+# groups are evaluated like dedup-vol would, with files opened
+# read-only; the totals are extrapolated with the usual stratified
+# sampling estimator, which also gives a confidence interval.
+
+DEFAULT_SAMPLE_FRACTION = .05
+# Groups sampled per size class, at least, so that there is a variance
+MIN_SAMPLED_GROUPS = 2
+# Larger groups have a random subset of their members hashed; savings
+# found in the subset are scaled up, which tends to underestimate.
+MAX_SAMPLED_MEMBERS = 64
+# Normal quantile for a two-sided 95% interval
+Z_95 = 1.96
+
+
+Estimate = collections.namedtuple(
+    'Estimate',
+    'savings low high groups sampled_groups candidate_bytes bytes_read')
+
+
+class GroupEvaluator(object):
+    """Works out what deduplicating a size group would save."""
+
+    def __init__(self, opts, rng):
+        self.opts = opts
+        self.rng = rng
+        self.bytes_read = 0
+
+    def located(self, records):
+        for record in records:
+            try:
+                path = lookup_ino_path_one(record.vol.fd, record.ino)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if record.has_current_extents():
+                record.layout_from_extents()
+            else:
+                with closing(fopenat(record.vol.fd, path)) as rfile:
+                    record.fiemap_hash_from_file(rfile)
+            yield record, path
+
+    def savings(self, records):
+        if len(records) > MAX_SAMPLED_MEMBERS:
+            scale = float(len(records)) / MAX_SAMPLED_MEMBERS
+            records = self.rng.sample(records, MAX_SAMPLED_MEMBERS)
+        else:
+            scale = 1.
+
+        # Files that already share their extents count once
+        survivors = []
+        seen_extents = set()
+        for record, path in self.located(records):
+            if record.shared_extents is not None:
+                if record.shared_extents in seen_extents:
+                    continue
+                seen_extents.add(record.shared_extents)
+            survivors.append((record, path))
+        if len(survivors) < 2:
+            return 0.
+
+        size = survivors[0][0].size
+        known = []
+        unknown = []
+        for record, path in survivors:
+            if record.has_current_digest(digest_name(record, self.opts)):
+                known.append((record, path))
+            else:
+                unknown.append((record, path))
+
+        if known:
+            # Same reasoning as do_hashing, the new files
+            # are hashed in full
+            to_hash = unknown
+        else:
+            by_mini_hash = collections.defaultdict(list)
+            nr_samples = len(mini_hash_offsets(
+                size, self.opts.mini_hash_sampling))
+            for record, path in unknown:
+                if record.is_sparse():
+                    # Like do_hashing, nothing to read
+                    by_mini_hash[record.data_ranges].append((record, path))
+                    continue
+                rfile = self.opts.throttle.wrap(
+                    fopenat(record.vol.fd, path))
+                with closing(rfile):
+                    record.mini_hash_from_file(
+                        rfile, self.opts.mini_hash_sampling)
+                self.bytes_read += min(
+                    size, nr_samples * self.opts.mini_hash_sampling.block)
+                by_mini_hash[record.mini_hash].append((record, path))
+            to_hash = [
+                item for bucket in by_mini_hash.itervalues()
+                if len(bucket) > 1 for item in bucket]
+
+        classes = collections.defaultdict(list)
+        for record, path in known:
+            classes[record.digest].append(record)
+        for record, path in to_hash:
+            rfile = self.opts.throttle.wrap(fopenat(record.vol.fd, path))
+            with closing(rfile):
+                if record.is_sparse():
+                    digest = sparse_digest(rfile, size, self.opts.hasher)
+                    self.bytes_read += sum(
+                        length for offset, length in record.data_ranges)
+                else:
+                    digest = full_digest(rfile, size, self.opts.hasher)
+                    self.bytes_read += size
+            if digest is None:
+                # Changed while being read
+                continue
+            classes[digest].append(record)
+
+        saved = 0
+        for members in classes.itervalues():
+            writable = sum(1 for record in members if not record.vol.readonly)
+            if writable == len(members):
+                # One of them has to stay as the source
+                writable -= 1
+            saved += size * writable
+        return saved * scale
+
+
+def stratum_estimate(values, population):
+    # Total and variance of a stratum, from a simple random sample
+    sampled = len(values)
+    total = float(sum(values)) * population / sampled
+    if sampled == population or sampled < 2:
+        return total, 0.
+    mean = float(sum(values)) / sampled
+    variance = sum((value - mean) ** 2 for value in values) / (sampled - 1)
+    return total, (
+        population ** 2 * (1. - float(sampled) / population)
+        * variance / sampled)
+
+
+def estimate_savings(sess, volset, tt, opts, fraction, seed=None):
+    """
+    Estimates the bytes a dedup run would reclaim on a volume set.
+
+    Only files sampled from the tracked size groups are read, up to
+    about fraction of the bytes of the candidate files, and they
+    are only opened read-only.  Nothing gets written.
+    """
+
+    rng = random.Random(seed)
+    vols_by_id = dict((vol.id, vol) for vol in volset)
+    vol_filter = [
+        Inode.fs_id == volset[0].fs.id, Inode.vol_id.in_(list(vols_by_id))]
+    groups = size_groups(sess, vol_filter, updated_only=False)
+
+    strata = collections.defaultdict(list)
+    for group in groups:
+        strata[size_class(group.size)].append(group)
+
+    evaluator = GroupEvaluator(opts, rng)
+    candidate_bytes = 0
+    savings = variance = 0.
+    sampled_groups = 0
+    tt.format('{elapsed} Sampled group {group:counter}')
+    for stratum in strata.itervalues():
+        stratum_bytes = sum(
+            group.size * group.inode_count for group in stratum)
+        candidate_bytes += stratum_bytes
+        budget = fraction * stratum_bytes
+        rng.shuffle(stratum)
+        spent_before = evaluator.bytes_read
+        values = []
+        for group in stratum:
+            if (len(values) >= MIN_SAMPLED_GROUPS
+                    and evaluator.bytes_read - spent_before >= budget):
+                break
+            tt.update(group=group)
+            records = load_records(
+                sess, vols_by_id, vol_filter + [Inode.size == group.size])
+            values.append(evaluator.savings(records))
+        sampled_groups += len(values)
+        total, var = stratum_estimate(values, len(stratum))
+        savings += total
+        variance += var
+
+    margin = Z_95 * math.sqrt(variance)
+    return Estimate(
+        savings=savings, low=max(0., savings - margin), high=savings + margin,
+        groups=len(groups), sampled_groups=sampled_groups,
+        candidate_bytes=candidate_bytes, bytes_read=evaluator.bytes_read)
+
+
+def describe_estimate(estimate):
+    return (
+        'About %d bytes reclaimable (95%% confidence interval %d-%d); '
+        'sampled %d of %d size groups, read %d of %d bytes' % (
+            estimate.savings, estimate.low, estimate.high,
+            estimate.sampled_groups, estimate.groups,
+            estimate.bytes_read, estimate.candidate_bytes))
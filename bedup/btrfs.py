@@ -19,6 +19,7 @@
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
 import cffi
+import errno
 import uuid
 
 from .compat import buffer_to_bytes
@@ -37,6 +38,7 @@ ffi.cdef("""
 #define BTRFS_IOC_INO_LOOKUP ...
 #define BTRFS_IOC_FS_INFO ...
 #define BTRFS_IOC_CLONE ...
+#define BTRFS_IOC_CLONE_RANGE ...
 #define BTRFS_IOC_DEFRAG ...
 
 #define BTRFS_FSID_SIZE ...
@@ -110,6 +112,13 @@ struct btrfs_ioctl_fs_info_args {
     ...; // reserved/padding
 };
 
+struct btrfs_ioctl_clone_range_args {
+    int64_t src_fd;
+    uint64_t src_offset;
+    uint64_t src_length;
+    uint64_t dest_offset;
+};
+
 struct btrfs_ioctl_ino_lookup_args {
     uint64_t treeid;
     uint64_t objectid;
@@ -125,14 +134,22 @@ struct btrfs_ioctl_ino_lookup_args {
 /* ctree.h */
 
 #define BTRFS_EXTENT_DATA_KEY ...
+#define BTRFS_FILE_EXTENT_INLINE ...
 #define BTRFS_INODE_REF_KEY ...
 #define BTRFS_INODE_ITEM_KEY ...
 #define BTRFS_DIR_ITEM_KEY ...
 #define BTRFS_DIR_INDEX_KEY ...
 #define BTRFS_ROOT_ITEM_KEY ...
+#define BTRFS_ROOT_BACKREF_KEY ...
+#define BTRFS_QGROUP_INFO_KEY ...
 
 #define BTRFS_FIRST_FREE_OBJECTID ...
+#define BTRFS_LAST_FREE_OBJECTID ...
 #define BTRFS_ROOT_TREE_OBJECTID ...
+#define BTRFS_FS_TREE_OBJECTID ...
+#define BTRFS_QUOTA_TREE_OBJECTID ...
+
+#define BTRFS_ROOT_SUBVOL_RDONLY ...
 
 
 struct btrfs_file_extent_item {
@@ -269,6 +286,23 @@ struct btrfs_inode_ref {
     ...;
 };
 
+struct btrfs_root_ref {
+    uint64_t dirid;
+    uint64_t sequence;
+    uint16_t name_len;
+    /* name goes here */
+    ...;
+};
+
+struct btrfs_qgroup_info_item {
+    uint64_t generation;
+    uint64_t rfer;
+    uint64_t rfer_cmpr;
+    uint64_t excl;
+    uint64_t excl_cmpr;
+    ...;
+};
+
 struct btrfs_disk_key {
     uint64_t objectid;
     uint8_t type;
@@ -286,12 +320,26 @@ struct btrfs_dir_item {
 };
 
 uint64_t btrfs_stack_file_extent_generation(struct btrfs_file_extent_item *s);
+uint8_t btrfs_stack_file_extent_type(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_disk_bytenr(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_offset(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_num_bytes(struct btrfs_file_extent_item *s);
+uint8_t btrfs_stack_file_extent_compression(
+    struct btrfs_file_extent_item *s);
 uint64_t btrfs_stack_inode_generation(struct btrfs_inode_item *s);
+uint64_t btrfs_stack_inode_transid(struct btrfs_inode_item *s);
 uint64_t btrfs_stack_inode_size(struct btrfs_inode_item *s);
 uint32_t btrfs_stack_inode_mode(struct btrfs_inode_item *s);
+uint64_t btrfs_stack_timespec_sec(struct btrfs_timespec *s);
 uint64_t btrfs_stack_inode_ref_name_len(struct btrfs_inode_ref *s);
 uint64_t btrfs_stack_dir_name_len(struct btrfs_dir_item *s);
+uint64_t btrfs_stack_root_ref_dirid(struct btrfs_root_ref *s);
+uint64_t btrfs_stack_root_ref_name_len(struct btrfs_root_ref *s);
 uint64_t btrfs_root_generation(struct btrfs_root_item *s);
+uint64_t btrfs_root_flags(struct btrfs_root_item *s);
+uint64_t btrfs_stack_qgroup_info_rfer(struct btrfs_qgroup_info_item *s);
+uint64_t btrfs_stack_qgroup_info_excl(struct btrfs_qgroup_info_item *s);
 """)
 
 
@@ -305,8 +353,11 @@ lib = ffi.verify('''
 
 
 BTRFS_FIRST_FREE_OBJECTID = lib.BTRFS_FIRST_FREE_OBJECTID
+BTRFS_ROOT_SUBVOL_RDONLY = lib.BTRFS_ROOT_SUBVOL_RDONLY
 
 u64_max = ffi.cast('uint64_t', -1)
+# Qgroup ids are the level in the upper 16 bits, then the id
+QGROUP_LEVEL_0_MAX = 2 ** 48 - 1
 
 
 def name_of_inode_ref(ref):
@@ -314,6 +365,11 @@ def name_of_inode_ref(ref):
     return ffi.string(ffi.cast('char*', ref + 1), namelen)
 
 
+def name_of_root_ref(ref):
+    namelen = lib.btrfs_stack_root_ref_name_len(ref)
+    return ffi.string(ffi.cast('char*', ref + 1), namelen)
+
+
 def name_of_dir_item(item):
     namelen = lib.btrfs_stack_dir_name_len(item)
     return ffi.string(ffi.cast('char*', item + 1), namelen)
@@ -432,17 +488,35 @@ def lookup_ino_path_one(volume_fd, ino):
     return rv[:-1]
 
 
-def volumes_from_root_tree(volume_fd):  # pragma: nocover
-    # Requires a scary amount of scanning, not just the root tree,
-    # needs to be combined with some inode resolution on mounted volumes
-    raise NotImplementedError
+def lookup_ino_path_in_tree(volume_fd, treeid, ino):
+    # Like lookup_ino_path_one, in the volume treeid
+    # rather than the one volume_fd is on.
+    # Returns a path with a final /, or an empty path for the root.
+    args = ffi.new('struct btrfs_ioctl_ino_lookup_args *')
+    args.treeid = treeid
+    args.objectid = ino
+    ioctl_pybug(volume_fd, lib.BTRFS_IOC_INO_LOOKUP, ffi.buffer(args))
+    return ffi.string(args.name)
+
+
+def volumes_from_root_tree(volume_fd):
+    """
+    Lists the subvolumes of the filesystem volume_fd is on.
+
+    Returns a dict from root ids to paths relative to the top-level
+    volume, which isn't included.  Needs CAP_SYS_ADMIN.
+    """
+
+    # Subvolume id -> (parent id, directory inode in the parent, name)
+    backrefs = {}
 
     args = ffi.new('struct btrfs_ioctl_search_args *')
     args_buffer = ffi.buffer(args)
     sk = args.key
 
     sk.tree_id = lib.BTRFS_ROOT_TREE_OBJECTID  # the tree of roots
-    sk.max_objectid = u64_max
+    sk.min_objectid = lib.BTRFS_FIRST_FREE_OBJECTID
+    sk.max_objectid = lib.BTRFS_LAST_FREE_OBJECTID
     sk.min_type = sk.max_type = lib.BTRFS_ROOT_BACKREF_KEY
     sk.max_offset = u64_max
     sk.max_transid = u64_max
@@ -460,19 +534,78 @@ def volumes_from_root_tree(volume_fd):  # pragma: nocover
             sh = ffi.cast(
                 'struct btrfs_ioctl_search_header *', args.buf + offset)
             offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+            # The search also returns the root items in between
             if sh.type == lib.BTRFS_ROOT_BACKREF_KEY:
-                item = ffi.cast('struct btrfs_root_ref *', sh + 1)
+                ref = ffi.cast('struct btrfs_root_ref *', sh + 1)
+                backrefs[sh.objectid] = (
+                    sh.offset, lib.btrfs_stack_root_ref_dirid(ref),
+                    name_of_root_ref(ref))
 
+        sk.min_objectid = sh.objectid
+        sk.min_type = sh.type
         sk.min_offset = sh.offset + 1
 
+    paths = {lib.BTRFS_FS_TREE_OBJECTID: b''}
+
+    def resolve(root_id):
+        if root_id not in paths:
+            parent_id, dirid, name = backrefs[root_id]
+            parent_path = resolve(parent_id)
+            if parent_path:
+                parent_path += b'/'
+            paths[root_id] = parent_path + lookup_ino_path_in_tree(
+                volume_fd, parent_id, dirid) + name
+        return paths[root_id]
+
+    rv = {}
+    for root_id in backrefs:
+        try:
+            rv[root_id] = resolve(root_id)
+        except KeyError:
+            # The parent is being deleted
+            continue
+    return rv
+
+
+def get_inode_transid(volume_fd, ino):
+    """
+    Gets the transid of an inode item, as of the last transaction commit.
+
+    Returns None if the inode doesn't exist.
+    """
+
+    args = ffi.new('struct btrfs_ioctl_search_args *')
+    sk = args.key
+    # The tree of the volume volume_fd is on
+    sk.tree_id = 0
+    sk.min_objectid = sk.max_objectid = ino
+    sk.min_type = sk.max_type = lib.BTRFS_INODE_ITEM_KEY
+    sk.max_offset = u64_max
+    sk.max_transid = u64_max
+    sk.nr_items = 1
+
+    ioctl_pybug(volume_fd, lib.BTRFS_IOC_TREE_SEARCH, ffi.buffer(args))
+    if sk.nr_items == 0:
+        return None
+    sh = ffi.cast('struct btrfs_ioctl_search_header *', args.buf)
+    item = ffi.cast('struct btrfs_inode_item *', sh + 1)
+    return lib.btrfs_stack_inode_transid(item)
+
 
 def get_root_generation(volume_fd):
+    return get_root_info(volume_fd)[0]
+
+
+def get_root_info(volume_fd):
+    """Gets the generation and the flags of a volume's root item."""
+
     # Adapted from find_root_gen in btrfs-list.c
     # XXX I'm iffy about the search, we may not be using the most
     # recent snapshot, don't want to pick up a newer generation from
     # a different snapshot.
     treeid = get_root_id(volume_fd)
     max_found = 0
+    flags = 0
 
     args = ffi.new('struct btrfs_ioctl_search_args *')
     args_buffer = ffi.buffer(args)
@@ -501,7 +634,10 @@ def get_root_generation(volume_fd):
             assert sh.type == lib.BTRFS_ROOT_ITEM_KEY
             item = ffi.cast(
                 'struct btrfs_root_item *', sh + 1)
-            max_found = max(max_found, lib.btrfs_root_generation(item))
+            generation = lib.btrfs_root_generation(item)
+            if generation > max_found:
+                max_found = generation
+                flags = lib.btrfs_root_flags(item)
 
         if sk.min_type != lib.BTRFS_ROOT_ITEM_KEY:
             break
@@ -510,7 +646,59 @@ def get_root_generation(volume_fd):
         sk.min_offset = sh.offset + 1
 
     assert max_found > 0
-    return max_found
+    return max_found, flags
+
+
+def get_qgroup_usage(volume_fd):
+    """
+    Gets the space used by each volume, from the quota tree.
+
+    Returns a dict from root ids to (referenced, exclusive) bytes,
+    as of the last transaction commit.  Returns None if quotas
+    aren't enabled.  Needs CAP_SYS_ADMIN.
+    """
+
+    usage = {}
+
+    args = ffi.new('struct btrfs_ioctl_search_args *')
+    args_buffer = ffi.buffer(args)
+    sk = args.key
+
+    # Level 0 qgroups have the id of their volume
+    sk.tree_id = lib.BTRFS_QUOTA_TREE_OBJECTID
+    sk.min_type = sk.max_type = lib.BTRFS_QGROUP_INFO_KEY
+    sk.max_offset = QGROUP_LEVEL_0_MAX
+    sk.max_transid = u64_max
+
+    while True:
+        sk.nr_items = 4096
+
+        try:
+            ioctl_pybug(
+                volume_fd, lib.BTRFS_IOC_TREE_SEARCH, args_buffer)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                # There is no quota tree
+                return None
+            raise
+        if sk.nr_items == 0:
+            break
+
+        offset = 0
+        for item_id in xrange(sk.nr_items):
+            sh = ffi.cast(
+                'struct btrfs_ioctl_search_header *', args.buf + offset)
+            offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+            if sh.type == lib.BTRFS_QGROUP_INFO_KEY:
+                item = ffi.cast('struct btrfs_qgroup_info_item *', sh + 1)
+                usage[sh.offset] = (
+                    lib.btrfs_stack_qgroup_info_rfer(item),
+                    lib.btrfs_stack_qgroup_info_excl(item))
+
+        sk.min_objectid = sh.objectid
+        sk.min_type = sh.type
+        sk.min_offset = sh.offset + 1
+    return usage
 
 
 # clone_data and defragment also have _RANGE variants
@@ -521,6 +709,17 @@ def clone_data(dest, src, check_first):
     return True
 
 
+def clone_data_range(dest, src, src_offset, length, dest_offset):
+    # Offsets and length must be block-aligned,
+    # except for a range that ends at the end of src.
+    args = ffi.new('struct btrfs_ioctl_clone_range_args *')
+    args.src_fd = src
+    args.src_offset = src_offset
+    args.src_length = length
+    args.dest_offset = dest_offset
+    ioctl_pybug(dest, lib.BTRFS_IOC_CLONE_RANGE, ffi.buffer(args))
+
+
 def defragment(fd):
     # XXX Can remove compression as a side-effect
     # Also, can unshare extents.
@@ -0,0 +1,340 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import struct
+
+from contextlib import closing
+from contextlib2 import ExitStack
+from sqlalchemy import and_, not_, or_
+from sqlalchemy.sql import func
+
+from .btrfs import lookup_ino_path_one, clone_data_range, get_inode_transid
+from .dedup import ImmutableFDs, cmp_ranges
+from .eventlog import EventLog
+from .fiemap import fiemap, exclusive_bytes, range_extents
+from .openat import fopenat, fopenat_rw
+from .model import Inode, Chunk
+from .syncfs import syncfs
+
+# Partial-file deduplication.
+# Files are cut into fixed-size chunks, whose digests are kept
+# in the Chunk table.  Chunks of a file that was modified are looked up
+# in the other files of the volume set; matching ranges are compared
+# and cloned, leaving the rest of the file alone.
+
+# Clone offsets must be aligned on the filesystem block size
+CHUNK_ALIGN = 4096
+DEFAULT_CHUNK_SIZE = 1024 ** 2
+# Smaller files are left to the whole-file pass
+MIN_CHUNKS = 2
+# Digests per lookup query; SQLite allows 999 variables
+DIGEST_BATCH = 500
+# Stale files loaded and chunked per transaction,
+# like tracking.SCHEDULE_WINDOW
+STALE_WINDOW = 256
+
+BUFSIZE = 64 * 1024
+ZERO_BUF = b'\0' * BUFSIZE
+
+
+def chunk_params(opts):
+    return '%s:%d' % (opts.hasher.name, opts.chunk_size)
+
+
+def digest_key(digest):
+    # Fits in a signed 64-bit SQLite integer
+    return struct.unpack('<q', digest[:8])[0]
+
+
+def chunk_digests(rfile, hasher, chunk_size):
+    """
+    Hashes the full chunks of a file.
+
+    Returns (offset, digest key) pairs.  Chunks that only contain zeroes
+    are left out; they are better handled by hole punching or compression.
+    """
+
+    rv = []
+    offset = 0
+    while True:
+        hobj = hasher.new()
+        remaining = chunk_size
+        is_zero = True
+        while remaining:
+            buf = rfile.read(min(BUFSIZE, remaining))
+            if not buf:
+                # The last chunk is partial, or the file shrank
+                return rv
+            hobj.update(buf)
+            if is_zero and buf != ZERO_BUF[:len(buf)]:
+                is_zero = False
+            remaining -= len(buf)
+        if not is_zero:
+            rv.append((offset, digest_key(hobj.digest())))
+        offset += chunk_size
+
+
+def replace_chunks(sess, inode, digests):
+    sess.execute(Chunk.__table__.delete().where(and_(
+        Chunk.vol_id == inode.vol_id, Chunk.ino == inode.ino)))
+    if digests:
+        sess.execute(Chunk.__table__.insert(), [
+            dict(vol_id=inode.vol_id, ino=inode.ino,
+                 offset=offset, digest=digest)
+            for offset, digest in digests])
+
+
+def find_sources(sess, vol_ids, params, inode, digests):
+    """
+    Finds, for each chunk of inode, a chunk with the same digest
+    in another file.
+
+    Returns a dict from (vol_id, ino) of the other file
+    to lists of (source offset, dest offset) pairs.
+    """
+
+    dest_offsets = collections.defaultdict(list)
+    for offset, digest in digests:
+        dest_offsets[digest].append(offset)
+    all_digests = list(dest_offsets)
+
+    sources = collections.defaultdict(list)
+    for start in xrange(0, len(all_digests), DIGEST_BATCH):
+        batch = all_digests[start:start + DIGEST_BATCH]
+        rows = sess.query(
+            Chunk.digest, Chunk.vol_id, Chunk.ino, Chunk.offset
+        ).join(
+            Inode, and_(Inode.vol_id == Chunk.vol_id, Inode.ino == Chunk.ino)
+        ).filter(
+            Chunk.digest.in_(batch),
+            Chunk.vol_id.in_(vol_ids),
+            # Digests computed with other settings can't match
+            Inode.chunk_params == params,
+            not_(and_(Chunk.vol_id == inode.vol_id, Chunk.ino == inode.ino)),
+        ).order_by(Chunk.vol_id, Chunk.ino, Chunk.offset)
+
+        found = set()
+        for digest, vol_id, ino, offset in rows:
+            # One source per digest, the one with the lowest key;
+            # this keeps the number of source files down.
+            if digest in found:
+                continue
+            found.add(digest)
+            for dest_offset in dest_offsets[digest]:
+                sources[(vol_id, ino)].append((offset, dest_offset))
+    return sources
+
+
+def merge_ranges(pairs, chunk_size):
+    """
+    Turns (source offset, dest offset) pairs of chunks
+    into (source offset, dest offset, length) ranges,
+    merging chunks that are adjacent on both sides.
+    """
+
+    ranges = []
+    for src_offset, dest_offset in sorted(pairs, key=lambda pair: pair[1]):
+        if ranges:
+            prev_src, prev_dest, prev_length = ranges[-1]
+            if (prev_src + prev_length == src_offset
+                    and prev_dest + prev_length == dest_offset):
+                ranges[-1] = (prev_src, prev_dest, prev_length + chunk_size)
+                continue
+        ranges.append((src_offset, dest_offset, chunk_size))
+    return ranges
+
+
+def inode_path(sess, inode):
+    try:
+        return lookup_ino_path_one(inode.vol.fd, inode.ino)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # A stale record; its chunks go away with it
+        sess.delete(inode)
+
+
+def dedup_ranges(sess, tt, opts, log, src_inode, dest_inode, ranges):
+    """
+    Clones identical ranges from src_inode into dest_inode.
+
+    Returns the number of bytes cloned.
+    """
+
+    src_path = inode_path(sess, src_inode)
+    dest_path = inode_path(sess, dest_inode)
+    if src_path is None or dest_path is None:
+        return 0
+
+    try:
+        sfile = fopenat(src_inode.vol.fd, src_path)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+    try:
+        dfile = fopenat_rw(dest_inode.vol.fd, dest_path)
+    except IOError as e:
+        sfile.close()
+        if e.errno in (errno.ETXTBSY, errno.EACCES, errno.ENOENT):
+            tt.notify('Can\'t open %r for writing, skipping' % dest_path)
+            return 0
+        raise
+
+    cloned = reclaimed = 0
+    with ExitStack() as stack:
+        stack.enter_context(closing(sfile))
+        stack.enter_context(closing(dfile))
+        sfd = sfile.fileno()
+        dfd = dfile.fileno()
+        # Enter this context last
+        # Read-only snapshots can't change, and can't be made immutable
+        if src_inode.vol.readonly:
+            frozen = [dfd]
+        else:
+            frozen = [sfd, dfd]
+        immutability = stack.enter_context(ImmutableFDs(frozen))
+        if immutability.fds_in_write_use:
+            tt.notify('Files %r %r are in use, skipping' % (
+                src_path, dest_path))
+            return 0
+
+        src_extents = tuple(fiemap(sfd))
+        dest_extents = tuple(fiemap(dfd))
+        for src_offset, dest_offset, length in ranges:
+            if (range_extents(src_extents, src_offset, length)
+                    == range_extents(dest_extents, dest_offset, length)):
+                # Already shared
+                continue
+            if not cmp_ranges(
+                    opts.throttle.wrap(sfile), opts.throttle.wrap(dfile),
+                    src_offset, dest_offset, length):
+                # A collision of the chunk digest, or a racing write
+                continue
+            reclaimable = exclusive_bytes(dest_extents, dest_offset, length)
+            clone_data_range(
+                dest=dfd, src=sfd, src_offset=src_offset,
+                length=length, dest_offset=dest_offset)
+            cloned += length
+            reclaimed += reclaimable
+
+    if cloned:
+        tt.notify('Deduplicated %d bytes: %r %r' % (
+            cloned, src_path, dest_path))
+        log.record(
+            dest_inode.vol.fs_id, cloned, reclaimed,
+            [(inode.vol_id, inode.ino) for inode in (src_inode, dest_inode)])
+    return cloned
+
+
+def dedup_stale_inode(sess, tt, opts, log, vol_ids, params, inode):
+    # Rechunks a file and clones matching ranges into it;
+    # returns the number of bytes cloned.
+    path = inode_path(sess, inode)
+    if path is None:
+        return 0
+    rfile = opts.throttle.wrap(fopenat(inode.vol.fd, path))
+    with closing(rfile):
+        digests = chunk_digests(rfile, opts.hasher, opts.chunk_size)
+    replace_chunks(sess, inode, digests)
+    inode.chunk_params = params
+    inode.chunk_transid = inode.transid
+    if inode.vol.readonly:
+        # Indexed as a source only
+        return 0
+
+    cloned = 0
+    sources = find_sources(sess, vol_ids, params, inode, digests)
+    for (vol_id, ino), pairs in sorted(sources.iteritems()):
+        src_inode = sess.query(Inode).get((vol_id, ino))
+        cloned += dedup_ranges(
+            sess, tt, opts, log, src_inode, inode,
+            merge_ranges(pairs, opts.chunk_size))
+    return cloned
+
+
+def stale_windows(query, per):
+    # Yields the inodes of query in (vol_id, ino) order, per at a time;
+    # each window is loaded after the previous one was committed.
+    query = query.order_by(Inode.vol_id, Inode.ino)
+    window = query.limit(per).all()
+    while window:
+        # Taken before the commit, which expires the window
+        last_vol_id, last_ino = window[-1].vol_id, window[-1].ino
+        yield window
+        window = query.filter(or_(
+            Inode.vol_id > last_vol_id,
+            and_(Inode.vol_id == last_vol_id, Inode.ino > last_ino),
+        )).limit(per).all()
+
+
+def refresh_chunk_transids(volset, inodes):
+    # Cloning into a file gives it a new transid without changing
+    # its contents; its chunks stay current.  The transid is read
+    # back once the transaction is committed.  A write in between
+    # would go unnoticed until the next one, ranges are still
+    # compared before they are cloned.
+    syncfs(volset[0].fd)
+    for inode in inodes:
+        transid = get_inode_transid(inode.vol.fd, inode.ino)
+        if transid is not None:
+            inode.chunk_transid = transid
+
+
+def dedup_chunks(sess, volset, tt, opts):
+    """
+    Deduplicates identical ranges of the tracked files of a volume set.
+
+    Chunks are recomputed for files that changed since the last pass.
+    """
+
+    vol_ids = [vol.id for vol in volset]
+    params = chunk_params(opts)
+    chunk_size = opts.chunk_size
+
+    stale = sess.query(Inode).filter(
+        Inode.vol_id.in_(vol_ids),
+        Inode.size >= MIN_CHUNKS * chunk_size,
+        or_(
+            func.coalesce(Inode.chunk_params, '') != params,
+            func.coalesce(Inode.chunk_transid, -1)
+            != func.coalesce(Inode.transid, -1)),
+        *opts.settled_filters()
+    )
+    stale_count = stale.count()
+
+    tt.format('{elapsed} Chunked file {chunked:counter}/{chunked:total}')
+    tt.set_total(chunked=stale_count)
+    total_cloned = 0
+    with closing(EventLog(opts.make_log_session)) as log:
+        for window in stale_windows(stale, STALE_WINDOW):
+            cloned_into = []
+            for inode in window:
+                tt.update(chunked=inode)
+                cloned = dedup_stale_inode(
+                    sess, tt, opts, log, vol_ids, params, inode)
+                if cloned:
+                    cloned_into.append(inode)
+                total_cloned += cloned
+            if cloned_into:
+                refresh_chunk_transids(volset, cloned_into)
+            sess.commit()
+    tt.notify('Partial dedup: %d files chunked, %d bytes cloned' % (
+        stale_count, total_cloned))
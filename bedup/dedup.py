@@ -82,6 +82,18 @@ def cmp_files(fi1, fi2):
             return True
 
 
+def cmp_ranges(fi1, fi2, offset1, offset2, length):
+    fi1.seek(offset1)
+    fi2.seek(offset2)
+    while length > 0:
+        b1 = fi1.read(min(BUFSIZE, length))
+        b2 = fi2.read(min(BUFSIZE, length))
+        if b1 != b2 or not b1:
+            return False
+        length -= len(b1)
+    return True
+
+
 def dedup_same(source, dests, defragment=False):
     if defragment:
         source_fd = os.open(source, os.O_RDWR)
@@ -0,0 +1,159 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import Queue
+import threading
+
+from sqlalchemy.sql import func
+
+from .datetime import system_now
+from .logModel import DedupEvent, DedupEventInode
+from .stats import update_aggregates
+from .time import monotonic_time
+
+# Events are committed in batches of this many,
+# or when the oldest pending one is this many seconds old.
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 5.
+
+# Queued to stop the writer
+LOG_END = None
+
+
+class EventLog(object):
+    """
+    Records dedup events into the log database.
+
+    Events are written by a background thread, so that the dedup loop
+    doesn't wait on the log database's fsyncs.  Without make_session,
+    events are dropped.
+    """
+
+    def __init__(self, make_session):
+        self.make_session = make_session
+        self.error = None
+        self.queue = Queue.Queue()
+        self.thread = None
+        if make_session is not None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def record(self, fs_id, item_size, reclaimed_bytes, inodes):
+        # inodes is a sequence of (vol_id, ino) pairs
+        self._check()
+        if self.thread is None:
+            return
+        self.queue.put((
+            system_now(), fs_id, item_size, reclaimed_bytes, tuple(inodes)))
+
+    def flush(self):
+        # Waits until the events recorded so far are committed
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        self._check()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(LOG_END)
+        self.thread.join()
+        self.thread = None
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            self._write_batches()
+        except Exception as e:
+            self.error = e
+            # Keep releasing flush calls until the log is closed
+            while True:
+                item = self.queue.get()
+                if item is LOG_END:
+                    return
+                if isinstance(item, tuple):
+                    continue
+                item.set()
+
+    def _write_batches(self):
+        sess = self.make_session()
+        pending = []
+        deadline = None
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - monotonic_time())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                # The oldest pending event is due
+                item = threading.Event()
+
+            if isinstance(item, tuple):
+                pending.append(item)
+                if deadline is None:
+                    deadline = monotonic_time() + LOG_FLUSH_INTERVAL
+                if len(pending) < LOG_BATCH_SIZE:
+                    continue
+
+            write_events(sess, pending)
+            pending = []
+            deadline = None
+            if item is LOG_END:
+                sess.close()
+                return
+            if not isinstance(item, tuple):
+                item.set()
+
+
+def write_events(sess, events):
+    if not events:
+        return
+    for created, fs_id, item_size, reclaimed_bytes, inodes in events:
+        evt = DedupEvent(
+            fs_id=fs_id, item_size=item_size, created=created,
+            reclaimed_bytes=reclaimed_bytes, inode_count=len(inodes))
+        sess.add(evt)
+        for vol_id, ino in inodes:
+            sess.add(DedupEventInode(event=evt, vol_id=vol_id, ino=ino))
+    # In the same transaction, so the totals match the events
+    update_aggregates(sess, events)
+    sess.commit()
+
+
+def sum_reclaimed_bytes(make_session, fs_id, since, until):
+    # The sum of DedupEvent.reclaimed_bytes over a time range
+    sess = make_session()
+    try:
+        return sess.query(
+            func.coalesce(func.sum(DedupEvent.reclaimed_bytes), 0)
+        ).filter(
+            DedupEvent.fs_id == fs_id,
+            DedupEvent.created >= since,
+            DedupEvent.created <= until,
+        ).scalar()
+    finally:
+        sess.close()
@@ -0,0 +1,137 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import struct
+
+# The extent layout of a file, as seen in its EXTENT_DATA items
+# during the volume scan.  Stored packed on the inode, so that
+# the layout can be used without opening the file.
+
+# logical offset, disk_bytenr, offset into the disk extent, num_bytes,
+# compression, extent type
+EXTENT_STRUCT = struct.Struct('<QQQQBB')
+# Files with more extents are left to FIEMAP; keeps rows small
+MAX_EXTENTS = 1024
+# Extent types, from the btrfs disk format (BTRFS_FILE_EXTENT_*)
+FILE_EXTENT_PREALLOC = 2
+# Files with at most this share of their size in written data are
+# sparse; they are hashed and compared by their data ranges only.
+SPARSE_MAX_DATA_SHARE = .5
+
+
+def pack_extents(records, size):
+    """
+    Packs the extent records of a file.
+
+    Records must be sorted by logical offset.  Returns None unless they
+    cover the file without gaps; records in leaves older than the
+    scanned generations don't show up, and with the no-holes feature
+    holes don't have records either.
+    """
+
+    if len(records) > MAX_EXTENTS:
+        return None
+    end = 0
+    for record in records:
+        if record[0] != end:
+            return None
+        end += record[3]
+    if end < size:
+        return None
+    return b''.join(EXTENT_STRUCT.pack(*record) for record in records)
+
+
+def unpack_extents(packed):
+    return [
+        EXTENT_STRUCT.unpack_from(packed, offset)
+        for offset in xrange(0, len(packed), EXTENT_STRUCT.size)]
+
+
+def first_physical(packed):
+    """
+    Gets the disk location where reading the file starts,
+    like fiemap.first_physical.
+
+    Returns None for files that are all holes.
+    """
+
+    for logical, bytenr, offset, num_bytes, compression, kind in (
+        unpack_extents(packed)
+    ):
+        if bytenr == 0:
+            # A hole
+            continue
+        if compression:
+            return bytenr
+        return bytenr + offset
+
+
+def shared_extents_key(packed):
+    """
+    Gets a key that is the same for files whose data is fully shared,
+    like fiemap.shared_extents_key.
+
+    Files with the same layout point to the same disk extents
+    at the same offsets.  Returns None for files that are all holes.
+    """
+
+    if first_physical(packed) is None:
+        return None
+    return packed
+
+
+def data_ranges(packed, size):
+    """
+    Gets the ranges of the file that hold written data,
+    like fiemap.data_ranges.
+    """
+
+    return merge_ranges((
+        (logical, num_bytes)
+        for logical, bytenr, offset, num_bytes, compression, kind in (
+            unpack_extents(packed))
+        # Holes have no disk location, preallocated extents read as zeros
+        if bytenr != 0 and kind != FILE_EXTENT_PREALLOC), size)
+
+
+def merge_ranges(ranges, size):
+    """
+    Merges sorted (offset, length) ranges that touch,
+    and clips them to size.
+
+    Returns a tuple; files with the same data ranges
+    have holes in the same places.
+    """
+
+    rv = []
+    for offset, length in ranges:
+        end = min(offset + length, size)
+        if offset >= end:
+            continue
+        if rv and rv[-1][0] + rv[-1][1] >= offset:
+            start = rv[-1][0]
+            rv[-1] = (start, max(end, start + rv[-1][1]) - start)
+        else:
+            rv.append((offset, end - offset))
+    return tuple(rv)
+
+
+def is_sparse(ranges, size):
+    # Mostly holes and preallocated space
+    return sum(length for offset, length in ranges) <= (
+        size * SPARSE_MAX_DATA_SHARE)
@@ -19,6 +19,10 @@
 from cffi import FFI
 from collections import namedtuple
 import fcntl
+import hashlib
+import struct
+
+from .extents import merge_ranges
 
 ffi = FFI()
 ffi.cdef('''
@@ -86,19 +90,32 @@ lib = ffi.verify('''
 FiemapExtent = namedtuple('FiemapExtent', 'logical physical length flags')
 
 
+# Room for extents added between the count and the mapping
+EXTENT_SLACK = 8
+
+
 def fiemap(fd):
     """
     Gets a map of file extents.
+
+    The extent count is queried first, so that the whole map
+    is usually read with one more ioctl.
     """
 
-    count = 72
+    count_cbuf = ffi.new('char[]', ffi.sizeof('struct fiemap'))
+    count_ptr = ffi.cast('struct fiemap*', count_cbuf)
+    count_ptr.fm_length = lib.FIEMAP_MAX_OFFSET
+    # With no room for extents, the kernel only counts them
+    count_ptr.fm_extent_count = 0
+    fcntl.ioctl(fd, lib.FS_IOC_FIEMAP, ffi.buffer(count_cbuf))
+    count = count_ptr.fm_mapped_extents + EXTENT_SLACK
+
     fiemap_cbuf = ffi.new(
         'char[]',
         ffi.sizeof('struct fiemap')
         + count * ffi.sizeof('struct fiemap_extent'))
     fiemap_pybuf = ffi.buffer(fiemap_cbuf)
     fiemap_ptr = ffi.cast('struct fiemap*', fiemap_cbuf)
-    assert ffi.sizeof(fiemap_cbuf) <= 4096
 
     while True:
         fiemap_ptr.fm_length = lib.FIEMAP_MAX_OFFSET
@@ -111,9 +128,155 @@ def fiemap(fd):
             yield FiemapExtent(
                 extent.fe_logical, extent.fe_physical,
                 extent.fe_length, extent.fe_flags)
+        if extent.fe_flags & lib.FIEMAP_EXTENT_LAST:
+            break
+        # The file grew past the slack since it was counted
         fiemap_ptr.fm_start = extent.fe_logical + extent.fe_length
 
 
+# Flags that describe how the data is stored.
+# FIEMAP_EXTENT_SHARED and FIEMAP_EXTENT_LAST are left out, they change
+# whenever another file shares the extent or the file is appended to,
+# without the extent itself changing.
+DIGEST_FLAGS_MASK = (
+    lib.FIEMAP_EXTENT_ENCODED
+    | lib.FIEMAP_EXTENT_DATA_ENCRYPTED
+    | lib.FIEMAP_EXTENT_UNWRITTEN)
+
+EXTENT_STRUCT = struct.Struct('<QQQI')
+# Past the end of any file
+FIEMAP_MAX_OFFSET_BOUND = 2 ** 64
+
+
+def extent_map_digest(extents):
+    """
+    Gets a stable digest of an extent map, suitable for persisting.
+
+    Unlike the builtin hash, this doesn't depend on the interpreter,
+    the word size or hash randomisation.  Files with the same digest
+    have the same extents at the same logical offsets.
+
+    Returns None if the map contains delayed allocations or inline data,
+    their location isn't meaningful.
+    """
+
+    hasher = hashlib.sha1()
+    for extent in extents:
+        if extent.flags & (
+            lib.FIEMAP_EXTENT_UNKNOWN | lib.FIEMAP_EXTENT_DATA_INLINE
+        ):
+            return None
+        hasher.update(EXTENT_STRUCT.pack(
+            extent.logical, extent.physical, extent.length,
+            extent.flags & DIGEST_FLAGS_MASK))
+    # Truncated to fit an SQLite integer
+    return struct.unpack('<q', hasher.digest()[:8])[0]
+
+
+def first_physical(extents):
+    """
+    Gets the disk location where reading the file starts.
+
+    Returns None if no extent has a known location
+    (empty or sparse files, inline or delalloc data).
+    """
+
+    for extent in extents:
+        if extent.flags & (
+            lib.FIEMAP_EXTENT_UNKNOWN | lib.FIEMAP_EXTENT_DATA_INLINE
+        ):
+            continue
+        return extent.physical
+
+
+def shared_extents_key(extents):
+    """
+    Gets a key that is the same for files whose data is fully shared.
+
+    Returns None unless every extent is flagged as shared
+    and has a known location.  Files with the same key have
+    the same extent map, there is nothing to gain from cloning them.
+    """
+
+    if not extents:
+        return None
+    for extent in extents:
+        if not extent.flags & lib.FIEMAP_EXTENT_SHARED:
+            return None
+        if extent.flags & (
+            lib.FIEMAP_EXTENT_UNKNOWN | lib.FIEMAP_EXTENT_DATA_INLINE
+        ):
+            return None
+    return tuple(
+        (extent.logical, extent.physical, extent.length)
+        for extent in extents)
+
+
+def data_ranges(extents, size):
+    """
+    Gets the (offset, length) ranges of a file that hold written data.
+
+    Holes and unwritten (preallocated) extents read as zeros
+    and are left out.
+    """
+
+    return merge_ranges((
+        (extent.logical, extent.length) for extent in extents
+        if not extent.flags & lib.FIEMAP_EXTENT_UNWRITTEN), size)
+
+
+def exclusive_bytes(extents, offset=0, length=None):
+    """
+    Counts the bytes of a file, or of a range of it, that aren't shared
+    with other files or snapshots.
+
+    This is an upper bound on what replacing the range with a clone
+    frees: it counts logical bytes, and compressed extents take less on
+    disk; an extent only partly covered by the range (a bookend) stays
+    allocated as long as the rest of it is referenced.
+    """
+
+    if length is None:
+        end = FIEMAP_MAX_OFFSET_BOUND
+    else:
+        end = offset + length
+    total = 0
+    for extent in extents:
+        if extent.flags & (
+            lib.FIEMAP_EXTENT_SHARED | lib.FIEMAP_EXTENT_UNKNOWN
+            | lib.FIEMAP_EXTENT_DATA_INLINE
+        ):
+            continue
+        start = max(extent.logical, offset)
+        stop = min(extent.logical + extent.length, end)
+        if start < stop:
+            total += stop - start
+    return total
+
+
+def range_extents(extents, offset, length):
+    """
+    Gets the disk locations backing a range of a file.
+
+    Two ranges with the same value share their data.
+    """
+
+    end = offset + length
+    rv = []
+    for extent in extents:
+        start = max(extent.logical, offset)
+        stop = min(extent.logical + extent.length, end)
+        if start >= stop:
+            continue
+        if extent.flags & lib.FIEMAP_EXTENT_ENCODED:
+            # Compressed; physical offsets don't map to logical ones
+            rv.append((extent.physical, start - extent.logical, stop - start))
+        else:
+            rv.append(
+                (extent.physical + start - extent.logical, 0, stop - start))
+    return tuple(rv)
+
+
 def same_extents(fd1, fd2):
     return tuple(fiemap(fd1)) == tuple(fiemap(fd2))
 
@@ -0,0 +1,167 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+
+from sqlalchemy import and_
+from sqlalchemy.sql import select
+
+from .model import Inode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Candidate selection.
+# The columns needed to pick size groups are loaded for the whole
+# volume set in one sequential read, into typed arrays, and sorted
+# in memory; this replaces a GROUP BY and the B-tree probes behind it.
+
+# array has no 64-bit typecode before Python 3.3; long is 64-bit
+# on the LP64 platforms btrfs runs on.
+try:
+    array.array('q')
+except ValueError:
+    INT64 = 'l'
+else:
+    INT64 = 'q'
+
+# Marks inodes without a current extent signature
+NO_SIGNATURE = 0
+
+SizeGroup = collections.namedtuple('SizeGroup', 'size inode_count')
+
+
+class InodeColumns(object):
+    """
+    The columns of the tracked inodes used to pick size groups.
+
+    The extent signature is the persisted fiemap_hash, when it is
+    current; files with the same signature are already deduplicated.
+    """
+
+    __slots__ = ('sizes', 'updates', 'signatures')
+
+    def __init__(self):
+        self.sizes = array.array(INT64)
+        self.updates = array.array('b')
+        self.signatures = array.array(INT64)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def append(self, size, has_updates, signature):
+        self.sizes.append(size)
+        self.updates.append(bool(has_updates))
+        # NO_SIGNATURE is also a possible digest; those files
+        # just don't get treated as deduplicated.
+        self.signatures.append(
+            NO_SIGNATURE if signature is None else signature)
+
+
+def load_inode_columns(sess, filters):
+    rv = InodeColumns()
+    query = select([
+        Inode.size, Inode.has_updates, Inode.fiemap_hash,
+        Inode.fiemap_transid, Inode.transid,
+    ]).where(and_(*filters))
+    for size, has_updates, fiemap_hash, fiemap_transid, transid in (
+        sess.execute(query)
+    ):
+        if transid is None or fiemap_transid != transid:
+            fiemap_hash = None
+        rv.append(size, has_updates, fiemap_hash)
+    return rv
+
+
+def is_candidate(updated, signatures, updated_only=True):
+    # A group is worth looking at if a member changed since the last
+    # pass, and its members don't all have the same known layout.
+    if updated_only and not updated:
+        return False
+    first = signatures[0]
+    if first == NO_SIGNATURE:
+        return True
+    return any(signature != first for signature in signatures)
+
+
+def scan_runs(columns, order, updated_only=True):
+    # Yields the runs of equal sizes, given the indices in size order
+    sizes = columns.sizes
+    start = 0
+    count = len(order)
+    while start < count:
+        size = sizes[order[start]]
+        end = start + 1
+        while end < count and sizes[order[end]] == size:
+            end += 1
+        if end - start > 1:
+            members = order[start:end]
+            if is_candidate(
+                any(columns.updates[idx] for idx in members),
+                [columns.signatures[idx] for idx in members],
+                updated_only,
+            ):
+                yield SizeGroup(size, end - start)
+        start = end
+
+
+def scan_runs_numpy(columns, updated_only=True):
+    sizes = numpy.frombuffer(columns.sizes, dtype=numpy.int64)
+    updates = numpy.frombuffer(columns.updates, dtype=numpy.int8)
+    signatures = numpy.frombuffer(columns.signatures, dtype=numpy.int64)
+    # Largest first; stable so that runs keep the load order
+    order = numpy.argsort(-sizes, kind='mergesort')
+    sizes = sizes[order]
+    starts = numpy.flatnonzero(numpy.diff(sizes)) + 1
+    starts = numpy.concatenate(([0], starts))
+    counts = numpy.diff(numpy.concatenate((starts, [len(sizes)])))
+    updated = numpy.maximum.reduceat(updates[order], starts)
+    for start, count, group_updated in zip(starts, counts, updated):
+        if count < 2:
+            continue
+        if is_candidate(
+            group_updated,
+            signatures[order[start:start + count]].tolist(),
+            updated_only,
+        ):
+            yield SizeGroup(int(sizes[start]), int(count))
+
+
+def size_groups(sess, filters, updated_only=True):
+    """
+    Gets the sizes shared by several of the inodes matching filters,
+    largest first.
+
+    With updated_only, groups without a member changed since the last
+    dedup pass are left out.
+    Returns a list of SizeGroup tuples.  NumPy is used for sorting
+    when it is available.
+    """
+
+    columns = load_inode_columns(sess, filters)
+    if not columns:
+        return []
+    if numpy is not None:
+        return list(scan_runs_numpy(columns, updated_only))
+    sizes = columns.sizes
+    order = sorted(
+        xrange(len(columns)), key=sizes.__getitem__, reverse=True)
+    return list(scan_runs(columns, order, updated_only))
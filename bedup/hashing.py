@@ -0,0 +1,107 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import os
+
+from .time import monotonic_time
+
+# Files are always compared byte for byte before being cloned,
+# so the content hash only needs to be good at telling files apart;
+# it doesn't need to be cryptographic.
+
+# new() returns an object with the hashlib update/digest interface
+HashProvider = collections.namedtuple('HashProvider', 'name new')
+
+# Bytes hashed by the self-test, and the size of each update.
+SELF_TEST_SIZE = 16 * 1024 ** 2
+SELF_TEST_BUFSIZE = 8192
+
+
+def available_providers():
+    """
+    Lists the hash providers that can be used here.
+
+    blake2b is in hashlib starting with Python 3.6, or comes from pyblake2.
+    xxh3 and xxh128 require the xxhash module.
+    """
+
+    providers = [HashProvider('sha1', hashlib.sha1)]
+
+    blake2b = getattr(hashlib, 'blake2b', None)
+    if blake2b is None:
+        try:
+            import pyblake2
+        except ImportError:
+            pass
+        else:
+            blake2b = pyblake2.blake2b
+    if blake2b is not None:
+        providers.append(HashProvider('blake2b', blake2b))
+
+    try:
+        import xxhash
+    except ImportError:
+        pass
+    else:
+        if hasattr(xxhash, 'xxh3_64'):
+            providers.append(HashProvider('xxh3', xxhash.xxh3_64))
+        if hasattr(xxhash, 'xxh3_128'):
+            providers.append(HashProvider('xxh128', xxhash.xxh3_128))
+    return providers
+
+
+def default_provider_name():
+    names = [provider.name for provider in available_providers()]
+    if 'blake2b' in names:
+        return 'blake2b'
+    return 'sha1'
+
+
+def measure_throughput(provider):
+    """Gets the throughput of a provider, in bytes per second."""
+
+    buf = os.urandom(SELF_TEST_BUFSIZE)
+    hasher = provider.new()
+    start = monotonic_time()
+    for i in xrange(SELF_TEST_SIZE // SELF_TEST_BUFSIZE):
+        hasher.update(buf)
+    hasher.digest()
+    # The clock might be coarse
+    elapsed = max(monotonic_time() - start, 1e-9)
+    return SELF_TEST_SIZE / elapsed
+
+
+def fastest_provider():
+    return max(available_providers(), key=measure_throughput)
+
+
+def get_provider(name):
+    """
+    Gets a hash provider by name.
+
+    'auto' runs the self-test and picks the fastest provider.
+    """
+
+    if name == 'auto':
+        return fastest_provider()
+    for provider in available_providers():
+        if provider.name == name:
+            return provider
+    raise KeyError(name)
@@ -0,0 +1,198 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import errno
+import os
+import struct
+import tempfile
+
+from .grouping import INT64
+
+# Inode indexes.
+# The scan keeps the (ino, size, transid, mtime) of every regular file of a
+# volume, whatever the size cutoff, in a file next to the database.
+# When the cutoff is lowered, the files between the two cutoffs are
+# taken from the index instead of rescanning from the first generation.
+# The columns are stored as arrays sorted by inode number, in native
+# byte order; the file is a cache and is only used by this machine.
+
+INDEX_MAGIC = b'bedupidx'
+INDEX_VERSION = 2
+# magic, version, item size, generation, number of inodes
+INDEX_HEADER = struct.Struct('=8sIIQQ')
+
+
+class InodeIndex(object):
+    """The (ino, size, transid, mtime) columns of an index, sorted by ino."""
+
+    __slots__ = ('inos', 'sizes', 'transids', 'mtimes')
+
+    def __init__(self):
+        self.inos = array.array(INT64)
+        self.sizes = array.array(INT64)
+        self.transids = array.array(INT64)
+        self.mtimes = array.array(INT64)
+
+    def __len__(self):
+        return len(self.inos)
+
+    def columns(self):
+        return (self.inos, self.sizes, self.transids, self.mtimes)
+
+    def append(self, ino, size, transid, mtime):
+        self.inos.append(ino)
+        self.sizes.append(size)
+        self.transids.append(transid)
+        self.mtimes.append(mtime)
+
+    def entry(self, idx):
+        return (
+            self.inos[idx], self.sizes[idx], self.transids[idx],
+            self.mtimes[idx])
+
+    def size_range(self, low, high):
+        # Returns the entries of files with low <= size < high
+        sizes = self.sizes
+        return [
+            self.entry(idx)
+            for idx in xrange(len(self)) if low <= sizes[idx] < high]
+
+    def merged(self, newer, removed):
+        """
+        Merges the entries of newer, which take precedence,
+        and leaves out our entries whose inode numbers are in removed.
+        """
+
+        rv = InodeIndex()
+        i = j = 0
+        while i < len(self) or j < len(newer):
+            if j == len(newer) or (
+                i < len(self) and self.inos[i] < newer.inos[j]
+            ):
+                src, idx = self, i
+                i += 1
+            else:
+                if i < len(self) and self.inos[i] == newer.inos[j]:
+                    i += 1
+                src, idx = newer, j
+                j += 1
+            if src is self and src.inos[idx] in removed:
+                continue
+            rv.append(*src.entry(idx))
+        return rv
+
+
+def index_path(index_dir, vol):
+    return os.path.join(index_dir, '%s-%d' % (vol.fs.uuid, vol.root_id))
+
+
+def read_index(path, generation):
+    """
+    Reads an index file.
+
+    Returns None unless it exists and is current as of generation.
+    """
+
+    try:
+        ifile = open(path, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    rv = InodeIndex()
+    with ifile:
+        header = ifile.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            return
+        magic, version, itemsize, index_generation, count = (
+            INDEX_HEADER.unpack(header))
+        if (magic != INDEX_MAGIC or version != INDEX_VERSION
+                or itemsize != rv.inos.itemsize
+                or index_generation != generation):
+            return
+        try:
+            for column in rv.columns():
+                column.fromfile(ifile, count)
+        except EOFError:
+            return
+    return rv
+
+
+def write_index(path, index, generation):
+    # Replaces the file atomically
+    index_dir = os.path.dirname(path)
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    fd, temp_path = tempfile.mkstemp(dir=index_dir)
+    try:
+        with os.fdopen(fd, 'wb') as ofile:
+            ofile.write(INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, index.inos.itemsize,
+                generation, len(index)))
+            for column in index.columns():
+                column.tofile(ofile)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+class IndexUpdate(object):
+    """
+    Keeps the index of a volume current through a scan.
+
+    base is the index as of the previous scan; it is None when the
+    scan covers the whole volume and the index is rebuilt.
+    """
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base
+        self.seen = InodeIndex()
+        # The tree search returns inodes in order
+        self.in_order = True
+        self.removed = set()
+
+    def add(self, entries):
+        seen = self.seen
+        for entry in entries:
+            if seen.inos and entry[0] <= seen.inos[-1]:
+                self.in_order = False
+            seen.append(*entry)
+
+    def forget(self, ino):
+        # For removed inodes; only used before the scan
+        self.removed.add(ino)
+
+    def save(self, generation):
+        seen = self.seen
+        if not self.in_order:
+            ordered = InodeIndex()
+            # Later entries take precedence
+            last = {}
+            for idx in xrange(len(seen)):
+                last[seen.inos[idx]] = idx
+            for ino in sorted(last):
+                ordered.append(*seen.entry(last[ino]))
+            seen = ordered
+        if self.base is None:
+            index = seen
+        else:
+            index = self.base.merged(seen, self.removed)
+        write_index(self.path, index, generation)
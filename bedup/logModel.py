@@ -16,9 +16,9 @@
 # You should have received a copy of the GNU General Public License
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy.orm import relationship, column_property
+from sqlalchemy.orm import relationship
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import and_, select, func, literal_column, distinct
+from sqlalchemy.sql import and_, literal_column, distinct
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.types import (
@@ -58,6 +58,14 @@ class DedupEvent(Base):
 
     item_size = Column(Integer, index=True, nullable=False)
     created = Column(UTCDateTime, index=True, nullable=False)
+    # Bytes the destinations didn't share with anything before
+    # being cloned; an upper bound on what the clone freed, since
+    # compressed extents take less on disk and an extent stays
+    # allocated while any part of it is still referenced.
+    reclaimed_bytes = Column(Integer, nullable=True)
+    # The number of DedupEventInode rows, stored so that it doesn't
+    # take a subquery per event
+    inode_count = Column(Integer, nullable=False)
 
     @hybrid_property
     def estimated_space_gain(self):
@@ -78,10 +86,30 @@ class DedupEventInode(Base):
         dict(
             sqlite_autoincrement=True))
 
-DedupEvent.inode_count = column_property(
-    select([func.count(DedupEventInode.id)])
-    .where(DedupEventInode.event_id == DedupEvent.id)
-    .label('inode_count'))
+
+class EventAggregate(Base):
+    # Totals of the dedup events, per time bucket, filesystem,
+    # volume and size class; see stats.update_aggregates
+    id = Column(Integer, primary_key=True)
+    period = Column(
+        Text, CheckConstraint("period in ('day', 'week')"), nullable=False)
+    bucket_start = Column(UTCDateTime, nullable=False)
+    fs_id = Column(Integer, nullable=False)
+    vol_id = Column(Integer, nullable=False)
+    # Item sizes are grouped by powers of two, this is the exponent
+    size_class = Column(Integer, nullable=False)
+
+    event_count = Column(Integer, nullable=False)
+    inode_count = Column(Integer, nullable=False)
+    # Sum of DedupEvent.estimated_space_gain
+    space_gain = Column(Integer, nullable=False)
+    reclaimed_bytes = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            'period', 'bucket_start', 'fs_id', 'vol_id', 'size_class'),
+        dict(
+            sqlite_autoincrement=True))
 
 
 LOG = Base.metadata
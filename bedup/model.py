@@ -22,13 +22,16 @@ from sqlalchemy.sql import and_, select, func, literal_column, distinct
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.types import (
-    Boolean, Integer, Text, DateTime, TypeDecorator)
+    Boolean, Integer, Text, DateTime, LargeBinary, TypeDecorator)
 from sqlalchemy.schema import (
-    Column, ForeignKey, UniqueConstraint, CheckConstraint)
+    Column, ForeignKey, ForeignKeyConstraint, UniqueConstraint,
+    CheckConstraint)
 
+from collections import namedtuple
 from zlib import adler32
-from . import fiemap
+from . import extents, fiemap
 from .datetime import UTC
+from .throttle import read_at
 
 
 def FK(cattr, primary_key=False, backref=None, nullable=False):
@@ -44,10 +47,15 @@ def FK(cattr, primary_key=False, backref=None, nullable=False):
 class UTCDateTime(TypeDecorator):
     impl = DateTime
 
+    # Also used by nullable columns
     def process_bind_param(self, value, engine):
+        if value is None:
+            return None
         return value.astimezone(UTC)
 
     def process_result_value(self, value, engine):
+        if value is None:
+            return None
         return value.replace(tzinfo=UTC)
 
 
@@ -62,6 +70,29 @@ def get_or_create(sess, model, **kwargs):
         return instance, True
 
 
+MiniHashSampling = namedtuple('MiniHashSampling', 'samples block')
+
+DEFAULT_MINI_HASH_SAMPLING = MiniHashSampling(samples=5, block=4096)
+
+
+def mini_hash_offsets(size, sampling):
+    """
+    Gets the offsets of the blocks read for the mini hash.
+    """
+
+    samples, block = sampling
+    if samples < 2:
+        return [0]
+    if size <= samples * block:
+        # Small files are read whole
+        return list(xrange(0, size, block))
+    last = size - block
+    offsets = set([last])
+    for i in xrange(samples - 1):
+        offsets.add(last * i // (samples - 1) // block * block)
+    return sorted(offsets)
+
+
 class SuperBase(object):
     @declared_attr
     def __tablename__(cls):
@@ -94,6 +125,9 @@ class Volume(Base):
     last_tracked_generation = Column(Integer, nullable=False, default=0)
     last_tracked_size_cutoff = Column(Integer, nullable=True)
     size_cutoff = Column(Integer, nullable=False)
+    # From the flags of the root item (read-only snapshots);
+    # files of read-only volumes can only be clone sources.
+    readonly = Column(Boolean, nullable=False, default=False)
 
 
 class VolumePathHistory(Base):
@@ -110,6 +144,22 @@ class VolumePathHistory(Base):
             sqlite_autoincrement=True))
 
 
+class VolumePathFilter(Base):
+    # Include and exclude rules for the files of a volume,
+    # applied by the scan (see pathfilter.PathFilter).
+    id = Column(Integer, primary_key=True)
+    vol_id, vol = FK(Volume.id, backref='path_filters')
+    kind = Column(
+        Text, CheckConstraint("kind in ('include', 'exclude')"),
+        nullable=False)
+    pattern = Column(Text, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            'vol_id', 'kind', 'pattern'),
+        )
+
+
 Volume.last_known_mountpoint = column_property(
     select([VolumePathHistory.path])
     .where(
@@ -119,7 +169,71 @@ Volume.last_known_mountpoint = column_property(
 )
 
 
-class Inode(Base):
+class InodeMixin(object):
+    # Methods shared by Inode and InodeRecord
+    __slots__ = ()
+
+    def mini_hash_from_file(self, rfile, sampling=DEFAULT_MINI_HASH_SAMPLING):
+        # A very cheap, very partial hash for quick disambiguation
+        # Samples the head, the tail, and evenly spaced blocks in between,
+        # so that files which only share a header (disk images, media
+        # containers, archives) get told apart.
+        # Won't help with things like zeroed or sparse files;
+        # those are told apart by their data ranges (see is_sparse).
+
+        # adler32 of the empty string; with a single sample, this is the
+        # same as hashing the first block.
+        mini_hash = 1
+        for offset in mini_hash_offsets(self.size, sampling):
+            mini_hash = adler32(
+                read_at(rfile, sampling.block, offset), mini_hash)
+        # bitops to make unsigned, for better readability
+        self.mini_hash = mini_hash & 0xffffffff
+
+    def fiemap_hash_from_file(self, rfile):
+        extents = tuple(fiemap.fiemap(rfile.fileno()))
+        self.fiemap_hash = fiemap.extent_map_digest(extents)
+        self.fiemap_transid = self.transid
+        # Not persisted, used to schedule reads in disk order
+        self.physical_start = fiemap.first_physical(extents)
+        # Not persisted, used to skip files that are already deduplicated
+        self.shared_extents = fiemap.shared_extents_key(extents)
+        # Not persisted, used to avoid reading holes
+        self.data_ranges = fiemap.data_ranges(extents, self.size)
+
+    def has_current_extents(self):
+        return (
+            self.extents is not None
+            and self.transid is not None
+            and self.extents_transid == self.transid)
+
+    def layout_from_extents(self):
+        # Same as fiemap_hash_from_file, from the layout recorded
+        # by the scan; fiemap_hash is left alone.
+        self.physical_start = extents.first_physical(self.extents)
+        self.shared_extents = extents.shared_extents_key(self.extents)
+        self.data_ranges = extents.data_ranges(self.extents, self.size)
+
+    def is_sparse(self):
+        # Needs the layout, from fiemap_hash_from_file
+        # or layout_from_extents
+        return self.data_ranges is not None and extents.is_sparse(
+            self.data_ranges, self.size)
+
+    def has_current_digest(self, hash_name):
+        # Files that haven't changed since they were hashed
+        # don't need to be read again.
+        return (
+            self.digest is not None
+            and self.digest_hash == hash_name
+            and self.transid is not None
+            and self.digest_transid == self.transid)
+
+    def __repr__(self):
+        return 'Inode(ino=%d, volume=%d)' % (self.ino, self.vol_id)
+
+
+class Inode(InodeMixin, Base):
     vol_id, vol = FK(Volume.id, primary_key=True)
     # inode number
     ino = Column(Integer, primary_key=True)
@@ -129,6 +243,28 @@ class Inode(Base):
     mini_hash = Column(Integer, index=True, nullable=True)
     # A digest of that file's FIEMAP extent info.
     fiemap_hash = Column(Integer, index=True, nullable=True)
+    # The transid of the inode item when the scan last saw it.
+    transid = Column(Integer, nullable=True)
+    # The mtime and ctime of the inode item when the scan last saw it,
+    # in seconds since the epoch.
+    mtime = Column(Integer, nullable=True)
+    ctime = Column(Integer, nullable=True)
+    # The transid at which fiemap_hash was computed;
+    # fiemap_hash is current as long as it matches transid.
+    fiemap_transid = Column(Integer, nullable=True)
+    # How the Chunk rows of this inode were computed
+    # ('<hash name>:<chunk size>'), and at which transid.
+    chunk_params = Column(Text, nullable=True)
+    chunk_transid = Column(Integer, nullable=True)
+    # The hex digest of the contents, the name of the hash that
+    # computed it, and the transid at which it was computed.
+    digest = Column(Text, index=True, nullable=True)
+    digest_hash = Column(Text, nullable=True)
+    digest_transid = Column(Integer, nullable=True)
+    # The extent layout seen by the scan (see extents.pack_extents),
+    # and the transid it is current for.
+    extents = Column(LargeBinary, nullable=True)
+    extents_transid = Column(Integer, nullable=True)
 
     # has_updates gets set whenever this inode
     # appears in the volume scan, and reset whenever we do
@@ -138,32 +274,50 @@ class Inode(Base):
     fs_id = column_property(
         select([Volume.fs_id]).where(Volume.id == vol_id).label('fs_id'))
 
-    def mini_hash_from_file(self, rfile):
-        # A very cheap, very partial hash for quick disambiguation
-        # Won't help with things like zeroed or sparse files.
-        # The mini_hash for those is 0x10000001
-        
-        if self.size > 1.3*4096:
-            rfile.seek(int(self.size * .3))
-        # bitops to make unsigned, for better readability
-        self.mini_hash = adler32(rfile.read(4096)) & 0xffffffff
 
-    def mini_hash_from_file(self, rfile):
-        # A very cheap, very partial hash for quick disambiguation
-        # Won't help with things like zeroed or sparse files.
-        # The mini_hash for those is 0x10000001
-        
-        #if self.size > 1.3*4096:
-        #    rfile.seek(int(self.size * .3))
-        # bitops to make unsigned, for better readability
-        self.mini_hash = adler32(rfile.read(4096)) & 0xffffffff
+# The Inode columns copied into InodeRecord
+RECORD_COLUMNS = (
+    'vol_id', 'ino', 'size', 'mini_hash', 'fiemap_hash', 'transid',
+    'fiemap_transid', 'digest', 'digest_hash', 'digest_transid',
+    'extents', 'extents_transid', 'has_updates')
 
-    def fiemap_hash_from_file(self, rfile):
-        extents = tuple(fiemap.fiemap(rfile.fileno()))
-        self.fiemap_hash = hash(extents)
 
-    def __repr__(self):
-        return 'Inode(ino=%d, volume=%d)' % (self.ino, self.vol_id)
+class InodeRecord(InodeMixin):
+    """
+    A detached copy of an Inode row, used by the dedup pass.
+
+    The volume is passed in rather than loaded through a relationship,
+    and nothing is tracked by a session; changes are written back
+    with bulk statements.
+    """
+
+    __slots__ = RECORD_COLUMNS + (
+        'vol', 'physical_start', 'shared_extents', 'data_ranges')
+
+    def __init__(self, vol, row):
+        self.vol = vol
+        for name in RECORD_COLUMNS:
+            setattr(self, name, row[name])
+        self.physical_start = None
+        self.shared_extents = None
+        self.data_ranges = None
+
+
+class Chunk(Base):
+    # Fixed-size pieces of tracked files, used to deduplicate ranges
+    # of files that aren't identical as a whole.
+    vol_id = Column(Integer, primary_key=True)
+    ino = Column(Integer, primary_key=True)
+    # A multiple of the chunk size
+    offset = Column(Integer, primary_key=True)
+    # The first 64 bits of the content hash
+    digest = Column(Integer, index=True, nullable=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['vol_id', 'ino'], ['Inode.vol_id', 'Inode.ino'],
+            ondelete='CASCADE'),
+        )
 
 
 Volume.inode_count = column_property(
@@ -209,6 +363,48 @@ DedupEvent.inode_count = column_property(
     .label('inode_count'))
 
 
+class DedupRun(Base):
+    # A dedup pass over the volumes of a filesystem
+    id = Column(Integer, primary_key=True)
+    fs_id, fs = FK(Filesystem.id)
+    started = Column(UTCDateTime, index=True, nullable=False)
+    finished = Column(UTCDateTime, nullable=True)
+    # The sum of logModel.DedupEvent.reclaimed_bytes over the run,
+    # an upper bound
+    reclaimed_bytes = Column(Integer, nullable=True)
+    # The counters of tracking.DedupStats, summed over the processes
+    # that worked on the run (see RUN_COUNTERS)
+    mini_hashed = Column(Integer, nullable=False, default=0)
+    sparse = Column(Integer, nullable=False, default=0)
+    mini_hash_passed = Column(Integer, nullable=False, default=0)
+    confirmed = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        dict(
+            sqlite_autoincrement=True))
+
+
+RUN_COUNTERS = ('mini_hashed', 'sparse', 'mini_hash_passed', 'confirmed')
+
+
+class VolumeUsage(Base):
+    # Space used by a volume at the start and at the end of a run,
+    # from the qgroup of the volume.  Only when quotas are enabled.
+    id = Column(Integer, primary_key=True)
+    run_id, run = FK(DedupRun.id, backref='usages')
+    vol_id, vol = FK(Volume.id)
+    referenced_before = Column(Integer, nullable=False)
+    exclusive_before = Column(Integer, nullable=False)
+    referenced_after = Column(Integer, nullable=True)
+    exclusive_after = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint(
+            'run_id', 'vol_id'),
+        dict(
+            sqlite_autoincrement=True))
+
+
 def comm_mappings(vol_ids):
     # XXX Is there a way to factor the vol_id.in_ as a subquery?
     # or to have a Comm3 -> Comm2 -> Comm1 relationship?
@@ -320,3 +516,59 @@ def comm_mappings(vol_ids):
 
 META = Base.metadata
 
+# Bumped whenever columns are added to existing tables, see upgrade_schema.
+# Kept in the user_version of the SQLite databases.
+SCHEMA_VERSION = 1
+
+
+class SchemaError(Exception):
+    pass
+
+
+def added_column_ddl(table, column, dialect):
+    ddl = '%s %s' % (column.name, column.type.compile(dialect=dialect))
+    if not column.nullable:
+        # SQLite needs a default to fill the rows already there
+        if column.default is None or not column.default.is_scalar:
+            raise SchemaError(
+                'Can\'t add column %s.%s to an existing database, '
+                'the database needs to be recreated' % (
+                    table.name, column.name))
+        ddl += ' NOT NULL DEFAULT %d' % column.default.arg
+    return ddl
+
+
+def upgrade_schema(engine, metadata):
+    """
+    Adds the columns that tables created by older versions lack.
+
+    Call after metadata.create_all, which only creates missing tables.
+    Databases created before the schema version was kept have
+    version 0.
+    """
+
+    conn = engine.connect()
+    try:
+        if conn.execute('PRAGMA user_version').scalar() >= SCHEMA_VERSION:
+            return
+        trans = conn.begin()
+        for table in metadata.sorted_tables:
+            present = set(
+                row[1] for row in
+                conn.execute('PRAGMA table_info("%s")' % table.name))
+            added = set()
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                conn.execute('ALTER TABLE "%s" ADD COLUMN %s' % (
+                    table.name, added_column_ddl(
+                        table, column, engine.dialect)))
+                added.add(column.name)
+            for index in table.indexes:
+                if any(column.name in added for column in index.columns):
+                    index.create(conn)
+        conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        trans.commit()
+    finally:
+        conn.close()
+
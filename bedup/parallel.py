@@ -0,0 +1,214 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import Queue
+
+from .chunks import dedup_chunks
+from .model import Volume
+from .tracking import (
+    prepare_scan, begin_scan, finish_scan, search_updated_inodes,
+    record_updated_inodes, refresh_seen_inodes, dedup_tracked2,
+    get_path_filter, start_run, finish_run)
+
+# Workers inherit the volume fds, which requires fork.
+try:
+    mp = multiprocessing.get_context('fork')
+except AttributeError:
+    # Python 2, always forks
+    mp = multiprocessing
+
+# Seconds between checks on running workers
+JOIN_INTERVAL = .5
+
+
+class WorkerError(Exception):
+    pass
+
+
+def scan_worker(outq, vol_id, scan_args):
+    # Runs the tree search and sends the results back, without
+    # touching the database.
+    try:
+        for batch in search_updated_inodes(*scan_args):
+            outq.put((vol_id, batch, None))
+    except Exception as e:
+        outq.put((vol_id, None, e))
+    else:
+        outq.put((vol_id, None, None))
+
+
+def track_updated_files_parallel(sess, volumes, tt, jobs, index_dir=None):
+    """
+    Scans volumes in worker processes, up to jobs at a time.
+
+    The workers only run the tree searches.  Inode records come back
+    in batches and are written to the database from this process,
+    which is the only writer.  Volumes whose worker died are left
+    for the next scan, and reported with a WorkerError at the end.
+    """
+
+    results = mp.Queue(jobs * 4)
+    pending = []
+    index_updates = {}
+    for vol in volumes:
+        min_generation, top_generation, index_updates[vol.id] = (
+            prepare_scan(sess, vol, tt, index_dir))
+        if begin_scan(sess, vol, tt, min_generation, top_generation):
+            scan_args = (
+                vol.fd, min_generation, vol.size_cutoff,
+                vol.last_tracked_size_cutoff, vol.last_tracked_generation,
+                get_path_filter(vol))
+            pending.append((vol, top_generation, scan_args))
+
+    nr_scans = len(pending)
+    running = {}
+    # Workers seen to have exited before the last wait on the queue
+    exited = set()
+    failed = 0
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                vol, top_generation, scan_args = pending.pop(0)
+                proc = mp.Process(
+                    target=scan_worker, args=(results, vol.id, scan_args))
+                proc.start()
+                running[vol.id] = (vol, top_generation, proc)
+
+            try:
+                vol_id, batch, error = results.get(timeout=JOIN_INTERVAL)
+            except Queue.Empty:
+                # A worker flushes what it sent before exiting; if it
+                # had exited before a wait that found nothing, it died
+                # without sending its end of scan (killed, or crashed).
+                for vol_id in exited:
+                    vol, top_generation, proc = running.pop(vol_id)
+                    proc.join()
+                    tt.notify(
+                        'Scan of volume %r failed (exit code %r)' % (
+                            vol.desc, proc.exitcode))
+                    failed += 1
+                exited = set(
+                    vol_id for vol_id, (vol, top_generation, proc)
+                    in running.iteritems() if not proc.is_alive())
+                continue
+            vol, top_generation, proc = running[vol_id]
+            index_update = index_updates[vol_id]
+            if batch is not None:
+                items, seen = batch
+                record_updated_inodes(sess, vol, tt, items)
+                refresh_seen_inodes(sess, vol, items, seen)
+                if index_update is not None:
+                    index_update.add(seen)
+                continue
+            proc.join()
+            del running[vol_id]
+            exited.discard(vol_id)
+            if error is not None:
+                raise error
+            finish_scan(sess, vol, top_generation, index_update)
+    finally:
+        for vol, top_generation, proc in running.itervalues():
+            proc.terminate()
+            proc.join()
+    if failed:
+        # What the failed workers sent is kept; their volumes still
+        # have the last tracked generation of the previous scan.
+        sess.commit()
+        raise WorkerError(
+            '%d of %d scan workers failed' % (failed, nr_scans))
+
+
+def run_in_processes(targets, jobs):
+    """Runs callables in forked processes, up to jobs at a time."""
+
+    pending = list(targets)
+    running = []
+    failed = 0
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                proc = mp.Process(target=pending.pop(0))
+                proc.start()
+                running.append(proc)
+            running[0].join(JOIN_INTERVAL)
+            finished = [worker for worker in running if not worker.is_alive()]
+            for worker in finished:
+                running.remove(worker)
+                if worker.exitcode != 0:
+                    failed += 1
+    finally:
+        for proc in running:
+            proc.join()
+    if failed:
+        raise WorkerError('%d of %d workers failed' % (failed, len(targets)))
+
+
+def attach_volumes(sess, volset):
+    # Gets the volumes of a volume set in another session,
+    # along with the fds opened by get_vol.
+    rv = []
+    for vol in volset:
+        vol2 = sess.query(Volume).get(vol.id)
+        vol2.fd = vol.fd
+        vol2.st_dev = vol.st_dev
+        vol2.desc = vol.desc
+        rv.append(vol2)
+    return rv
+
+
+def dedup_volset(make_session, volset, tt, opts, jobs_per_fs, partial):
+    def partition_worker(index):
+        def run():
+            sess = make_session()
+            dedup_tracked2(
+                sess, attach_volumes(sess, volset), tt, opts,
+                partition=(index, jobs_per_fs), run_id=run_id)
+        return run
+
+    sess = make_session()
+    volset = attach_volumes(sess, volset)
+    run = start_run(sess, volset)
+    run_id = run.id
+    if jobs_per_fs > 1:
+        run_in_processes(
+            [partition_worker(index) for index in xrange(jobs_per_fs)],
+            jobs_per_fs)
+    else:
+        dedup_tracked2(sess, volset, tt, opts, run_id=run_id)
+    if partial:
+        dedup_chunks(sess, volset, tt, opts)
+    finish_run(sess, run, volset, tt, opts)
+
+
+def dedup_parallel(
+    make_session, volsets, tt, opts, jobs, jobs_per_fs, partial,
+):
+    """
+    Deduplicates the volume sets of several filesystems concurrently.
+
+    Up to jobs filesystems are handled at a time, each by jobs_per_fs
+    processes that split its size groups between them.
+    Each process uses its own database session, from make_session.
+    """
+
+    def volset_worker(volset):
+        return lambda: dedup_volset(
+            make_session, volset, tt, opts, jobs_per_fs, partial)
+
+    run_in_processes([volset_worker(volset) for volset in volsets], jobs)
@@ -0,0 +1,125 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+import sys
+
+from .btrfs import lookup_ino_path_one, BTRFS_FIRST_FREE_OBJECTID
+
+FS_ENCODING = sys.getfilesystemencoding()
+
+PATH_FILTER_KINDS = ('include', 'exclude')
+
+
+def fs_bytes(text):
+    # Paths from the tree search are bytes
+    if isinstance(text, bytes):
+        return text
+    return text.encode(FS_ENCODING)
+
+
+def matches(path, patterns):
+    for pattern in patterns:
+        if pattern.endswith(b'/'):
+            # A prefix, everything under that directory
+            if (path + b'/').startswith(pattern):
+                return True
+        elif fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
+
+class PathFilter(object):
+    """
+    Include and exclude rules for the files of a volume.
+
+    Patterns are globs matched against paths relative to the volume,
+    starting with a /; a pattern ending with / matches everything
+    under that directory.  A file is left out if its path or the path
+    of one of its directories matches an exclude rule; when there are
+    include rules, one of them has to match as well.
+
+    What the rules say about a directory and its parents is cached by
+    directory inode, so that the files of an excluded directory are
+    left out without looking up their paths.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = [fs_bytes(pattern) for pattern in include]
+        self.exclude = [fs_bytes(pattern) for pattern in exclude]
+        # directory inode -> (excluded, included), or None
+        self.dir_states = {}
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude)
+
+    def _add(self, state, path):
+        excluded, included = state
+        return (
+            excluded or matches(path, self.exclude),
+            included or matches(path, self.include))
+
+    def path_state(self, path):
+        # path is relative to the volume, without the leading /
+        state = (False, False)
+        prefix = b''
+        for name in path.split(b'/') if path else []:
+            prefix += b'/' + name
+            state = self._add(state, prefix)
+        return state
+
+    def dir_state(self, volume_fd, dir_ino):
+        # Returns None if the directory can't be found;
+        # that is cached as well
+        if dir_ino in self.dir_states:
+            return self.dir_states[dir_ino]
+        if dir_ino == BTRFS_FIRST_FREE_OBJECTID:
+            # The root of the volume
+            path = b''
+        else:
+            try:
+                path = lookup_ino_path_one(volume_fd, dir_ino)
+            except IOError:
+                self.dir_states[dir_ino] = None
+                return
+        state = self.dir_states[dir_ino] = self.path_state(path)
+        return state
+
+    def dir_excluded(self, volume_fd, dir_ino):
+        if dir_ino is None:
+            return False
+        state = self.dir_state(volume_fd, dir_ino)
+        return state is not None and state[0]
+
+    def selected(self, volume_fd, dir_ino, path):
+        """
+        Tells whether a file is kept.
+
+        dir_ino is the inode of a directory the file is in, or None;
+        path is the path of the file, relative to the volume.
+        """
+
+        state = None
+        if dir_ino is not None:
+            state = self.dir_state(volume_fd, dir_ino)
+        if state is None:
+            state = self.path_state(path)
+        else:
+            state = self._add(state, b'/' + path)
+        excluded, included = state
+        return not excluded and (included or not self.include)
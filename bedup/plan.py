@@ -0,0 +1,258 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import json
+import os
+
+from contextlib import closing
+
+from .btrfs import (
+    get_fsid, get_root_id, get_inode_transid, lookup_ino_path_one)
+from .datetime import system_now
+from .eventlog import EventLog
+from .model import Inode, InodeRecord, Volume, RECORD_COLUMNS
+from .tracking import (
+    any_writable, get_vol, load_records, dedup_members, dedup_window,
+    set_ofile_limits, InodeChanges, SCHEDULE_WINDOW, SQL_BATCH)
+
+# Dedup plans.
+# dedup-vol --plan does the reading (mini-hashes and full hashes)
+# and writes the duplicate sets it finds to a file, one JSON object
+# per line, without freezing or cloning anything.  dedup-apply checks
+# that the files haven't changed since, using the transids of their
+# inode items, and clones them.  Files are still compared byte for
+# byte before cloning; the clone ioctl doesn't check contents.
+#
+# A plan made on read-only snapshots can be applied to the volumes
+# they were taken from: a file keeps its inode number in snapshots,
+# and its transid until it is written to.
+
+PLAN_FORMAT = 'bedup-plan'
+PLAN_VERSION = 1
+
+
+class PlanError(ValueError):
+    pass
+
+
+class PlanWriter(object):
+    def __init__(self, ofile):
+        self.ofile = ofile
+        self.entries = 0
+        self._write(dict(
+            format=PLAN_FORMAT, version=PLAN_VERSION,
+            created=system_now().isoformat()))
+
+    def _write(self, obj):
+        self.ofile.write(json.dumps(obj, separators=(',', ':')) + '\n')
+
+    def add(self, members, hash_name):
+        # members are the (inode, path, fresh) tuples of a hash class
+        first = members[0][0]
+        self._write(dict(
+            fs=first.vol.fs.uuid, size=first.size,
+            hash=hash_name, digest=first.digest,
+            members=[
+                [inode.vol_id, inode.vol.root_id, inode.ino, inode.transid,
+                 fresh]
+                for inode, path, fresh in members]))
+        self.entries += 1
+
+
+def read_plan(ifile):
+    header = json.loads(ifile.readline() or 'null')
+    if not isinstance(header, dict) or header.get('format') != PLAN_FORMAT:
+        raise PlanError('Not a dedup plan')
+    if header['version'] != PLAN_VERSION:
+        raise PlanError('Unsupported plan version %r' % header['version'])
+    for line in ifile:
+        yield json.loads(line)
+
+
+def plan_volume(sess, tt, vol_id, root_id, fs_uuid):
+    # Opens a volume of the plan, from its last known mountpoint
+    vol = sess.query(Volume).get(vol_id)
+    if (vol is None or vol.root_id != root_id
+            or vol.fs.uuid != fs_uuid or vol.last_known_mountpoint is None):
+        tt.notify('Volume %d of the plan is unknown, skipping' % vol_id)
+        return
+    if hasattr(vol, 'fd'):
+        # Already opened with get_vol, see map_volumes
+        return vol
+    volpath = vol.last_known_mountpoint
+    try:
+        volume_fd = os.open(volpath, os.O_DIRECTORY)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        volume_fd = None
+    if volume_fd is None or (
+        str(get_fsid(volume_fd)) != fs_uuid
+        or get_root_id(volume_fd) != root_id
+    ):
+        if volume_fd is not None:
+            os.close(volume_fd)
+        tt.notify('Volume %d of the plan is not mounted at %r, skipping' % (
+            vol_id, volpath))
+        return
+    # Like get_vol
+    vol.fd = volume_fd
+    vol.st_dev = os.fstat(volume_fd).st_dev
+    vol.desc = volpath
+    return vol
+
+
+def load_members(sess, vols_by_id, entry):
+    # Gets the records of the plan entry's members, by (vol_id, ino)
+    inos_by_vol = collections.defaultdict(list)
+    for vol_id, root_id, ino, transid, fresh in entry['members']:
+        if vols_by_id.get(vol_id) is not None:
+            inos_by_vol[vol_id].append(ino)
+    records = {}
+    for vol_id, inos in inos_by_vol.iteritems():
+        for start in xrange(0, len(inos), SQL_BATCH):
+            for record in load_records(sess, vols_by_id, [
+                Inode.vol_id == vol_id,
+                Inode.ino.in_(inos[start:start + SQL_BATCH]),
+            ]):
+                records[(record.vol_id, record.ino)] = record
+    return records
+
+
+def still_valid(record, entry, transid):
+    # The scan, and the filesystem, still see the inode as it was
+    # when the plan was made.  The plan pass doesn't save digests
+    # (see tracking.save_digest), the plan has them.
+    return (
+        record.transid == transid
+        and record.size == entry['size']
+        and get_inode_transid(record.vol.fd, record.ino) == transid)
+
+
+def map_volumes(sess, pairs):
+    """
+    Opens the (snapshot, target) volume path pairs of dedup-apply.
+
+    Returns a dict from the ids of the snapshots to the target volumes.
+    """
+
+    targets = {}
+    for snapshot_path, target_path in pairs:
+        snapshot = get_vol(sess, snapshot_path, None)
+        target = get_vol(sess, target_path, None)
+        if target.fs != snapshot.fs:
+            raise PlanError('%r and %r are on different filesystems' % (
+                snapshot_path, target_path))
+        if target.readonly:
+            raise PlanError('%r is read-only' % target_path)
+        targets[snapshot.id] = target
+    sess.commit()
+    return targets
+
+
+def mapped_member(target, record, transid):
+    # The file of a target volume with the inode number of a snapshot
+    # member, if it hasn't been written to since the snapshot was taken.
+    if get_inode_transid(target.fd, record.ino) != transid:
+        return
+    try:
+        path = lookup_ino_path_one(target.fd, record.ino)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return
+    mapped = InodeRecord(target, dict(
+        (name, getattr(record, name)) for name in RECORD_COLUMNS))
+    mapped.vol_id = target.id
+    # Whatever the target's records say, the digest isn't saved
+    return mapped, path, False
+
+
+def apply_plan(sess, plan_path, tt, opts, targets=None):
+    """
+    Clones the duplicate sets of a plan written by dedup-vol --plan.
+
+    Members that changed since the plan was made are left out.
+    targets maps the ids of read-only snapshots to writable volumes
+    (see map_volumes); members in those snapshots are also cloned
+    into their unchanged counterparts in the target.
+    """
+
+    if targets is None:
+        targets = {}
+
+    # First pass, to open the volumes
+    vols_by_id = {}
+    with open(plan_path) as ifile:
+        for entry in read_plan(ifile):
+            for vol_id, root_id, ino, transid, fresh in entry['members']:
+                if vol_id not in vols_by_id:
+                    vols_by_id[vol_id] = plan_volume(
+                        sess, tt, vol_id, root_id, entry['fs'])
+
+    set_ofile_limits(len(vols_by_id) + len(targets))
+    window = dedup_window()
+    changes = InodeChanges()
+    entries = applied = 0
+    with closing(EventLog(opts.make_log_session)) as log:
+        with open(plan_path) as ifile:
+            for entry in read_plan(ifile):
+                entries += 1
+                records = load_members(sess, vols_by_id, entry)
+                members = []
+                for vol_id, root_id, ino, transid, fresh in (
+                    entry['members']
+                ):
+                    record = records.get((vol_id, ino))
+                    if record is None or not still_valid(
+                        record, entry, transid
+                    ):
+                        continue
+                    try:
+                        path = lookup_ino_path_one(record.vol.fd, ino)
+                    except IOError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue
+                    # Saved once the member is cloned
+                    fresh = not record.has_current_digest(entry['hash'])
+                    record.digest = entry['digest']
+                    record.digest_hash = entry['hash']
+                    record.digest_transid = transid
+                    members.append((record, path, fresh))
+                    if vol_id in targets:
+                        mapped = mapped_member(
+                            targets[vol_id], record, transid)
+                        if mapped is not None:
+                            members.append(mapped)
+
+                if len(members) < 2 or not any_writable(
+                    record for record, path, fresh in members
+                ):
+                    continue
+                applied += 1
+                dedup_members(tt, members, opts, changes, log, window)
+                if applied % SCHEDULE_WINDOW == 0:
+                    changes.flush(sess)
+                    sess.commit()
+    changes.flush(sess)
+    changes.flush_skipped(sess)
+    sess.commit()
+    tt.notify('Applied %d of %d plan entries' % (applied, entries))
@@ -0,0 +1,211 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import collections
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy.sql import func
+
+from .datetime import system_now
+from .logModel import EventAggregate
+from .model import Filesystem, Volume, DedupRun, RUN_COUNTERS
+
+# Dedup statistics.
+# EventAggregate holds running totals of the dedup events, per time
+# bucket, filesystem, volume and size class.  They are updated along
+# with the events, so reports don't depend on the length of the history.
+
+PERIODS = ('day', 'week')
+
+AGGREGATE_SUMS = ('event_count', 'inode_count', 'space_gain', 'reclaimed_bytes')
+
+
+def mini_hash_precision(mini_hash_passed, confirmed):
+    # How often a mini-hash match turns out to be a real duplicate,
+    # see tracking.DedupStats.  When this is low, more samples would
+    # save full reads.
+    if not mini_hash_passed:
+        return 'n/a'
+    return '%.1f%%' % (100. * confirmed / mini_hash_passed)
+
+
+def bucket_start(period, created):
+    # Buckets start at midnight UTC; weeks start on Monday
+    start = created.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'week':
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def size_class(size):
+    # floor(log2(size)); files are grouped by powers of two
+    rv = 0
+    while size > 1:
+        size >>= 1
+        rv += 1
+    return rv
+
+
+def update_aggregates(sess, events):
+    """
+    Adds events to EventAggregate.
+
+    events are (created, fs_id, item_size, reclaimed_bytes, inodes)
+    tuples, see eventlog.EventLog.record.  An event is counted in the
+    volume of its first destination, where the space is reclaimed.
+    """
+
+    deltas = collections.defaultdict(lambda: [0] * len(AGGREGATE_SUMS))
+    for created, fs_id, item_size, reclaimed_bytes, inodes in events:
+        vol_id = inodes[min(1, len(inodes) - 1)][0]
+        for period in PERIODS:
+            delta = deltas[(
+                period, bucket_start(period, created), fs_id, vol_id,
+                size_class(item_size))]
+            delta[0] += 1
+            delta[1] += len(inodes)
+            delta[2] += item_size * (len(inodes) - 1)
+            delta[3] += reclaimed_bytes or 0
+
+    table = EventAggregate.__table__
+    for key, delta in deltas.iteritems():
+        period, start, fs_id, vol_id, cls = key
+        rv = sess.execute(table.update().where(and_(
+            table.c.period == period,
+            table.c.bucket_start == start,
+            table.c.fs_id == fs_id,
+            table.c.vol_id == vol_id,
+            table.c.size_class == cls,
+        )).values(dict(
+            (name, table.c[name] + value)
+            for name, value in zip(AGGREGATE_SUMS, delta))))
+        if rv.rowcount:
+            continue
+        values = dict(zip(AGGREGATE_SUMS, delta))
+        values.update(
+            period=period, bucket_start=start, fs_id=fs_id, vol_id=vol_id,
+            size_class=cls)
+        sess.execute(table.insert().values(values))
+
+
+def query_stats(log_sess, period, days, per_volume=False, per_size=False):
+    """
+    Gets the aggregated dedup statistics of the last days,
+    most recent bucket first.
+
+    Returns a list of dicts; vol_id and size_class are only set
+    when grouping by them.
+    """
+
+    since = bucket_start(
+        period, system_now() - datetime.timedelta(days=days))
+    group_by = [EventAggregate.bucket_start, EventAggregate.fs_id]
+    if per_volume:
+        group_by.append(EventAggregate.vol_id)
+    if per_size:
+        group_by.append(EventAggregate.size_class)
+    sums = [
+        func.sum(getattr(EventAggregate, name)).label(name)
+        for name in AGGREGATE_SUMS]
+    rows = log_sess.query(*(group_by + sums)).filter(
+        EventAggregate.period == period,
+        EventAggregate.bucket_start >= since,
+    ).group_by(*group_by).order_by(
+        EventAggregate.bucket_start.desc(), *group_by[1:])
+
+    rv = []
+    for row in rows:
+        entry = dict(
+            period=period, bucket_start=row.bucket_start.isoformat(),
+            fs_id=row.fs_id)
+        if per_volume:
+            entry['vol_id'] = row.vol_id
+        if per_size:
+            entry['size_class'] = row.size_class
+            entry['min_size'] = 2 ** row.size_class
+        for name in AGGREGATE_SUMS:
+            entry[name] = getattr(row, name)
+        rv.append(entry)
+    return rv
+
+
+def query_runs(sess, days):
+    """
+    Gets the dedup runs started in the last days, most recent first,
+    with the mini-hash counters of each.
+
+    Returns a list of dicts.
+    """
+
+    since = system_now() - datetime.timedelta(days=days)
+    rv = []
+    for run in sess.query(DedupRun).filter(
+        DedupRun.started >= since,
+    ).order_by(DedupRun.started.desc(), DedupRun.id.desc()):
+        entry = dict(
+            run_id=run.id, fs_id=run.fs_id, fs_uuid=run.fs.uuid,
+            started=run.started.isoformat(),
+            finished=(
+                run.finished.isoformat() if run.finished is not None
+                else None),
+            reclaimed_bytes=run.reclaimed_bytes)
+        for name in RUN_COUNTERS:
+            entry[name] = getattr(run, name)
+        rv.append(entry)
+    return rv
+
+
+def describe_stats(sess, entries):
+    # Adds the filesystem uuids and volume paths from the tracking db
+    for entry in entries:
+        fs = sess.query(Filesystem).get(entry['fs_id'])
+        entry['fs_uuid'] = fs.uuid if fs is not None else None
+        if 'vol_id' in entry:
+            vol = sess.query(Volume).get(entry['vol_id'])
+            entry['vol_path'] = (
+                vol.last_known_mountpoint if vol is not None else None)
+    return entries
+
+
+def show_stats(entries, ofile):
+    for entry in entries:
+        where = ['fs %s' % (entry['fs_uuid'] or entry['fs_id'])]
+        if 'vol_id' in entry:
+            where.append('volume %s' % (entry['vol_path'] or entry['vol_id']))
+        if 'size_class' in entry:
+            where.append('files >= %d bytes' % entry['min_size'])
+        ofile.write(
+            '%s %s: %d events, %d files, %d bytes estimated, '
+            'at most %d bytes reclaimed\n' % (
+                entry['bucket_start'][:10], ', '.join(where),
+                entry['event_count'], entry['inode_count'],
+                entry['space_gain'], entry['reclaimed_bytes']))
+
+
+def show_runs(entries, ofile):
+    for entry in entries:
+        precision = mini_hash_precision(
+            entry['mini_hash_passed'], entry['confirmed'])
+        ofile.write(
+            '%s fs %s: %d files sampled, %d sparse files grouped by layout, '
+            '%d read in full, %d duplicates confirmed (%s)\n' % (
+                entry['started'][:19], entry['fs_uuid'],
+                entry['mini_hashed'], entry['sparse'],
+                entry['mini_hash_passed'], entry['confirmed'], precision))
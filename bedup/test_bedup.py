@@ -2,6 +2,7 @@
 import multiprocessing
 import os
 import shutil
+import sqlite3
 import subprocess
 import tempfile
 
@@ -10,15 +11,19 @@ import pytest
 from .__main__ import main
 from .syncfs import syncfs
 from .btrfs import lookup_ino_paths, BTRFS_FIRST_FREE_OBJECTID
+from .fiemap import fiemap, shared_extents_key
 from . import compat  # monkey-patch check_output in py2.6
+from . import tracking
 
 # Placate pyflakes
 db = fs = fsimage = sampledata = vol_fd = None
 
 
 def setup_module():
-    global db, fs, fsimage, sampledata, vol_fd
+    global db, log_db, plan, fs, fsimage, sampledata, vol_fd
     db_fd, db = tempfile.mkstemp(suffix='.sqlite')
+    log_db_fd, log_db = tempfile.mkstemp(suffix='.sqlite')
+    plan_fd, plan = tempfile.mkstemp(suffix='.plan')
     fsimage_fd, fsimage = tempfile.mkstemp(suffix='.btrfs')
     sampledata_fd, sampledata = tempfile.mkstemp(suffix='.sample')
     fs = tempfile.mkdtemp(suffix='.mnt')
@@ -63,7 +68,7 @@ def boxed_call(argv, expected_rv=None):
     parent_conn, child_conn = multiprocessing.Pipe()
     argv = list(argv)
     if argv[0] not in 'dedup-files find-new'.split():
-        argv[1:1] = ['--db-path', db]
+        argv[1:1] = ['--db-path', db, '--log-db-path', log_db]
     argv[0:0] = ['__main__']
     proc = multiprocessing.Process(target=subp_main, args=(child_conn, argv))
     proc.start()
@@ -87,6 +92,23 @@ def test_functional():
     boxed_call('forget-vol --'.split() + [fs])
     boxed_call('scan-vol --size-cutoff=65536 --'.split() + [fs, fs])
     boxed_call('dedup-vol --'.split() + [fs])
+    boxed_call(
+        'dedup-vol --max-read-rate=4194304 --max-read-iops=512 --'.split()
+        + [fs])
+    boxed_call('analyze --sample-fraction=0.5 --seed=1 --'.split() + [fs])
+    boxed_call('dedup-vol --mini-hash-samples=1 --'.split() + [fs])
+    boxed_call('dedup-vol --hash=auto --'.split() + [fs])
+    boxed_call('dedup-vol --settle-time=3600 --'.split() + [fs])
+    boxed_call('dedup-vol --partial --chunk-size=65536 --'.split() + [fs])
+    boxed_call('dedup-vol --jobs=2 --jobs-per-fs=2 --'.split() + [fs, fs])
+    boxed_call('dedup-vol --plan'.split() + [plan, '--', fs])
+    boxed_call(['dedup-apply', plan])
+    boxed_call(
+        'scan-vol --subvols --exclude-subvol=/nothing --'.split() + [fs])
+    boxed_call(
+        'scan-vol --exclude-path=/nothing/ --exclude-path=*.tmp --'.split()
+        + [fs])
+    boxed_call('scan-vol --clear-path-filters --'.split() + [fs])
     boxed_call(
         'dedup-files --defragment --'.split() +
         [fs + '/one.sample', fs + '/two.sample'])
@@ -101,6 +123,84 @@ def test_functional():
     assert stat0 == stat1
     boxed_call('find-new --'.split() + [fs])
     boxed_call('show-vols'.split())
+    boxed_call('stats --period=week --per-volume --per-size --json'.split())
+    boxed_call('stats --runs'.split())
+
+
+def tracked_inodes():
+    conn = sqlite3.connect(db)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM Inode').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_size_cutoff_from_index(monkeypatch):
+    boxed_call('forget-vol --'.split() + [fs])
+    # The samples are below that cutoff, the index gets them
+    boxed_call('scan-vol --size-cutoff=16777216 --'.split() + [fs])
+    assert tracked_inodes() == 0
+
+    scan_range = tracking.scan_range
+
+    def scan_range_from_index(vol):
+        min_generation, top_generation = scan_range(vol)
+        assert min_generation > 0, 'Rescanned from generation 0'
+        return min_generation, top_generation
+    # Also seen by the forked boxed_call
+    monkeypatch.setattr(tracking, 'scan_range', scan_range_from_index)
+    boxed_call('scan-vol --size-cutoff=65536 --'.split() + [fs])
+    assert tracked_inodes() == 2
+
+
+def shared_layout(fname):
+    with open(fname) as afile:
+        return shared_extents_key(tuple(fiemap(afile.fileno())))
+
+
+def test_plan_then_dedup():
+    # A plan that doesn't get applied mustn't keep the next pass
+    # from deduplicating the files it lists.
+    three = os.path.join(fs, 'three.sample')
+    four = os.path.join(fs, 'four.sample')
+    with open(sampledata, 'rb') as ifile:
+        data = ifile.read()
+    # Written out rather than copied, copies may share extents
+    for fname in (three, four):
+        with open(fname, 'wb') as ofile:
+            ofile.write(data)
+    syncfs(vol_fd)
+    boxed_call('dedup-vol --plan'.split() + [plan, '--', fs])
+    assert shared_layout(three) is None
+    boxed_call('dedup-vol --'.split() + [fs])
+    assert shared_layout(three) is not None
+    assert shared_layout(three) == shared_layout(four)
+
+
+def test_plan_on_snapshot():
+    # Planned on a read-only snapshot, applied to the live volume
+    five = os.path.join(fs, 'five.sample')
+    six = os.path.join(fs, 'six.sample')
+    snap = os.path.join(fs, 'snap')
+    with open(sampledata, 'rb') as ifile:
+        data = ifile.read()
+    for fname in (five, six):
+        with open(fname, 'wb') as ofile:
+            ofile.write(data)
+    syncfs(vol_fd)
+    subprocess.check_call('btrfs subvolume snapshot -r'.split() + [fs, snap])
+    try:
+        boxed_call(
+            'dedup-vol --size-cutoff=65536 --plan'.split()
+            + [plan, '--', snap])
+        # Shared with the snapshot, not with each other
+        assert shared_layout(five) != shared_layout(six)
+        boxed_call(
+            'dedup-apply --map-volume'.split() + [snap, fs, plan])
+    finally:
+        subprocess.check_call('btrfs subvolume delete'.split() + [snap])
+    assert shared_layout(five) is not None
+    assert shared_layout(five) == shared_layout(six)
 
 
 @pytest.mark.xfail
@@ -128,6 +228,9 @@ def teardown_module():
     finally:
         os.unlink(db)
         os.unlink(db + '-journal')
+        shutil.rmtree(db + '.inodes')
+        os.unlink(log_db)
+        os.unlink(plan)
         os.unlink(fsimage)
         os.unlink(sampledata)
         os.rmdir(fs)
@@ -0,0 +1,746 @@
+from __future__ import absolute_import
+import datetime
+import errno
+import io
+import os
+import random
+import time
+
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import func
+
+from . import grouping, parallel, pathfilter, throttle
+from .btrfs import BTRFS_FIRST_FREE_OBJECTID
+from .chunks import (
+    chunk_digests, merge_ranges as merge_chunk_ranges, stale_windows)
+from .datetime import UTC, system_now
+from .extents import (
+    pack_extents, data_ranges, merge_ranges, is_sparse, FILE_EXTENT_PREALLOC)
+from .fiemap import fiemap, data_ranges as fiemap_data_ranges
+from .grouping import SizeGroup, size_groups
+from .hashing import get_provider
+from .inodeindex import (
+    InodeIndex, IndexUpdate, read_index, write_index,
+    INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION)
+from .logModel import LOG, EventAggregate
+from .model import (
+    META, SCHEMA_VERSION, Filesystem, Volume, Inode, DedupRun, SchemaError,
+    upgrade_schema)
+from .pathfilter import PathFilter, matches
+from .stats import (
+    bucket_start, size_class, update_aggregates, query_stats, query_runs,
+    mini_hash_precision)
+from .throttle import TokenBucket, ReadThrottle, read_at
+from .tracking import (
+    DedupOptions, DedupStats, full_digest, sparse_digest, refresh_seen_inodes)
+
+# Tests that need neither root nor a btrfs filesystem
+
+
+def memory_session(metadata):
+    engine = sqlalchemy.engine.create_engine('sqlite://')
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_settled_filters():
+    sess = memory_session(META)
+    vol = Volume(fs=Filesystem(uuid='test'), root_id=5, size_cutoff=0)
+    now = int(time.time())
+    for ino, mtime in ((257, None), (258, now - 10), (259, now - 7200)):
+        sess.add(Inode(
+            vol=vol, ino=ino, size=4096, mtime=mtime, has_updates=True))
+    sess.commit()
+
+    assert DedupOptions().settled_filters() == []
+    settled = DedupOptions(settle_time=3600).settled_filters()
+    assert [
+        inode.ino for inode in sess.query(Inode).filter(*settled)] == [259]
+
+
+def make_index(entries):
+    index = InodeIndex()
+    for entry in entries:
+        index.append(*entry)
+    return index
+
+
+def index_entries(index):
+    return [index.entry(idx) for idx in xrange(len(index))]
+
+
+def test_index_merged():
+    base = make_index([
+        (257, 100, 1, 10), (258, 200, 1, 10), (260, 400, 1, 10),
+        (262, 600, 1, 10)])
+    newer = make_index([
+        (256, 50, 3, 30), (258, 250, 3, 30), (261, 500, 3, 30),
+        (262, 650, 3, 30)])
+    # Removals only apply to the older entries
+    merged = base.merged(newer, set([260, 262]))
+    assert index_entries(merged) == [
+        (256, 50, 3, 30), (257, 100, 1, 10), (258, 250, 3, 30),
+        (261, 500, 3, 30), (262, 650, 3, 30)]
+    assert merged.size_range(100, 500) == [
+        (257, 100, 1, 10), (258, 250, 3, 30)]
+    assert index_entries(base.merged(InodeIndex(), set([258]))) == [
+        (257, 100, 1, 10), (260, 400, 1, 10), (262, 600, 1, 10)]
+
+
+def test_index_update(tmpdir):
+    path = str(tmpdir.join('inodes', 'index'))
+    update = IndexUpdate(path, None)
+    update.add([(258, 200, 1, 10), (300, 300, 1, 10)])
+    assert update.in_order
+    update.add([(257, 100, 2, 20), (258, 250, 2, 20)])
+    assert not update.in_order
+    update.save(2)
+    assert index_entries(read_index(path, 2)) == [
+        (257, 100, 2, 20), (258, 250, 2, 20), (300, 300, 1, 10)]
+
+    update = IndexUpdate(path, read_index(path, 2))
+    update.forget(300)
+    update.add([(259, 150, 3, 30)])
+    update.save(3)
+    assert index_entries(read_index(path, 3)) == [
+        (257, 100, 2, 20), (258, 250, 2, 20), (259, 150, 3, 30)]
+
+
+def write_raw_index(path, header, index):
+    with open(path, 'wb') as ofile:
+        ofile.write(INDEX_HEADER.pack(*header))
+        for column in index.columns():
+            column.tofile(ofile)
+
+
+def test_read_index(tmpdir):
+    path = str(tmpdir.join('index'))
+    assert read_index(path, 5) is None
+
+    index = make_index([(257, 100, 1, 10), (258, 200, 1, 10)])
+    write_index(path, index, 5)
+    assert index_entries(read_index(path, 5)) == index_entries(index)
+    # Not current
+    assert read_index(path, 4) is None
+    assert read_index(path, 6) is None
+
+    itemsize = index.inos.itemsize
+    write_raw_index(
+        path, (INDEX_MAGIC, INDEX_VERSION, itemsize, 5, 2), index)
+    assert index_entries(read_index(path, 5)) == index_entries(index)
+    for header in [
+        (b'notindex', INDEX_VERSION, itemsize, 5, 2),
+        (INDEX_MAGIC, INDEX_VERSION + 1, itemsize, 5, 2),
+        (INDEX_MAGIC, INDEX_VERSION, itemsize // 2, 5, 2),
+        # Truncated
+        (INDEX_MAGIC, INDEX_VERSION, itemsize, 5, 3),
+    ]:
+        write_raw_index(path, header, index)
+        assert read_index(path, 5) is None
+    with open(path, 'wb') as ofile:
+        ofile.write(INDEX_MAGIC)
+    assert read_index(path, 5) is None
+
+
+def test_bucket_start():
+    # A Wednesday
+    created = datetime.datetime(2013, 5, 15, 23, 59, 59, 999, tzinfo=UTC)
+    assert bucket_start('day', created) == datetime.datetime(
+        2013, 5, 15, tzinfo=UTC)
+    assert bucket_start('week', created) == datetime.datetime(
+        2013, 5, 13, tzinfo=UTC)
+    # Sunday and Monday midnight
+    assert bucket_start('week', datetime.datetime(
+        2013, 5, 19, 12, tzinfo=UTC)) == datetime.datetime(
+        2013, 5, 13, tzinfo=UTC)
+    monday = datetime.datetime(2013, 5, 20, tzinfo=UTC)
+    assert bucket_start('day', monday) == monday
+    assert bucket_start('week', monday) == monday
+    assert bucket_start('week', monday).tzinfo is UTC
+
+
+def test_size_class():
+    assert [size_class(size) for size in (0, 1, 2, 3, 4, 4095, 4096)] == [
+        0, 0, 1, 1, 2, 11, 12]
+    assert size_class(2 ** 40 - 1) == 39
+    assert size_class(2 ** 40) == 40
+
+
+def test_update_aggregates():
+    sess = memory_session(LOG)
+    created = datetime.datetime(2013, 5, 15, 12, tzinfo=UTC)
+    # (created, fs_id, item_size, reclaimed_bytes, inodes)
+    update_aggregates(sess, [
+        (created, 1, 8192, 4096, [(1, 257), (2, 258)]),
+        (created, 1, 8192, None, [(1, 259), (2, 260), (2, 261)]),
+    ])
+    sess.commit()
+    update_aggregates(sess, [
+        (created + datetime.timedelta(hours=1), 1, 12288, 8192,
+         [(1, 262), (2, 263)]),
+        # Another day and size class
+        (created + datetime.timedelta(days=1), 1, 4096, 0,
+         [(1, 264), (2, 265)]),
+    ])
+    sess.commit()
+
+    def totals(period, start, cls):
+        agg = sess.query(EventAggregate).filter_by(
+            period=period, bucket_start=start, fs_id=1, vol_id=2,
+            size_class=cls).one()
+        return (
+            agg.event_count, agg.inode_count, agg.space_gain,
+            agg.reclaimed_bytes)
+
+    day = datetime.datetime(2013, 5, 15, tzinfo=UTC)
+    week = datetime.datetime(2013, 5, 13, tzinfo=UTC)
+    assert totals('day', day, 13) == (3, 7, 8192 + 16384 + 12288, 12288)
+    assert totals('week', week, 13) == (3, 7, 8192 + 16384 + 12288, 12288)
+    assert totals('week', week, 12) == (1, 2, 4096, 0)
+    assert sess.query(EventAggregate).count() == 4
+
+
+def test_query_stats():
+    sess = memory_session(LOG)
+    now = system_now()
+    update_aggregates(sess, [
+        (now, 1, 4096, 4096, [(1, 257), (1, 258)]),
+        (now, 1, 65536, 0, [(1, 259), (2, 260)]),
+        (now - datetime.timedelta(days=2), 1, 4096, 0, [(1, 261), (1, 262)]),
+        (now - datetime.timedelta(days=30), 1, 4096, 0,
+         [(1, 263), (1, 264)]),
+    ])
+    sess.commit()
+
+    entries = query_stats(sess, 'day', 7)
+    assert [entry['event_count'] for entry in entries] == [2, 1]
+    assert entries[0]['bucket_start'] == bucket_start(
+        'day', now).isoformat()
+    assert entries[0]['space_gain'] == 4096 + 65536
+    assert 'vol_id' not in entries[0]
+    assert len(query_stats(sess, 'day', 1)) == 1
+    assert sum(
+        entry['event_count'] for entry in query_stats(sess, 'week', 60)
+    ) == 4
+
+    entries = query_stats(sess, 'day', 1, per_volume=True, per_size=True)
+    assert [
+        (entry['vol_id'], entry['size_class'], entry['min_size'])
+        for entry in entries] == [(1, 12, 4096), (2, 16, 65536)]
+
+
+def test_merge_ranges():
+    size = 1 << 20
+    assert merge_ranges([], size) == ()
+    # Touching
+    assert merge_ranges(
+        [(0, 4096), (4096, 4096), (16384, 4096)], size) == (
+        (0, 8192), (16384, 4096))
+    # Overlapping, or within the previous range
+    assert merge_ranges(
+        [(0, 8192), (4096, 2048), (6144, 8192)], size) == ((0, 14336),)
+    # Clipped to the size
+    assert merge_ranges(
+        [(0, 4096), (8192, 8192), (20480, 4096)], 10000) == (
+        (0, 4096), (8192, 1808))
+
+
+def test_data_ranges():
+    # (logical, disk_bytenr, offset, num_bytes, compression, type)
+    packed = pack_extents([
+        (0, 1 << 20, 0, 4096, 0, 1),
+        # A hole
+        (4096, 0, 0, 8192, 0, 1),
+        (12288, 2 << 20, 0, 4096, 0, FILE_EXTENT_PREALLOC),
+        (16384, 3 << 20, 4096, 4096, 0, 1),
+        # Past the size
+        (20480, 4 << 20, 0, 8192, 0, 1),
+    ], 24576)
+    assert data_ranges(packed, 24576) == ((0, 4096), (16384, 8192))
+
+
+def test_is_sparse():
+    assert is_sparse((), 8192)
+    assert is_sparse(((0, 4096),), 8192)
+    assert not is_sparse(((0, 4097),), 8192)
+    assert not is_sparse(((0, 2048), (4096, 4096)), 8192)
+
+
+def write_sparse(path, size, chunks):
+    with open(path, 'wb') as ofile:
+        for offset, data in chunks:
+            ofile.seek(offset)
+            ofile.write(data)
+        ofile.truncate(size)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+
+
+def test_sparse_digest(tmpdir):
+    hasher = get_provider('sha1')
+    size = 1 << 20
+    data = os.urandom(4096)
+    paths = [str(tmpdir.join(name)) for name in ('one', 'two', 'zeros')]
+    write_sparse(paths[0], size, [(0, data), (65536, data)])
+    write_sparse(paths[1], size, [(0, data), (65536, data)])
+    # Same contents, with zeros written where the others have a hole
+    write_sparse(
+        paths[2], size, [(0, data), (8192, b'\0' * 4096), (65536, data)])
+
+    sparse = []
+    full = []
+    for path in paths:
+        with open(path, 'rb') as afile:
+            assert fiemap_data_ranges(
+                tuple(fiemap(afile.fileno())), size)[-1] == (65536, 4096)
+            sparse.append(sparse_digest(afile, size, hasher))
+            afile.seek(0)
+            full.append(full_digest(afile, size, hasher))
+            assert sparse_digest(afile, size + 1, hasher) is None
+    assert full[0] == full[1] == full[2]
+    assert sparse[0] == sparse[1]
+    assert sparse[2] != sparse[0]
+
+
+def test_path_patterns():
+    assert matches(b'/a', [b'/a/'])
+    assert matches(b'/a/b', [b'/a/'])
+    assert not matches(b'/ab', [b'/a/'])
+    assert matches(b'/a/b.tmp', [b'/c/', b'*.tmp'])
+    assert not matches(b'/a/b', [])
+
+
+def test_path_filter(monkeypatch):
+    dirs = {300: b'a', 301: b'a/b', 302: b'c'}
+    lookups = []
+
+    def lookup_ino_path_one(volume_fd, ino):
+        lookups.append(ino)
+        if ino not in dirs:
+            raise IOError(errno.ENOENT, 'No such file or directory')
+        return dirs[ino]
+    monkeypatch.setattr(
+        pathfilter, 'lookup_ino_path_one', lookup_ino_path_one)
+    root = BTRFS_FIRST_FREE_OBJECTID
+
+    pf = PathFilter(include=['/a/'])
+    assert pf.selected(None, 301, b'a/b/file')
+    assert pf.selected(None, None, b'a/file')
+    assert not pf.selected(None, 302, b'c/file')
+    assert not pf.selected(None, root, b'file')
+
+    # Directories inherit the exclusions of their parents
+    pf = PathFilter(exclude=['/a'])
+    assert pf.dir_excluded(None, 301)
+    assert not pf.selected(None, 301, b'a/b/file')
+    assert pf.selected(None, 302, b'c/file')
+    assert not pf.dir_excluded(None, root)
+
+    pf = PathFilter(include=['/a/'], exclude=['/a/b', '*.tmp'])
+    assert pf.selected(None, 300, b'a/file')
+    assert pf.selected(None, 300, b'a/bc')
+    assert not pf.selected(None, 300, b'a/file.tmp')
+    assert not pf.selected(None, 301, b'a/b/file')
+    assert pf.dir_state(None, root) == (False, False)
+    assert root not in lookups
+
+    # A directory that can't be found is looked up once,
+    # the file paths are used instead
+    del lookups[:]
+    pf = PathFilter(exclude=['/c/'])
+    assert pf.dir_state(None, 999) is None
+    assert not pf.selected(None, 999, b'c/file')
+    assert pf.selected(None, 999, b'd/file')
+    assert lookups == [999]
+
+
+def grouping_session():
+    sess = memory_session(META)
+    vol = Volume(fs=Filesystem(uuid='test'), root_id=5, size_cutoff=0)
+    rng = random.Random(0)
+    for ino in xrange(257, 757):
+        # Sizes shared by a few files, and some unique ones
+        size = 4096 * rng.randint(1, 50) + rng.choice((0, 0, 0, ino << 20))
+        sess.add(Inode(
+            vol=vol, ino=ino, size=size, has_updates=rng.random() < .3))
+    sess.commit()
+    return sess, vol
+
+
+def baseline_size_groups(sess, updated_only):
+    # Like the GROUP BY query that picked the size groups before
+    query = sess.query(
+        Inode.size, func.count(), func.max(Inode.has_updates),
+    ).group_by(Inode.size).having(func.count() > 1).order_by(
+        Inode.size.desc())
+    return [
+        SizeGroup(size, count) for size, count, has_updates in query
+        if has_updates or not updated_only]
+
+
+def check_size_groups(sess, vol):
+    filters = [Inode.vol_id == vol.id]
+    for updated_only in (True, False):
+        groups = size_groups(sess, filters, updated_only=updated_only)
+        assert groups == baseline_size_groups(sess, updated_only)
+        assert groups
+
+    # Groups whose members all have the same current layout
+    # are already deduplicated
+    size = groups[0].size
+    members = sess.query(Inode).filter_by(size=size).all()
+    for inode in members:
+        inode.transid = inode.fiemap_transid = 1
+        inode.fiemap_hash = 42
+    sess.commit()
+    assert size not in [
+        group.size for group in size_groups(sess, filters, False)]
+    members[0].fiemap_transid = 2
+    sess.commit()
+    assert size in [
+        group.size for group in size_groups(sess, filters, False)]
+
+
+def test_size_groups(monkeypatch):
+    monkeypatch.setattr(grouping, 'numpy', None)
+    check_size_groups(*grouping_session())
+
+
+def test_size_groups_numpy():
+    pytest.importorskip('numpy')
+    check_size_groups(*grouping_session())
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(100, burst=50, clock=clock, sleep=clock.sleep)
+    bucket.take(50)
+    assert clock.sleeps == []
+    # Sleeps until the debt is paid back
+    bucket.take(25)
+    assert clock.sleeps == [.25]
+    # Refills up to the burst
+    clock.now += 10
+    bucket.take(50)
+    assert clock.sleeps == [.25]
+    # Larger than the bucket
+    bucket.take(100)
+    assert clock.sleeps == [.25, 1.]
+    bucket.take(50)
+    assert clock.sleeps == [.25, 1., .5]
+
+    # One second worth of tokens by default
+    clock = FakeClock()
+    bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+    bucket.take(10)
+    bucket.take(5)
+    assert clock.sleeps == [.5]
+
+
+def test_read_throttle(monkeypatch):
+    clock = FakeClock()
+    rt = ReadThrottle(
+        max_rate=1000, max_iops=2, clock=clock, sleep=clock.sleep)
+    rfile = rt.wrap(io.BytesIO(b'x' * 4096))
+    assert rfile.read(500) == b'x' * 500
+    rfile.read(500)
+    assert clock.sleeps == []
+    # Out of iops first
+    rfile.read(250)
+    assert clock.sleeps == [.5]
+    rfile.read(1000)
+    assert clock.sleeps == [.5, .5, .25]
+    assert rfile.tell() == 2250
+
+    rfile = io.BytesIO()
+    assert ReadThrottle().wrap(rfile) is rfile
+
+    # Backs off while the pressure is high, then polls
+    # once per interval
+    pressures = [50., 40., 5., 50.]
+    monkeypatch.setattr(
+        throttle, 'read_io_pressure', lambda: pressures.pop(0))
+    clock = FakeClock()
+    rt = ReadThrottle(max_pressure=10., clock=clock, sleep=clock.sleep)
+    rt.account(4096)
+    assert clock.sleeps == [1., 2.]
+    rt.account(4096)
+    assert pressures == [50.]
+
+
+def test_chunk_digests(tmpdir):
+    hasher = get_provider('sha1')
+    # Larger than chunks.BUFSIZE
+    chunk_size = 128 * 1024
+    data = os.urandom(chunk_size)
+    path = str(tmpdir.join('chunked'))
+    with open(path, 'wb') as ofile:
+        # Zero chunks and the partial chunk at the end are left out
+        for buf in (
+            data, b'\0' * chunk_size, data, data[::-1], data[:100]
+        ):
+            ofile.write(buf)
+    with open(path, 'rb') as rfile:
+        digests = chunk_digests(rfile, hasher, chunk_size)
+    assert [offset for offset, digest in digests] == [
+        0, 2 * chunk_size, 3 * chunk_size]
+    assert digests[0][1] == digests[1][1] != digests[2][1]
+
+    with open(path, 'rb') as rfile:
+        assert chunk_digests(rfile, hasher, 8 * chunk_size) == []
+
+
+def test_merge_chunk_ranges():
+    # (source offset, dest offset) pairs of 4096-byte chunks
+    assert merge_chunk_ranges([
+        (20480, 12288), (8192, 0), (0, 8192), (12288, 4096),
+        (24576, 16384), (32768, 20480),
+    ], 4096) == [
+        # Adjacent on both sides
+        (8192, 0, 8192),
+        # Adjacent on the dest side only
+        (0, 8192, 4096),
+        (20480, 12288, 8192),
+        (32768, 20480, 4096),
+    ]
+    assert merge_chunk_ranges([], 4096) == []
+
+
+def test_stale_windows():
+    sess = memory_session(META)
+    fs = Filesystem(uuid='test')
+    vols = [
+        Volume(fs=fs, root_id=root_id, size_cutoff=0)
+        for root_id in (5, 256)]
+    for vol in vols:
+        for ino in xrange(257, 264):
+            sess.add(Inode(vol=vol, ino=ino, size=ino, has_updates=True))
+    sess.commit()
+
+    seen = []
+    query = sess.query(Inode).filter(Inode.ino != 260)
+    for window in stale_windows(query, 4):
+        assert 0 < len(window) <= 4
+        for inode in window:
+            seen.append((inode.vol_id, inode.ino))
+            # Like a stale record found by dedup_stale_inode
+            if inode.ino == 263:
+                sess.delete(inode)
+        sess.commit()
+    assert seen == [
+        (vol.id, ino)
+        for vol in vols for ino in (257, 258, 259, 261, 262, 263)]
+
+
+def test_run_times():
+    sess = memory_session(META)
+    run = DedupRun(fs=Filesystem(uuid='test'), started=system_now())
+    sess.add(run)
+    sess.commit()
+    sess.expire(run)
+    assert run.started.tzinfo is UTC
+    assert run.finished is None
+
+
+def test_read_at(tmpdir):
+    path = str(tmpdir.join('data'))
+    with open(path, 'wb') as ofile:
+        ofile.write(b'0123456789')
+    clock = FakeClock()
+    rt = ReadThrottle(max_rate=4, clock=clock, sleep=clock.sleep)
+    with open(path, 'rb') as rfile:
+        assert read_at(rfile, 4, 6) == b'6789'
+        assert read_at(rfile, 4, 8) == b'89'
+        assert read_at(rt.wrap(rfile), 8, 1) == b'12345678'
+    assert clock.sleeps == [1.]
+
+
+def test_run_counters():
+    sess = memory_session(META)
+    fs = Filesystem(uuid='test')
+    now = system_now()
+    old = DedupRun(fs=fs, started=now - datetime.timedelta(days=40))
+    run = DedupRun(fs=fs, started=now)
+    sess.add_all([old, run])
+    sess.commit()
+
+    # Like two processes sharing the run
+    for mini_hashed in (10, 5):
+        stats = DedupStats()
+        stats.mini_hashed = mini_hashed
+        stats.mini_hash_passed = 4
+        stats.confirmed = 3
+        stats.add_to_run(sess, run.id)
+        sess.commit()
+
+    entries = query_runs(sess, 30)
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry['run_id'] == run.id
+    assert entry['fs_uuid'] == 'test'
+    assert entry['finished'] is None
+    assert (
+        entry['mini_hashed'], entry['sparse'], entry['mini_hash_passed'],
+        entry['confirmed']) == (15, 0, 8, 6)
+    assert len(query_runs(sess, 60)) == 2
+
+
+def test_mini_hash_precision():
+    assert mini_hash_precision(0, 0) == 'n/a'
+    stats = DedupStats()
+    stats.mini_hash_passed = 8
+    stats.confirmed = 6
+    assert stats.describe().endswith('(75.0%)')
+
+
+def test_refresh_seen_inodes():
+    sess = memory_session(META)
+    vol = Volume(fs=Filesystem(uuid='test'), root_id=5, size_cutoff=0)
+    for ino in (257, 258, 259):
+        sess.add(Inode(
+            vol=vol, ino=ino, size=4096, transid=10, mtime=100,
+            digest='d', digest_hash='sha1', digest_transid=10,
+            has_updates=False))
+    sess.commit()
+
+    # 257 written to in place, 258 unchanged, 259 returned by the decoder
+    items = [(259, 4096, 12, 12, 1, 300, 300, None, None, 'x', None)]
+    seen = [(257, 4096, 11, 200), (258, 4096, 10, 100), (259, 4096, 12, 300)]
+    refresh_seen_inodes(sess, vol, items, seen)
+    sess.commit()
+    sess.expire_all()
+    inodes = dict((inode.ino, inode) for inode in sess.query(Inode))
+    assert (inodes[257].transid, inodes[257].mtime) == (11, 200)
+    assert inodes[257].has_updates
+    assert not inodes[257].has_current_digest('sha1')
+    assert inodes[258].has_current_digest('sha1')
+    assert not inodes[258].has_updates
+    # Left to record_updated_inodes
+    assert inodes[259].transid == 10
+
+
+class FakeVolume(object):
+    def __init__(self, vol_id):
+        self.id = self.fd = vol_id
+        self.desc = 'vol%d' % vol_id
+        self.size_cutoff = 0
+        self.last_tracked_size_cutoff = self.last_tracked_generation = None
+
+
+class FakeSession(object):
+    def commit(self):
+        pass
+
+
+class FakeTermTemplate(object):
+    def notify(self, message):
+        pass
+
+
+def test_scan_worker_death(monkeypatch):
+    def search_updated_inodes(volume_fd, *args):
+        yield [], []
+        if volume_fd == 2:
+            # Killed without sending the end of its scan
+            os._exit(9)
+
+    finished = []
+    monkeypatch.setattr(
+        parallel, 'prepare_scan', lambda *args: (1, 2, None))
+    monkeypatch.setattr(parallel, 'begin_scan', lambda *args: True)
+    monkeypatch.setattr(
+        parallel, 'finish_scan',
+        lambda sess, vol, *args: finished.append(vol.id))
+    monkeypatch.setattr(
+        parallel, 'search_updated_inodes', search_updated_inodes)
+    monkeypatch.setattr(parallel, 'record_updated_inodes', lambda *args: None)
+    monkeypatch.setattr(parallel, 'refresh_seen_inodes', lambda *args: None)
+    monkeypatch.setattr(parallel, 'get_path_filter', lambda vol: None)
+    monkeypatch.setattr(parallel, 'JOIN_INTERVAL', .05)
+
+    with pytest.raises(parallel.WorkerError):
+        parallel.track_updated_files_parallel(
+            FakeSession(), [FakeVolume(vol_id) for vol_id in (1, 2, 3)],
+            FakeTermTemplate(), 2)
+    assert sorted(finished) == [1, 3]
+
+
+# Tables as created before the schema version was kept
+OLD_TABLES = (
+    '''CREATE TABLE "Filesystem" (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        uuid TEXT NOT NULL UNIQUE CHECK (uuid != ''))''',
+    '''CREATE TABLE "Volume" (
+        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        fs_id INTEGER NOT NULL REFERENCES "Filesystem" (id),
+        root_id INTEGER NOT NULL,
+        last_tracked_generation INTEGER NOT NULL,
+        last_tracked_size_cutoff INTEGER,
+        size_cutoff INTEGER NOT NULL,
+        UNIQUE (fs_id, root_id))''',
+    '''CREATE TABLE "Inode" (
+        vol_id INTEGER NOT NULL REFERENCES "Volume" (id),
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mini_hash INTEGER,
+        fiemap_hash INTEGER,
+        has_updates BOOLEAN NOT NULL,
+        PRIMARY KEY (vol_id, ino))''',
+)
+
+
+def test_upgrade_schema():
+    engine = sqlalchemy.engine.create_engine('sqlite://')
+    for ddl in OLD_TABLES:
+        engine.execute(ddl)
+    engine.execute('INSERT INTO "Filesystem" VALUES (1, \'test\')')
+    engine.execute('INSERT INTO "Volume" VALUES (1, 1, 5, 10, 65536, 65536)')
+    engine.execute('INSERT INTO "Inode" VALUES (1, 257, 65536, 1, 2, 1)')
+    META.create_all(engine)
+    upgrade_schema(engine, META)
+    assert engine.execute('PRAGMA user_version').scalar() == SCHEMA_VERSION
+    # Nothing left to do
+    upgrade_schema(engine, META)
+
+    sess = sessionmaker(bind=engine)()
+    vol = sess.query(Volume).one()
+    assert vol.readonly is False
+    inode = sess.query(Inode).one()
+    assert inode.transid is None and inode.digest is None
+    inode.digest = 'd'
+    sess.add(Inode(vol=vol, ino=258, size=65536, has_updates=True))
+    sess.commit()
+    assert sess.query(Inode).filter(Inode.digest == 'd').count() == 1
+    indexes = [
+        row[1] for row in engine.execute('PRAGMA index_list("Inode")')]
+    assert 'ix_Inode_digest' in indexes
+
+
+def test_upgrade_schema_unknown_default():
+    engine = sqlalchemy.engine.create_engine('sqlite://')
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        'Thing', metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True))
+    metadata.create_all(engine)
+    sqlalchemy.Table(
+        'Thing', metadata,
+        sqlalchemy.Column('count', sqlalchemy.Integer, nullable=False),
+        extend_existing=True)
+    with pytest.raises(SchemaError):
+        upgrade_schema(engine, metadata)
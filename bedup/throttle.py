@@ -0,0 +1,189 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+import errno
+import os
+import time
+
+from .time import monotonic_time
+
+# set_idle_priority only helps with CFQ; this is for everything else
+# (deadline, mq-deadline, none, NVMe).
+
+# Pressure stall information, Linux 4.20
+PSI_IO_PATH = '/proc/pressure/io'
+# Seconds between two reads of PSI_IO_PATH
+PSI_POLL_INTERVAL = 1.
+# Longest sleep while waiting for the pressure to go down
+PSI_MAX_BACKOFF = 30.
+
+
+def read_io_pressure():
+    """
+    Gets the share of time (in percent, over the last ten seconds)
+    some tasks were stalled on io.
+
+    Returns None if the kernel doesn't provide the information.
+    """
+
+    try:
+        with open(PSI_IO_PATH) as psi:
+            for line in psi:
+                fields = line.split()
+                if not fields or fields[0] != 'some':
+                    continue
+                for field in fields[1:]:
+                    key, val = field.split('=', 1)
+                    if key == 'avg10':
+                        return float(val)
+    except (IOError, OSError) as e:
+        # EOPNOTSUPP: booted with psi=0
+        if e.errno in (errno.ENOENT, errno.EOPNOTSUPP):
+            return None
+        raise
+
+
+class TokenBucket(object):
+    """A token bucket, refilled at rate tokens per second.
+
+    take() sleeps until the tokens are available.  Requests larger
+    than the bucket are allowed, they leave the bucket in debt.
+    clock and sleep can be replaced for testing.
+    """
+
+    def __init__(
+        self, rate, burst=None, clock=monotonic_time, sleep=time.sleep,
+    ):
+        self.rate = float(rate)
+        if burst is None:
+            # One second worth of tokens
+            burst = self.rate
+        self.burst = burst
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__tokens = burst
+        self.__last = clock()
+
+    def take(self, count):
+        now = self.__clock()
+        self.__tokens = min(
+            self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+        self.__tokens -= count
+        if self.__tokens < 0:
+            self.__sleep(-self.__tokens / self.rate)
+
+
+class ReadThrottle(object):
+    """Limits the bandwidth and the number of reads of file contents.
+
+    Optionally backs off while the io pressure of the system
+    is above max_pressure.  With no limits, this does nothing.
+    """
+
+    def __init__(
+        self, max_rate=None, max_iops=None, max_pressure=None,
+        clock=monotonic_time, sleep=time.sleep,
+    ):
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__byte_bucket = self.__io_bucket = None
+        if max_rate:
+            self.__byte_bucket = TokenBucket(
+                max_rate, clock=clock, sleep=sleep)
+        if max_iops:
+            self.__io_bucket = TokenBucket(
+                max_iops, clock=clock, sleep=sleep)
+        self.__max_pressure = max_pressure
+        self.__next_poll = 0
+
+    @property
+    def enabled(self):
+        return (
+            self.__byte_bucket is not None
+            or self.__io_bucket is not None
+            or self.__max_pressure is not None)
+
+    def account(self, nbytes):
+        """Accounts for one read of nbytes, sleeping if necessary."""
+
+        if self.__io_bucket is not None:
+            self.__io_bucket.take(1)
+        if self.__byte_bucket is not None:
+            self.__byte_bucket.take(nbytes)
+        if self.__max_pressure is not None:
+            self.__wait_for_pressure()
+
+    def __wait_for_pressure(self):
+        if self.__clock() < self.__next_poll:
+            return
+        delay = PSI_POLL_INTERVAL
+        while True:
+            pressure = read_io_pressure()
+            if pressure is None:
+                # Not supported, don't bother polling again
+                self.__max_pressure = None
+                return
+            if pressure <= self.__max_pressure:
+                break
+            self.__sleep(delay)
+            delay = min(2 * delay, PSI_MAX_BACKOFF)
+        self.__next_poll = self.__clock() + PSI_POLL_INTERVAL
+
+    def wrap(self, rfile):
+        """Returns a file object whose reads go through the throttle."""
+
+        if not self.enabled:
+            return rfile
+        return ThrottledFile(rfile, self)
+
+
+class ThrottledFile(object):
+    def __init__(self, rfile, throttle):
+        self.__file = rfile
+        self.__throttle = throttle
+
+    def read(self, size=-1):
+        buf = self.__file.read(size)
+        self.__throttle.account(len(buf))
+        return buf
+
+    def read_at(self, size, offset):
+        buf = read_at(self.__file, size, offset)
+        self.__throttle.account(len(buf))
+        return buf
+
+    def __getattr__(self, name):
+        return getattr(self.__file, name)
+
+
+def read_at(rfile, size, offset):
+    """
+    Reads up to size bytes of a file, starting at offset.
+
+    Uses a single pread where Python has it (3.3 and later),
+    which leaves the file position alone; otherwise seeks.
+    """
+
+    if isinstance(rfile, ThrottledFile):
+        return rfile.read_at(size, offset)
+    if hasattr(os, 'pread'):
+        return os.pread(rfile.fileno(), size, offset)
+    rfile.seek(offset)
+    return rfile.read(size)
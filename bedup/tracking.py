@@ -17,38 +17,72 @@
 # You should have received a copy of the GNU General Public License
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import absolute_import
 import collections
 import errno
 import fcntl
+import fnmatch
 import gc
 import hashlib
 import os
+import Queue
 import re
 import resource
 import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 from contextlib import closing
 from contextlib2 import ExitStack
-from sqlalchemy import and_
+from sqlalchemy import and_, bindparam
 
 from .btrfs import (
     lookup_ino_path_one, get_fsid, get_root_id,
-    get_root_generation, clone_data, defragment,
-    BTRFS_FIRST_FREE_OBJECTID)
+    get_root_generation, get_root_info, clone_data, defragment,
+    volumes_from_root_tree, get_qgroup_usage, BTRFS_FIRST_FREE_OBJECTID,
+    BTRFS_ROOT_SUBVOL_RDONLY, ffi, lib, u64_max)
+from .chunks import DEFAULT_CHUNK_SIZE
 from .datetime import system_now
-from .dedup import ImmutableFDs, cmp_files
+from .eventlog import EventLog, sum_reclaimed_bytes
+from .dedup import ImmutableFDs, cmp_files, cmp_ranges
+from .extents import pack_extents, is_sparse
+from .fiemap import fiemap, data_ranges, exclusive_bytes
+from .grouping import size_groups
+from .inodeindex import IndexUpdate, index_path, read_index
+from .hashing import get_provider, default_provider_name
 from .openat import fopenat, fopenat_rw
+from .pathfilter import PathFilter
+from .stats import mini_hash_precision
+from .syncfs import syncfs
 from .model import (
-    Filesystem, Volume, Inode, comm_mappings, get_or_create,
-    DedupEvent, DedupEventInode, VolumePathHistory)
-from sqlalchemy.sql import func, literal_column
+    Filesystem, Volume, Inode, InodeRecord, comm_mappings, get_or_create,
+    DedupEvent, DedupEventInode, DedupRun, VolumeUsage, VolumePathHistory,
+    VolumePathFilter, RECORD_COLUMNS, RUN_COUNTERS,
+    DEFAULT_MINI_HASH_SAMPLING)
+from .throttle import ReadThrottle
+from sqlalchemy.sql import select
 
 BUFSIZE = 8192
 
 WINDOW_SIZE = 1024
 
+# Number of duplicate candidate sets whose reads get sorted together
+SCHEDULE_WINDOW = 256
+# Upper bound on the destination files opened together
+DEDUP_WINDOW = 256
+# Tree search results queued between scan stages
+PIPELINE_DEPTH = 8
+# Bound on the variables of an IN query; SQLite allows 999
+SQL_BATCH = 500
+# Appended to the hash name for digests of sparse files
+SPARSE_HASH_SUFFIX = '+sparse'
+# An (offset, length) data range, in sparse digests
+RANGE_STRUCT = struct.Struct('<QQ')
+
 FS_ENCODING = sys.getfilesystemencoding()
 
 # 32MiB, initial scan takes about 12', might gain 15837689948,
@@ -61,7 +95,7 @@ DEFAULT_SIZE_CUTOFF = 16 * 1024 ** 2
 DEFAULT_SIZE_CUTOFF = 8 * 1024 ** 2
 
 
-def get_vol(sess, volpath, size_cutoff):
+def get_vol(sess, volpath, size_cutoff, desc=None, record_path=True):
     volpath = os.path.normpath(volpath)
     volume_fd = os.open(volpath, os.O_DIRECTORY)
     fs, fs_created = get_or_create(
@@ -75,9 +109,13 @@ def get_vol(sess, volpath, size_cutoff):
         vol.size_cutoff = size_cutoff
     elif vol_created:
         vol.size_cutoff = DEFAULT_SIZE_CUTOFF
+    # Snapshots can be made read-only or read-write at any time
+    generation, root_flags = get_root_info(volume_fd)
+    vol.readonly = bool(root_flags & BTRFS_ROOT_SUBVOL_RDONLY)
 
-    path_history, ph_created = get_or_create(
-        sess, VolumePathHistory, vol=vol, path=volpath)
+    if record_path:
+        path_history, ph_created = get_or_create(
+            sess, VolumePathHistory, vol=vol, path=volpath)
 
     # If a volume was given multiple times on the command line,
     # keep the first name and fd for it.
@@ -87,10 +125,133 @@ def get_vol(sess, volpath, size_cutoff):
         vol.fd = volume_fd
         vol.st_dev = os.fstat(volume_fd).st_dev
         # Only use the path as a description, it is liable to change.
-        vol.desc = volpath
+        vol.desc = desc or volpath
     return vol
 
 
+def find_top_level_mount(volume_fd):
+    """
+    Finds where the top-level volume of a filesystem is mounted.
+
+    Returns (device, mount point); the mount point is None if the
+    top-level volume isn't mounted.
+    """
+
+    fsid = get_fsid(volume_fd)
+    device = None
+    for dev, mounts in parse_btrfs_mountinfo().iteritems():
+        for volpath, mpoint in mounts:
+            try:
+                mpoint_fd = os.open(mpoint, os.O_DIRECTORY)
+            except OSError:
+                continue
+            try:
+                same_fs = get_fsid(mpoint_fd) == fsid
+            finally:
+                os.close(mpoint_fd)
+            if not same_fs:
+                # All the mounts of a device are of the same filesystem
+                break
+            device = dev
+            if volpath == '/':
+                return device, mpoint
+    return device, None
+
+
+def subvol_selected(subvol_path, include, exclude):
+    # Patterns apply to paths relative to the top-level volume,
+    # starting with a /; the top-level volume itself is /.
+    if include and not any(
+        fnmatch.fnmatchcase(subvol_path, pattern) for pattern in include
+    ):
+        return False
+    return not any(
+        fnmatch.fnmatchcase(subvol_path, pattern) for pattern in exclude)
+
+
+def get_fs_vols(sess, volpath, size_cutoff, include=(), exclude=()):
+    """
+    Gets all the subvolumes of the filesystem volpath is on.
+
+    Subvolumes are opened under an existing mount of the top-level
+    volume, or under a private mount that is detached once the
+    subvolumes are open.
+    """
+
+    volume_fd = os.open(volpath, os.O_DIRECTORY)
+    try:
+        subvol_paths = volumes_from_root_tree(volume_fd).values()
+        device, top_mpoint = find_top_level_mount(volume_fd)
+    finally:
+        os.close(volume_fd)
+
+    private = top_mpoint is None
+    if private:
+        if device is None:
+            raise IOError(errno.ENODEV, 'No device for %r' % volpath)
+        top_mpoint = tempfile.mkdtemp(prefix='bedup-')
+        subprocess.check_call(
+            ['mount', '-t', 'btrfs', '-o', 'subvolid=5', device, top_mpoint])
+
+    vols = []
+    try:
+        for subvol_path in [b''] + sorted(subvol_paths):
+            subvol_path = subvol_path.decode(FS_ENCODING)
+            if not subvol_selected(
+                '/' + subvol_path, include, exclude
+            ):
+                continue
+            path = os.path.join(top_mpoint, subvol_path)
+            if private:
+                # The mount point won't outlive this function
+                vols.append(get_vol(
+                    sess, path, size_cutoff,
+                    desc='%s:/%s' % (device, subvol_path),
+                    record_path=False))
+            else:
+                vols.append(get_vol(sess, path, size_cutoff))
+    finally:
+        if private:
+            # Lazy, the fds we opened keep the mount alive
+            subprocess.check_call(['umount', '-l', top_mpoint])
+            os.rmdir(top_mpoint)
+    return vols
+
+
+def get_path_filter(vol):
+    return PathFilter(
+        include=[
+            rule.pattern for rule in vol.path_filters
+            if rule.kind == 'include'],
+        exclude=[
+            rule.pattern for rule in vol.path_filters
+            if rule.kind == 'exclude'])
+
+
+def set_path_filters(sess, vol, include, exclude):
+    """
+    Replaces the path filter of a volume.
+
+    When the rules change, the next scan starts over from the first
+    generation; files the new rules leave out are forgotten, and files
+    they let in get tracked.
+    """
+
+    rules = set(
+        [('include', pattern) for pattern in include]
+        + [('exclude', pattern) for pattern in exclude])
+    if rules == set((rule.kind, rule.pattern) for rule in vol.path_filters):
+        return
+    for rule in list(vol.path_filters):
+        sess.delete(rule)
+    for kind, pattern in sorted(rules):
+        sess.add(VolumePathFilter(vol=vol, kind=kind, pattern=pattern))
+    # Like lowering the size cutoff, see scan_range
+    vol.last_tracked_size_cutoff = None
+    sess.flush()
+    sess.expire(vol, ['path_filters'])
+
+
 def forget_vol(sess, vol):
     # Forgets Inodes, not logging. Make that configurable?
     sess.query(Inode).filter_by(vol=vol).delete()
@@ -134,6 +295,10 @@ def show_fs(fs, mpoints_by_root_id, initial_indent, indent):
         sys.stdout.write(
             initial_indent + indent +
             '%d inodes tracked\n' % (vol.inode_count, ))
+        for rule in vol.path_filters:
+            sys.stdout.write(
+                initial_indent + indent + 'Path filter: %s %s\n'
+                % (rule.kind, rule.pattern))
 
         if vol.root_id in mpoints_by_root_id:
             for (volpath, mpoint) in mpoints_by_root_id[vol.root_id]:
@@ -200,8 +365,8 @@ def show_vols(sess):
     sess.commit()
 
 
-def track_updated_files(sess, vol, tt):
-    from .btrfs import ffi, u64_max
+def scan_range(vol):
+    """Gets the generations (first, last) the next scan of vol covers."""
 
     top_generation = get_root_generation(vol.fd)
     if (vol.last_tracked_size_cutoff is not None
@@ -209,21 +374,100 @@ def track_updated_files(sess, vol, tt):
         min_generation = vol.last_tracked_generation + 1
     else:
         min_generation = 0
+    return min_generation, top_generation
+
+
+def begin_scan(sess, vol, tt, min_generation, top_generation):
     tt.notify(
         'Scanning volume %r generations from %d to %d, with size cutoff %d'
         % (vol.desc, min_generation, top_generation, vol.size_cutoff))
     if min_generation > top_generation:
         tt.notify('Generation didn\'t change, skipping scan')
         sess.commit()
-        return
+        return False
     tt.format(
         '{elapsed} Updated {desc:counter} items: '
         '{path:truncate-left} {desc}')
+    return True
+
+
+def finish_scan(sess, vol, top_generation, index_update=None):
+    if index_update is not None:
+        # Written first; if the commit fails, the index
+        # won't match and won't be used.
+        index_update.save(top_generation)
+    vol.last_tracked_generation = top_generation
+    vol.last_tracked_size_cutoff = vol.size_cutoff
+    sess.commit()
+
+
+def prepare_scan(sess, vol, tt, index_dir):
+    """
+    Gets the generations (first, last) the next scan of vol covers,
+    and the inode index update (see inodeindex.IndexUpdate) to feed.
+
+    With an index current as of the last scan, a lowered size cutoff
+    is handled by tracking the files between the two cutoffs from the
+    index; the scan goes on from the last tracked generation.  Without
+    index_dir, there is no index.
+    """
+
+    if index_dir is None:
+        return scan_range(vol) + (None,)
+    path = index_path(index_dir, vol)
+    base = read_index(path, vol.last_tracked_generation)
+    index_update = None
+    if base is not None:
+        index_update = IndexUpdate(path, base)
+        if (vol.last_tracked_size_cutoff is not None
+                and vol.last_tracked_size_cutoff > vol.size_cutoff):
+            track_from_index(sess, vol, tt, base, index_update)
+    min_generation, top_generation = scan_range(vol)
+    if min_generation == 0 or vol.last_tracked_generation == 0:
+        # Rebuilt from scratch
+        index_update = IndexUpdate(path, None)
+    return min_generation, top_generation, index_update
+
+
+def track_from_index(sess, vol, tt, index, index_update):
+    entries = index.size_range(vol.size_cutoff, vol.last_tracked_size_cutoff)
+    tt.notify(
+        'Tracking %d files of volume %r between size cutoffs %d and %d '
+        'from the inode index' % (
+            len(entries), vol.desc, vol.size_cutoff,
+            vol.last_tracked_size_cutoff))
+    tt.format('{elapsed} Indexed {desc:counter} items: {path:truncate-left}')
+    path_filter = get_path_filter(vol)
+    for start in xrange(0, len(entries), SQL_BATCH):
+        items = []
+        for item in lookup_inode_paths(vol.fd, [
+            # No layout or ctime, they get filled in by fiemap
+            # and the next scan that sees the inode
+            (ino, size, transid, transid, 0, mtime, None, None, None)
+            for ino, size, transid, mtime in entries[start:start + SQL_BATCH]
+        ], path_filter):
+            error = item[-1]
+            if error is not None and error.errno == errno.ENOENT:
+                # Removed since; the scan doesn't see removals
+                index_update.forget(item[0])
+                continue
+            items.append(item)
+        record_updated_inodes(sess, vol, tt, items)
+    vol.last_tracked_size_cutoff = vol.size_cutoff
+    sess.commit()
+
+
+def search_inode_buffers(volume_fd, min_generation):
+    """
+    Runs the tree search for inode items updated since min_generation.
+
+    Yields (item count, result buffer) pairs; buffers are copies,
+    they can be decoded while the next search runs.
+    """
 
     args = ffi.new('struct btrfs_ioctl_search_args *')
     args_buffer = ffi.buffer(args)
     sk = args.key
-    lib = ffi.verifier.load_library()
 
     # Not a valid objectid that I know.
     # But find-new uses that and it seems to work.
@@ -239,80 +483,371 @@ def track_updated_files(sess, vol, tt):
     sk.max_objectid = u64_max
     sk.max_offset = u64_max
     sk.max_transid = u64_max
-    sk.max_type = lib.BTRFS_INODE_ITEM_KEY
+    # Extent items come after the inode item
+    sk.max_type = lib.BTRFS_EXTENT_DATA_KEY
 
     while True:
         sk.nr_items = 4096
 
         try:
             fcntl.ioctl(
-                vol.fd, lib.BTRFS_IOC_TREE_SEARCH, args_buffer)
+                volume_fd, lib.BTRFS_IOC_TREE_SEARCH, args_buffer)
         except IOError:
             raise
 
         if sk.nr_items == 0:
             break
 
+        yield sk.nr_items, ffi.buffer(args.buf)[:]
+
         offset = 0
         for item_id in xrange(sk.nr_items):
             sh = ffi.cast(
                 'struct btrfs_ioctl_search_header *', args.buf + offset)
             offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+        sk.min_objectid = sh.objectid
+        sk.min_type = sh.type
+        sk.min_offset = sh.offset
+
+        sk.min_offset += 1
+
+
+class InodeDecoder(object):
+    """
+    Gets the regular files worth tracking from tree search buffers.
+
+    The extent items of an inode follow its inode item, possibly in
+    the next buffer; feed() returns the inodes whose items are complete,
+    finish() the last one.  Inodes are
+    (ino, size, transid, outer gen, inner gen, mtime, ctime,
+    parent directory, packed extents) tuples; the parent directory is
+    None when the search didn't return an inode ref, packed extents
+    are None when it didn't return a full layout.
+    """
+
+    def __init__(
+        self, min_generation, size_cutoff,
+        last_tracked_size_cutoff, last_tracked_generation,
+    ):
+        self.min_generation = min_generation
+        self.size_cutoff = size_cutoff
+        self.last_tracked_size_cutoff = last_tracked_size_cutoff
+        self.last_tracked_generation = last_tracked_generation
+        self.__current = None
+        self.__parent = None
+        self.__records = None
+        # (ino, size, transid, mtime) of all the regular files decoded,
+        # for the inode index
+        self.seen = []
+
+    def take_seen(self):
+        rv = self.seen
+        self.seen = []
+        return rv
+
+    def feed(self, nr_items, buf):
+        cbuf = ffi.new('char[]', buf)
+        rv = []
+        offset = 0
+        for item_id in xrange(nr_items):
+            sh = ffi.cast(
+                'struct btrfs_ioctl_search_header *', cbuf + offset)
+            offset += (
+                ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len)
+
+            if (self.__current is not None
+                    and sh.objectid != self.__current[0]):
+                rv.append(self.finish())
 
             # We can't prevent the search from grabbing irrelevant types
             if sh.type == lib.BTRFS_INODE_ITEM_KEY:
                 item = ffi.cast(
                     'struct btrfs_inode_item *', sh + 1)
-                inode_gen = lib.btrfs_stack_inode_generation(item)
-                size = lib.btrfs_stack_inode_size(item)
-                mode = lib.btrfs_stack_inode_mode(item)
-                if size < vol.size_cutoff:
-                    continue
-                # XXX Should I use inner or outer gen in these checks?
-                # Inner gen seems to miss updates (due to delalloc?),
-                # whereas outer gen has too many spurious updates.
-                if (vol.last_tracked_size_cutoff
-                    and size >= vol.last_tracked_size_cutoff):
-                    if inode_gen <= vol.last_tracked_generation:
-                        continue
-                else:
-                    if inode_gen < min_generation:
-                        continue
-                if not stat.S_ISREG(mode):
+                self.__inode_item(sh, item)
+            elif (sh.type == lib.BTRFS_INODE_REF_KEY
+                  and self.__current is not None
+                  and self.__parent is None):
+                # The offset is the inode of the directory
+                # holding the first link
+                self.__parent = sh.offset
+            elif (sh.type == lib.BTRFS_EXTENT_DATA_KEY
+                  and self.__current is not None
+                  and self.__records is not None):
+                item = ffi.cast(
+                    'struct btrfs_file_extent_item *', sh + 1)
+                kind = lib.btrfs_stack_file_extent_type(item)
+                if kind == lib.BTRFS_FILE_EXTENT_INLINE:
+                    # Inline data has no disk location
+                    self.__records = None
                     continue
-                ino = sh.objectid
-                inode, inode_created = get_or_create(
-                    sess, Inode, vol=vol, ino=ino)
-                inode.size = size
-                inode.has_updates = True
+                self.__records.append((
+                    sh.offset,
+                    lib.btrfs_stack_file_extent_disk_bytenr(item),
+                    lib.btrfs_stack_file_extent_offset(item),
+                    lib.btrfs_stack_file_extent_num_bytes(item),
+                    lib.btrfs_stack_file_extent_compression(item),
+                    kind))
+        return rv
+
+    def __inode_item(self, sh, item):
+        inode_gen = lib.btrfs_stack_inode_generation(item)
+        transid = lib.btrfs_stack_inode_transid(item)
+        size = lib.btrfs_stack_inode_size(item)
+        mode = lib.btrfs_stack_inode_mode(item)
+        mtime = lib.btrfs_stack_timespec_sec(ffi.addressof(item.mtime))
+        ctime = lib.btrfs_stack_timespec_sec(ffi.addressof(item.ctime))
+        if stat.S_ISREG(mode):
+            self.seen.append((sh.objectid, size, transid, mtime))
+        if size < self.size_cutoff:
+            return
+        # XXX Should I use inner or outer gen in these checks?
+        # Inner gen seems to miss updates (due to delalloc?),
+        # whereas outer gen has too many spurious updates.
+        if (self.last_tracked_size_cutoff
+            and size >= self.last_tracked_size_cutoff):
+            if inode_gen <= self.last_tracked_generation:
+                return
+        else:
+            if inode_gen < self.min_generation:
+                return
+        if not stat.S_ISREG(mode):
+            return
+        self.__current = (
+            sh.objectid, size, transid, sh.transid, inode_gen, mtime, ctime)
+        self.__parent = None
+        self.__records = []
+
+    def finish(self):
+        """Returns the inode being decoded, if any."""
+
+        current = self.__current
+        if current is None:
+            return None
+        if self.__records is None:
+            packed = None
+        else:
+            packed = pack_extents(self.__records, current[1])
+        parent = self.__parent
+        self.__current = self.__parent = self.__records = None
+        return current + (parent, packed)
+
+
+def lookup_inode_paths(volume_fd, items, path_filter=None):
+    """
+    Adds the path lookup result to decoded inode items.
+
+    Returns (ino, size, transid, outer gen, inner gen, mtime, ctime,
+    parent directory, packed extents, path, error) tuples; when the
+    path lookup failed, path is None and error is set.  Files left out
+    by path_filter (a pathfilter.PathFilter) have neither.
+    """
+
+    rv = []
+    for item in items:
+        if path_filter and path_filter.dir_excluded(volume_fd, item[7]):
+            # No need for the path
+            rv.append(item + (None, None))
+            continue
+        try:
+            path = lookup_ino_path_one(volume_fd, item[0])
+        except IOError as e:
+            rv.append(item + (None, e))
+            continue
+        if path_filter and not path_filter.selected(
+            volume_fd, item[7], path
+        ):
+            path = None
+        rv.append(item + (path, None))
+    return rv
+
+
+def search_updated_inodes(
+    volume_fd, min_generation, size_cutoff,
+    last_tracked_size_cutoff, last_tracked_generation, path_filter=None,
+):
+    """
+    Lists the regular files of a volume updated since min_generation.
+
+    Only does ioctls, so that it can run in a worker process.
+    Yields (lookup_inode_paths tuples, inode index entries) pairs,
+    one per search.
+    """
+
+    decoder = InodeDecoder(
+        min_generation, size_cutoff,
+        last_tracked_size_cutoff, last_tracked_generation)
+    for nr_items, buf in search_inode_buffers(volume_fd, min_generation):
+        yield lookup_inode_paths(
+            volume_fd, decoder.feed(nr_items, buf), path_filter
+        ), decoder.take_seen()
+    last = decoder.finish()
+    if last is not None:
+        yield lookup_inode_paths(
+            volume_fd, [last], path_filter), decoder.take_seen()
+
+
+def record_updated_inodes(sess, vol, tt, items):
+    # One query for the inodes we already know, rather than one per item
+    known = {}
+    inos = [item[0] for item in items]
+    for start in xrange(0, len(inos), SQL_BATCH):
+        for inode in sess.query(Inode).filter(
+            Inode.vol_id == vol.id,
+            Inode.ino.in_(inos[start:start + SQL_BATCH]),
+        ):
+            known[inode.ino] = inode
+
+    for (ino, size, transid, outer_gen, inode_gen, mtime, ctime, parent,
+         packed_extents, path, error) in items:
+        inode = known.get(ino)
+        if path is None and error is None:
+            # Left out by the path filter of the volume
+            if inode is not None:
+                sess.delete(inode)
+            continue
+        inode_created = inode is None
+        if inode_created:
+            inode = Inode(vol=vol, ino=ino)
+            sess.add(inode)
+        inode.size = size
+        inode.transid = transid
+        inode.mtime = mtime
+        inode.ctime = ctime
+        inode.has_updates = True
+        inode.extents = packed_extents
+        if packed_extents is not None:
+            inode.extents_transid = transid
+
+        if error is not None:
+            tt.notify(
+                'Error at path lookup of inode %d: %r' % (ino, error))
+            if inode_created:
+                sess.expunge(inode)
+            else:
+                sess.delete(inode)
+            continue
 
-                try:
-                    path = lookup_ino_path_one(vol.fd, ino)
-                except IOError as e:
-                    tt.notify(
-                        'Error at path lookup of inode %d: %r' % (ino, e))
-                    if inode_created:
-                        sess.expunge(inode)
-                    else:
-                        sess.delete(inode)
-                    continue
+        try:
+            path = path.decode(FS_ENCODING)
+        except ValueError:
+            continue
+        tt.update(path=path)
+        tt.update(
+            desc='(ino %d outer gen %d inner gen %d size %d)' % (
+                ino, outer_gen, inode_gen, size))
+
+
+def refresh_seen_inodes(sess, vol, items, seen):
+    """
+    Updates the tracked files that the scan saw but didn't return.
+
+    InodeDecoder leaves out files created before the last scan even
+    when they were written to since; without a new transid, digests
+    cached for their old contents would look current.  seen are
+    InodeDecoder.seen entries, items what the decoder returned.
+    """
+
+    recorded = set(item[0] for item in items)
+    params = [
+        dict(key_ino=ino, new_transid=transid, new_mtime=mtime)
+        for ino, size, transid, mtime in seen if ino not in recorded]
+    if not params:
+        return
+    sess.execute(
+        Inode.__table__.update().where(and_(
+            Inode.vol_id == vol.id,
+            Inode.ino == bindparam('key_ino'),
+            Inode.transid != bindparam('new_transid'),
+        )).values(
+            transid=bindparam('new_transid'),
+            mtime=bindparam('new_mtime'),
+            has_updates=True),
+        params)
 
-                try:
-                    path = path.decode(FS_ENCODING)
-                except ValueError:
-                    continue
-                tt.update(path=path)
-                tt.update(
-                    desc='(ino %d outer gen %d inner gen %d size %d)' % (
-                        ino, sh.transid, inode_gen, size))
-        sk.min_objectid = sh.objectid
-        sk.min_type = sh.type
-        sk.min_offset = sh.offset
 
-        sk.min_offset += 1
-    vol.last_tracked_generation = top_generation
-    vol.last_tracked_size_cutoff = vol.size_cutoff
-    sess.commit()
+class StageError(object):
+    # Carries an exception from a pipeline stage to its consumer
+    def __init__(self, error):
+        self.error = error
+
+
+PIPELINE_END = object()
+
+
+def start_stage(produce, outq):
+    """
+    Runs a pipeline stage in a thread.
+
+    What the produce generator yields goes on outq, followed by
+    PIPELINE_END.  Exceptions are passed on and raised by drain_stage.
+    """
+
+    def run():
+        try:
+            for item in produce():
+                outq.put(item)
+        except Exception as e:
+            outq.put(StageError(e))
+        else:
+            outq.put(PIPELINE_END)
+
+    thread = threading.Thread(target=run)
+    # Don't wait on a stage blocked on a full queue
+    # if the consumer gave up.
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def drain_stage(inq):
+    while True:
+        item = inq.get()
+        if item is PIPELINE_END:
+            return
+        if isinstance(item, StageError):
+            raise item.error
+        yield item
+
+
+def track_updated_files(sess, vol, tt, index_dir=None):
+    min_generation, top_generation, index_update = prepare_scan(
+        sess, vol, tt, index_dir)
+    if not begin_scan(sess, vol, tt, min_generation, top_generation):
+        return
+
+    # The tree search, the decoding and path lookups, and the
+    # database writes run concurrently.  The ioctls release the GIL,
+    # and the queues bound how far ahead the searches get.
+    searched = Queue.Queue(PIPELINE_DEPTH)
+    decoded = Queue.Queue(PIPELINE_DEPTH)
+
+    # Read the volume attributes here, the session isn't thread-safe
+    volume_fd = vol.fd
+    filter_args = (
+        min_generation, vol.size_cutoff,
+        vol.last_tracked_size_cutoff, vol.last_tracked_generation)
+    path_filter = get_path_filter(vol)
+
+    def decode():
+        decoder = InodeDecoder(*filter_args)
+        for nr_items, buf in drain_stage(searched):
+            yield lookup_inode_paths(
+                volume_fd, decoder.feed(nr_items, buf), path_filter
+            ), decoder.take_seen()
+        last = decoder.finish()
+        if last is not None:
+            yield lookup_inode_paths(
+                volume_fd, [last], path_filter), decoder.take_seen()
+
+    start_stage(
+        lambda: search_inode_buffers(volume_fd, min_generation), searched)
+    start_stage(decode, decoded)
+    for items, seen in drain_stage(decoded):
+        record_updated_inodes(sess, vol, tt, items)
+        refresh_seen_inodes(sess, vol, items, seen)
+        if index_update is not None:
+            index_update.add(seen)
+    finish_scan(sess, vol, top_generation, index_update)
 
 
 def windowed_query(window_start, query, attr, per, clear_updates):
@@ -616,86 +1151,306 @@ ofile_hard = 0
 ofile_reserved = 0
 fs = 0
 
-def dedup_tracked2(sess, volset, tt):
+class DedupOptions(object):
+    """Settings of a dedup pass."""
+
+    def __init__(
+        self, throttle=None, mini_hash_sampling=DEFAULT_MINI_HASH_SAMPLING,
+        hasher=None, chunk_size=DEFAULT_CHUNK_SIZE, make_log_session=None,
+        plan=None, settle_time=0,
+    ):
+        if throttle is None:
+            throttle = ReadThrottle()
+        if hasher is None:
+            hasher = get_provider(default_provider_name())
+        self.throttle = throttle
+        self.mini_hash_sampling = mini_hash_sampling
+        # The HashProvider for full-content hashes
+        self.hasher = hasher
+        # Chunk size of the partial-file pass
+        self.chunk_size = chunk_size
+        # Makes sessions of the log database, where dedup events
+        # are recorded (see eventlog.EventLog)
+        self.make_log_session = make_log_session
+        # A plan.PlanWriter; duplicates are written to the plan
+        # instead of being cloned
+        self.plan = plan
+        # Files modified less than this many seconds ago are left
+        # for a later pass
+        self.settle_time = settle_time
+
+    def settled_filters(self):
+        # Leaves out inodes modified within settle_time, according to
+        # the mtime seen by the scan; they keep has_updates.  ctime
+        # isn't used, it also moves when bedup sets the immutable flag.
+        # An unknown mtime doesn't count as settled.
+        if not self.settle_time:
+            return []
+        cutoff = int(time.time() - self.settle_time)
+        return [Inode.mtime != None, Inode.mtime <= cutoff]
+
+
+class DedupStats(object):
+    """Counters for a dedup pass over a volume set."""
+
+    def __init__(self):
+        # Files whose mini-hash was computed
+        self.mini_hashed = 0
+        # Sparse files, grouped by layout instead
+        self.sparse = 0
+        # Files sharing their mini-hash with another, hashed in full
+        self.mini_hash_passed = 0
+        # Files whose full hash matched another's
+        self.confirmed = 0
+
+    def describe(self):
+        precision = mini_hash_precision(
+            self.mini_hash_passed, self.confirmed)
+        return (
+            'Mini-hash: %d files sampled, %d sparse files grouped by '
+            'layout, %d read in full, %d duplicates confirmed (%s)' % (
+                self.mini_hashed, self.sparse, self.mini_hash_passed,
+                self.confirmed, precision))
+
+    def add_to_run(self, sess, run_id):
+        # Several processes may work on the same run
+        table = DedupRun.__table__
+        sess.execute(table.update().where(table.c.id == run_id).values(dict(
+            (name, table.c[name] + getattr(self, name))
+            for name in RUN_COUNTERS)))
+
+
+def measure_usage(volset):
+    # Qgroups are updated when the transaction commits
+    syncfs(volset[0].fd)
+    return get_qgroup_usage(volset[0].fd)
+
+
+def start_run(sess, volset):
+    """
+    Records the start of a dedup pass over a volume set.
+
+    When quotas are enabled, the space used by each volume is measured
+    at the start and at the end of the run.
+    """
+
+    run = DedupRun(fs=volset[0].fs, started=system_now())
+    sess.add(run)
+    usage = measure_usage(volset)
+    if usage is not None:
+        for vol in volset:
+            if vol.root_id not in usage:
+                continue
+            referenced, exclusive = usage[vol.root_id]
+            sess.add(VolumeUsage(
+                run=run, vol=vol,
+                referenced_before=referenced, exclusive_before=exclusive))
+    sess.commit()
+    return run
+
+
+def finish_run(sess, run, volset, tt, opts):
+    run.finished = system_now()
+    if opts.make_log_session is not None:
+        # Events may have been recorded by other processes
+        run.reclaimed_bytes = sum_reclaimed_bytes(
+            opts.make_log_session, run.fs_id, run.started, run.finished)
+        tt.notify('Reclaimed at most %d bytes' % run.reclaimed_bytes)
+
+    usage = measure_usage(volset)
+    if usage is not None:
+        for vol_usage in run.usages:
+            if vol_usage.vol.root_id not in usage:
+                continue
+            vol_usage.referenced_after, vol_usage.exclusive_after = (
+                usage[vol_usage.vol.root_id])
+            tt.notify(
+                'Volume %d: %d -> %d bytes referenced, '
+                '%d -> %d bytes exclusive' % (
+                    vol_usage.vol.root_id,
+                    vol_usage.referenced_before, vol_usage.referenced_after,
+                    vol_usage.exclusive_before, vol_usage.exclusive_after))
+    sess.commit()
+
+
+# Columns set by the dedup pass, written back by InodeChanges
+MINI_HASH_COLUMNS = ('mini_hash',)
+FIEMAP_COLUMNS = ('fiemap_hash', 'fiemap_transid')
+DIGEST_COLUMNS = ('digest', 'digest_hash', 'digest_transid')
+
+
+def inode_key_clause():
+    return and_(
+        Inode.vol_id == bindparam('key_vol_id'),
+        Inode.ino == bindparam('key_ino'))
+
+
+class InodeChanges(object):
+    """
+    Changes to InodeRecords, written with bulk statements.
+
+    Updates, deletions and inodes to look at again on the next pass
+    are accumulated, and flushed once per window.
+    """
+
+    def __init__(self):
+        # (vol_id, ino) -> {column: value}
+        self.updates = {}
+        self.deleted = set()
+        # Inodes to look at again on the next pass
+        self.skipped = []
+
+    def save(self, record, columns):
+        values = self.updates.setdefault((record.vol_id, record.ino), {})
+        for name in columns:
+            values[name] = getattr(record, name)
+
+    def delete(self, record):
+        key = (record.vol_id, record.ino)
+        self.updates.pop(key, None)
+        self.deleted.add(key)
+
+    def skip(self, record):
+        self.skipped.append((record.vol_id, record.ino))
+
+    def flush(self, sess):
+        # One executemany per set of updated columns
+        by_columns = collections.defaultdict(list)
+        for (vol_id, ino), values in self.updates.iteritems():
+            params = dict(values, key_vol_id=vol_id, key_ino=ino)
+            by_columns[tuple(sorted(values))].append(params)
+        for columns, params in by_columns.iteritems():
+            sess.execute(
+                Inode.__table__.update().where(inode_key_clause()).values(
+                    dict((name, bindparam(name)) for name in columns)),
+                params)
+        if self.deleted:
+            sess.execute(
+                Inode.__table__.delete().where(inode_key_clause()), [
+                    dict(key_vol_id=vol_id, key_ino=ino)
+                    for vol_id, ino in self.deleted])
+        self.updates.clear()
+        self.deleted.clear()
+
+    def flush_skipped(self, sess):
+        if self.skipped:
+            sess.execute(
+                Inode.__table__.update().where(inode_key_clause()).values(
+                    has_updates=True), [
+                    dict(key_vol_id=vol_id, key_ino=ino)
+                    for vol_id, ino in self.skipped])
+        self.skipped = []
+
+
+def load_records(sess, vols_by_id, filters):
+    return [
+        InodeRecord(vols_by_id[row['vol_id']], row)
+        for row in sess.execute(select([
+            getattr(Inode, name) for name in RECORD_COLUMNS
+        ]).where(and_(*filters)))]
+
+
+def set_ofile_limits(nr_volumes):
     global ofile_soft
     global ofile_hard
     global ofile_reserved
+
+    ofile_soft, ofile_hard = resource.getrlimit(resource.RLIMIT_OFILE)
+
+    # 3 for stdio, 3 for sqlite (wal mode), 1 that somehow doesn't
+    # get closed, 1 per volume.
+    ofile_reserved = 7 + nr_volumes
+
+
+def dedup_tracked2(sess, volset, tt, opts, partition=None, run_id=None):
+    # partition is an (index, count) pair; when set, only the size
+    # groups with size % count == index are handled, so that
+    # count processes can share a volume set.
+    # The counters of the pass are added to the DedupRun run_id.
     global fs
 
-    space_gain1 = space_gain2 = space_gain3 = 0
+    stats = DedupStats()
+    changes = InodeChanges()
     vol_ids = [vol.id for vol in volset]
+    # Volumes are resolved once, rather than through Inode.vol
+    vols_by_id = dict((vol.id, vol) for vol in volset)
     fs = volset[0].fs
     assert all(vol.fs == fs for vol in volset)
+    vol_filter = [Inode.vol_id.in_(vol_ids)]
+    if partition is not None:
+        index, count = partition
+        vol_filter.append(Inode.size % count == index)
+    settled = opts.settled_filters()
+    if settled:
+        deferred = sess.query(Inode).filter(
+            Inode.fs_id == fs.id, Inode.has_updates,
+            ~and_(*settled), *vol_filter).count()
+        if deferred:
+            tt.notify(
+                'Leaving %d recently modified files for a later pass'
+                % deferred)
+        # Also keeps has_updates set on the others
+        vol_filter.extend(settled)
 
-    ofile_soft, ofile_hard = resource.getrlimit(resource.RLIMIT_OFILE)
-
-    # 3 for stdio, 3 for sqlite (wal mode), 1 that somehow doesn't
-    # get closed, 1 per volume.
-    ofile_reserved = 7 + len(volset)
+    set_ofile_limits(len(volset))
 
-    try:
+    # Closing the log keeps the events of the clones that did happen,
+    # and raising from the loop skips the has_updates reset.
+    with closing(EventLog(opts.make_log_session)) as log:
         tt.format('{elapsed} Size group {comm1:counter}/{comm1:total}')
 
-        groups = sess.query(
-            Inode.size,
-            func.count().label('inode_count'),
-            func.max(Inode.has_updates).label('has_updates'),
-        ).filter(and_(
-            Inode.vol_id.in_(vol_ids),
-            Inode.fs_id == fs.id,
-        )).group_by(
-            -Inode.size
-        ).having(and_(
-            literal_column('inode_count') > 1,
-            literal_column('has_updates') > 0,
-        )).all()
+        groups = size_groups(sess, [Inode.fs_id == fs.id] + vol_filter)
 
         tt.set_total(comm1=len(groups))
 
-        for group in groups[50000:]:
-            tt.update(comm1=group)
-            query = sess.query(
-                Inode
-            ).filter(
-                Inode.vol_id.in_(vol_ids),
+        pending = []
+        for start in xrange(0, len(groups), SQL_BATCH):
+            batch = groups[start:start + SQL_BATCH]
+            by_size = collections.defaultdict(list)
+            for record in load_records(sess, vols_by_id, [
                 Inode.fs_id == fs.id,
-                Inode.size == group.size,
-            ).all()
-
-            do_hashing(sess, tt, query)
-
-
-    except:
-        # Empty except just so that we can have an else: branch,
-        # when returning without errors.
-        raise
-    else:
-        sess.execute(
-            Inode.__table__.update().where(
-                Inode.vol_id.in_(vol_ids)
-            ).values(
-                has_updates=False))
-        for inode in skipped:
-            inode.has_updates = True
-        sess.commit()
+                Inode.size.in_([group.size for group in batch]),
+            ] + vol_filter):
+                by_size[record.size].append(record)
+
+            for group in batch:
+                tt.update(comm1=group)
+                pending.extend(do_hashing(
+                    tt, by_size.pop(group.size, []), opts, stats, changes))
+                if len(pending) >= SCHEDULE_WINDOW:
+                    dedup_in_disk_order(
+                        sess, tt, pending, opts, stats, changes, log)
+                    pending = []
+        dedup_in_disk_order(sess, tt, pending, opts, stats, changes, log)
+    tt.notify(stats.describe())
+
+    sess.execute(
+        Inode.__table__.update().where(
+            and_(*vol_filter)
+        ).values(
+            has_updates=False))
+    changes.flush_skipped(sess)
+    if run_id is not None:
+        stats.add_to_run(sess, run_id)
+    sess.commit()
 
 
-def do_hashing(sess, tt, chunk):
+def do_hashing(tt, chunk, opts, stats, changes):
 
     #print "> do hashing ", chunk[0].size, len(chunk)
 
-    by_hash = collections.defaultdict(list)
+    if not can_clone(chunk, opts):
+        return []
 
+    located = []
     for inode in chunk:
         # XXX Need to cope with deleted inodes.
         # We cannot find them in the search-new pass,
         # not without doing some tracking of directory modifications to
         # poke updated directories to find removed elements.
 
-        # rehash everytime for now
-        # I don't know enough about how inode transaction numbers
-        # are updated (as opposed to extent updates)
-        # to be able to actually cache the result
+        # Content digests are cached along with the inode transid,
+        # which changes whenever the inode is written to.
         try:
             path = lookup_ino_path_one(inode.vol.fd, inode.ino)
         except IOError as e:
@@ -710,194 +1465,408 @@ def do_hashing(sess, tt, chunk):
             # all stale entries.  We can also get into trouble with
             # regular file inodes being replaced by some other kind of
             # inode.
-            sess.delete(inode)
-            #HR: Delete from chunk
+            changes.delete(inode)
             continue
-        rfile = fopenat(inode.vol.fd, path)
-        inode.mini_hash_from_file(rfile)
+        if inode.has_current_extents():
+            # Recorded by the scan, no need to open the file
+            inode.layout_from_extents()
+        else:
+            # The extent map doesn't require reading the contents
+            rfile = fopenat(inode.vol.fd, path)
+            inode.fiemap_hash_from_file(rfile)
+            rfile.close()
+            changes.save(inode, FIEMAP_COLUMNS)
+        located.append((inode, path))
+
+    # Files that fully share their extents with another member of
+    # the group are already deduplicated; keep one of them.
+    # When a group was deduplicated by a previous run, this leaves
+    # a single file and nothing gets read.
+    survivors = []
+    seen_extents = set()
+    for inode, path in located:
+        if inode.shared_extents is not None:
+            if inode.shared_extents in seen_extents:
+                continue
+            seen_extents.add(inode.shared_extents)
+        survivors.append((inode, path))
+
+    if len(survivors) < 2 or not can_clone(
+        [inode for inode, path in survivors], opts
+    ):
+        return []
+
+    # Files hashed by an earlier run, unchanged since
+    known = [
+        inode for inode, path in survivors
+        if inode.has_current_digest(digest_name(inode, opts))]
+    if len(known) == len(survivors):
+        # Nothing new; digests are only saved once the hash class
+        # of the file has been deduplicated (see save_digest).
+        return []
+    if known:
+        # New files are hashed in full and looked up among the
+        # known digests; a mini-hash would have to read the known
+        # files as well.
+        stats.mini_hash_passed += len(survivors) - len(known)
+        return [[inode for inode, path in survivors]]
+
+    survivors.sort(key=lambda item: physical_order(item[0]))
+    by_hash = collections.defaultdict(list)
+    for inode, path in survivors:
+        if inode.is_sparse():
+            # The mini-hash would mostly sample holes; files with
+            # holes in different places have different sparse
+            # digests anyway, so the layout tells them apart
+            # without reading anything.
+            by_hash[inode.data_ranges].append(inode)
+            stats.sparse += 1
+            continue
+        rfile = opts.throttle.wrap(fopenat(inode.vol.fd, path))
+        inode.mini_hash_from_file(rfile, opts.mini_hash_sampling)
         rfile.close()
+        changes.save(inode, MINI_HASH_COLUMNS)
         by_hash[inode.mini_hash].append(inode)
+        stats.mini_hashed += 1
+
+    candidates = [
+        newChunk for newChunk in by_hash.itervalues()
+        if len(newChunk) > 1 and can_clone(newChunk, opts)]
+    stats.mini_hash_passed += sum(len(newChunk) for newChunk in candidates)
+    return candidates
+
+
+def any_writable(inodes):
+    return any(not inode.vol.readonly for inode in inodes)
+
+
+def can_clone(inodes, opts):
+    # Nothing can be cloned into read-only snapshots.  Plans still
+    # list their duplicates; dedup-apply can clone them into the
+    # volume the snapshot was taken from (see plan.mapped_member).
+    return opts.plan is not None or any_writable(inodes)
+
+
+def physical_order(inode):
+    # Files without a known location go last
+    if inode.physical_start is None:
+        return (1, 0)
+    return (0, inode.physical_start)
+
+
+def dedup_in_disk_order(sess, tt, chunks, opts, stats, changes, log):
+    # Hashing reads whole files; on rotating disks, reading them
+    # in the order of their location avoids most seeks.
+    # Locations are logical btrfs addresses, which are shared by all
+    # volumes of a filesystem.
+    for chunk in chunks:
+        chunk.sort(key=physical_order)
+    chunks.sort(key=lambda chunk: physical_order(chunk[0]))
+    for chunk in chunks:
+        do_dedup(tt, chunk, opts, stats, changes, log)
+    changes.flush(sess)
+    # Keeps write transactions short; other processes
+    # may be waiting on the database.
+    sess.commit()
 
-    for newChunk in by_hash.itervalues():
-        if len(newChunk) > 1:
-            do_hashing2(sess, tt, newChunk)
-
-
-def do_hashing2(sess, tt, chunk):
-
-    #print ">> do hashing2 ", chunk[0].size, chunk[0].mini_hash, len(chunk)
 
-    seen = {}
-    for inode in chunk:
-        try:
-            path = lookup_ino_path_one(inode.vol.fd, inode.ino)
-        except IOError as e:
-            if e.errno != errno.ENOENT:
-                raise
-            sess.delete(inode)
-            #HR: Delete from chunk
-            continue
-        rfile = fopenat(inode.vol.fd, path)
-        inode.fiemap_hash_from_file(rfile)
-        rfile.close()
+def dedup_window():
+    # Destination files opened at once; 1 fd goes to the source
+    return max(1, min(DEDUP_WINDOW, ofile_soft - ofile_reserved - 1))
 
-        if inode.mini_hash not in seen:
-            seen[inode.fiemap_hash] = inode
 
-    chunk[:] = seen.values()
+def open_checked(tt, inode, path, opts, changes, writable=False):
+    """
+    Opens a file of a duplicate group.
 
-    #print ">> end hashing2 ", len(chunk)
+    Returns None, after recording what happened to the inode,
+    when the file can't be used.
+    """
 
-    if len(chunk) > 1:
-        do_dedup(sess, tt, chunk)
+    try:
+        # Reads for hashing and comparison go through the throttle
+        if writable:
+            afile = opts.throttle.wrap(fopenat_rw(inode.vol.fd, path))
+        else:
+            afile = opts.throttle.wrap(fopenat(inode.vol.fd, path))
+    except IOError as e:
+        if e.errno == errno.ETXTBSY:
+            # The file contains the image of a running process,
+            # we can't open it in write mode.
+            tt.notify('File %r is busy, skipping' % path)
+        elif e.errno == errno.EACCES:
+            # Could be SELinux or immutability
+            tt.notify('Access denied on %r, skipping' % path)
+        elif e.errno == errno.ENOENT:
+            # The file was moved or unlinked by a racing process
+            tt.notify('File %r may have moved, skipping' % path)
+        else:
+            raise
+        changes.skip(inode)
+        return
 
+    # Gets rid of a race condition
+    st = os.fstat(afile.fileno())
+    if st.st_ino != inode.ino or st.st_dev != inode.vol.st_dev:
+        afile.close()
+        changes.skip(inode)
+        return
+    if st.st_size != inode.size:
+        afile.close()
+        if st.st_size < inode.vol.size_cutoff:
+            # if we didn't delete this inode, it would cause
+            # spurious comm groups in all future invocations.
+            changes.delete(inode)
+        else:
+            changes.skip(inode)
+        return
+    return afile
 
-def do_dedup(sess, tt, chunk):
 
-    #print ">>> do dedup ", chunk[0].size, chunk[0].mini_hash, len(chunk)
+def hash_group(tt, chunk, opts, changes):
+    """
+    Gets the content digests of a group of same-size files.
 
-    global ofile_soft
-    global ofile_hard
-    global ofile_reserved
-    global fs
+    Files are opened and hashed one at a time.  Returns a dict from
+    digests to lists of (inode, path, fresh) tuples; fresh is true
+    for files hashed by this pass.  Their digests aren't saved yet,
+    see save_digest.
+    """
 
-    files = []
-    fds = []
-    fd_names = {}
-    fd_inodes = {}
     by_hash = collections.defaultdict(list)
-
-    # XXX I have no justification for doubling count3
-    ofile_req = 2 * len(chunk) + ofile_reserved
-    if ofile_req > ofile_soft:
-        if ofile_req <= ofile_hard:
-            resource.setrlimit(
-                resource.RLIMIT_OFILE, (ofile_req, ofile_hard))
-            ofile_soft = ofile_req
-        else:
-            tt.notify(
-                'Too many duplicates (%d at size %d), '
-                'would bring us over the open files limit (%d, %d).'
-                % (count3, comm3.size, ofile_soft, ofile_hard))
-            for inode in comm3.inodes:
-                if inode.has_updates:
-                    skipped.append(inode)
-                    continue
-
     for inode in chunk:
-        # Open everything rw, we can't pick one for the source side
-        # yet because the crypto hash might eliminate it.
-        # We may also want to defragment the source.
         try:
             path = lookup_ino_path_one(inode.vol.fd, inode.ino)
         except IOError as e:
             if e.errno == errno.ENOENT:
-                sess.delete(inode)
-                continue
-            raise
-        try:
-            afile = fopenat_rw(inode.vol.fd, path)
-        except IOError as e:
-            if e.errno == errno.ETXTBSY:
-                # The file contains the image of a running process,
-                # we can't open it in write mode.
-                tt.notify('File %r is busy, skipping' % path)
-                skipped.append(inode)
-                continue
-            elif e.errno == errno.EACCES:
-                # Could be SELinux or immutability
-                tt.notify('Access denied on %r, skipping' % path)
-                skipped.append(inode)
-                continue
-            elif e.errno == errno.ENOENT:
-                # The file was moved or unlinked by a racing process
-                tt.notify('File %r may have moved, skipping' % path)
-                skipped.append(inode)
+                changes.delete(inode)
                 continue
             raise
+        hash_name = digest_name(inode, opts)
+        if inode.has_current_digest(hash_name):
+            # Checked when it gets opened for cloning
+            by_hash[inode.digest].append((inode, path, False))
+            continue
+
+        afile = open_checked(tt, inode, path, opts, changes)
+        if afile is None:
+            continue
+        with closing(afile):
+            if inode.is_sparse():
+                digest = sparse_digest(afile, inode.size, opts.hasher)
+            else:
+                digest = full_digest(afile, inode.size, opts.hasher)
+        if digest is None:
+            # Written to while we were reading
+            changes.skip(inode)
+            continue
+        inode.digest = digest
+        inode.digest_hash = hash_name
+        inode.digest_transid = inode.transid
+        by_hash[inode.digest].append((inode, path, True))
+    return by_hash
+
+
+def save_digest(inode, fresh, changes):
+    # A saved digest tells the next runs that the file was dealt with
+    # (see do_hashing); files that were skipped, or only planned,
+    # get hashed and compared again.
+    if fresh:
+        changes.save(inode, DIGEST_COLUMNS)
+
+
+def digest_name(inode, opts):
+    # Sparse files are hashed by their data ranges, which doesn't
+    # give the same digest as hashing the whole file.
+    if inode.is_sparse():
+        return opts.hasher.name + SPARSE_HASH_SUFFIX
+    return opts.hasher.name
+
+
+def full_digest(afile, size, hasher):
+    # Returns None if the file doesn't have the expected size
+    hobj = hasher.new()
+    for buf in iter(lambda: afile.read(BUFSIZE), b''):
+        hobj.update(buf)
+    if afile.tell() != size:
+        return
+    return hobj.hexdigest()
+
 
-        # It's not completely guaranteed we have the right inode,
-        # there may still be race conditions at this point.
-        # Gets re-checked below (tell and fstat).
-        fd = afile.fileno()
-        fd_inodes[fd] = inode
-        fd_names[fd] = path
-        files.append(afile)
-        fds.append(fd)
+def sparse_digest(afile, size, hasher):
+    """
+    Hashes the data ranges of a file and where they are.
 
+    Holes and preallocated extents aren't read; they read as zeros,
+    so files with the same sparse digest have the same contents.
+    The layout is mapped again from the open file, in case it changed
+    since the scan.  Returns None if the file doesn't have the
+    expected size.
+    """
+
+    if os.fstat(afile.fileno()).st_size != size:
+        return
+    hobj = hasher.new()
+    for offset, length in data_ranges(tuple(fiemap(afile.fileno())), size):
+        hobj.update(RANGE_STRUCT.pack(offset, length))
+        afile.seek(offset)
+        while length > 0:
+            buf = afile.read(min(BUFSIZE, length))
+            if not buf:
+                return
+            hobj.update(buf)
+            length -= len(buf)
+    return hobj.hexdigest()
+
+
+def same_contents(sfile, sranges, dfile, dextents, size):
+    # Files with the same holes only need their data ranges compared.
+    # sranges are the data ranges of the source.
+    if is_sparse(sranges, size) and data_ranges(dextents, size) == sranges:
+        return all(
+            cmp_ranges(sfile, dfile, offset, offset, length)
+            for offset, length in sranges)
+    return cmp_files(sfile, dfile)
+
+
+def open_source(tt, members, opts, changes, stack):
+    # Takes the first member that can be opened and made immutable;
+    # it stays open while the rest of the hash class is cloned from it.
+    while members:
+        inode, path, fresh = members.pop(0)
+        # Read-only snapshots can't change, and can't be made immutable
+        writable = not inode.vol.readonly
+        sfile = open_checked(
+            tt, inode, path, opts, changes, writable=writable)
+        if sfile is None:
+            continue
+        with ExitStack() as attempt:
+            attempt.enter_context(closing(sfile))
+            if writable:
+                immutability = attempt.enter_context(
+                    ImmutableFDs([sfile.fileno()]))
+                if immutability.fds_in_write_use:
+                    tt.notify('File %r is in use, skipping' % path)
+                    changes.skip(inode)
+                    continue
+            stack.enter_context(attempt.pop_all())
+        save_digest(inode, fresh, changes)
+        return inode, path, sfile
+
+
+def clone_window(tt, source, dests, opts, changes, log):
+    sinode, sname, sfile = source
+    sfd = sfile.fileno()
+    sranges = data_ranges(tuple(fiemap(sfd)), sinode.size)
     with ExitStack() as stack:
-        for afile in files:
-            stack.enter_context(closing(afile))
-        # Enter this context last
-        immutability = stack.enter_context(ImmutableFDs(fds))
-
-        for afile in files:
-            fd = afile.fileno()
-            inode = fd_inodes[fd]
-            if fd in immutability.fds_in_write_use:
-                tt.notify('File %r is in use, skipping' % fd_names[fd])
-                skipped.append(inode)
+        dfiles = []
+        for inode, path, fresh in dests:
+            dfile = open_checked(
+                tt, inode, path, opts, changes, writable=True)
+            if dfile is None:
                 continue
-            hasher = hashlib.sha1()
-            for buf in iter(lambda: afile.read(BUFSIZE), b''):
-                hasher.update(buf)
-
-            # Gets rid of a race condition
-            st = os.fstat(fd)
-            if st.st_ino != inode.ino:
-                skipped.append(inode)
+            stack.enter_context(closing(dfile))
+            dfiles.append((inode, path, fresh, dfile))
+        # Enter this context last
+        immutability = stack.enter_context(ImmutableFDs(
+            [afile.fileno() for inode, path, fresh, afile in dfiles]))
+
+        successful = []
+        reclaimed = 0
+        for inode, dname, fresh, dfile in dfiles:
+            dfd = dfile.fileno()
+            if dfd in immutability.fds_in_write_use:
+                tt.notify('File %r is in use, skipping' % dname)
+                changes.skip(inode)
                 continue
-            if st.st_dev != inode.vol.st_dev:
-                skipped.append(inode)
+            dextents = tuple(fiemap(dfd))
+            if not same_contents(
+                sfile, sranges, dfile, dextents, sinode.size
+            ):
+                # A collision of the content hash, or a bug
+                tt.notify('Files differ: %r %r' % (sname, dname))
                 continue
+            # At most the extents only the destination uses are freed
+            reclaimable = exclusive_bytes(dextents)
+            if clone_data(dest=dfd, src=sfd, check_first=True):
+                tt.notify('Deduplicated: %r %r' % (sname, dname))
+                successful.append(inode)
+                reclaimed += reclaimable
+            else:
+                tt.notify(
+                    'Did not deduplicate (same extents): %r %i %r %i' % (
+                        sname, sinode.ino, dname, inode.ino))
+            save_digest(inode, fresh, changes)
+
+    if successful:
+        log.record(
+            sinode.vol.fs_id, sinode.size, reclaimed,
+            [(inode.vol_id, inode.ino) for inode in [sinode] + successful])
+
+
+def do_dedup(tt, chunk, opts, stats, changes, log):
+    """
+    Deduplicates a group of same-size files.
+
+    The files are hashed one at a time, then each hash class is cloned
+    from a single source into windows of destinations.  The number of
+    open files doesn't depend on the size of the group.
+    """
 
-            size = afile.tell()
-            if size != inode.size:
-                if size < inode.vol.size_cutoff:
-                    # if we didn't delete this inode, it would cause
-                    # spurious comm groups in all future invocations.
-                    sess.delete(inode)
-                else:
-                    skipped.append(inode)
-                continue
+    #print ">>> do dedup ", chunk[0].size, chunk[0].mini_hash, len(chunk)
 
-            by_hash[hasher.digest()].append(afile)
+    by_hash = hash_group(tt, chunk, opts, changes)
+    window = dedup_window()
 
-        for fileset in by_hash.itervalues():
-            if len(fileset) < 2:
-                continue
-            sfile = fileset[0]
-            sfd = sfile.fileno()
-            # Commented out, defragmentation can unshare extents.
-            # It can also disable compression as a side-effect.
-            if False:
-                defragment(sfd)
-            dfiles = fileset[1:]
-            dfiles_successful = []
-            for dfile in dfiles:
-                dfd = dfile.fileno()
-                sname = fd_names[sfd]
-                dname = fd_names[dfd]
-                if not cmp_files(sfile, dfile):
-                    # Probably a bug since we just used a crypto hash
-                    tt.notify('Files differ: %r %r' % (sname, dname))
-                    assert False, (sname, dname)
-                    continue
-                if clone_data(dest=dfd, src=sfd, check_first=True):
-                    tt.notify('Deduplicated: %r %r' % (sname, dname))
-                    dfiles_successful.append(dfile)
-                else:
-                    tt.notify(
-                        'Did not deduplicate (same extents): %r %i %r %i' % (
-                            sname, fd_inodes[sfd].ino, dname, fd_inodes[dfd].ino))
-            if dfiles_successful:
-                evt = DedupEvent(
-                    fs=fs, item_size=inode.size, created=system_now())
-                sess.add(evt)
-                for afile in [sfile] + dfiles_successful:
-                    inode = fd_inodes[afile.fileno()]
-                    evti = DedupEventInode(
-                        event=evt, ino=inode.ino, vol=inode.vol)
-                    sess.add(evti)
-                sess.commit()
+    for members in by_hash.itervalues():
+        if len(members) < 2:
+            # No duplicate
+            for inode, path, fresh in members:
+                save_digest(inode, fresh, changes)
+            continue
+        if not can_clone([inode for inode, path, fresh in members], opts):
+            # Digests not saved, so that a plan can list them
+            continue
+        if not any(fresh for inode, path, fresh in members):
+            # Deduplicated by an earlier run
+            continue
+        stats.confirmed += len(members)
+        if opts.plan is not None:
+            opts.plan.add(members, members[0][0].digest_hash)
+            # Still candidates for the next pass, in case the plan
+            # doesn't get applied: they keep has_updates, and their
+            # digests aren't saved, so they get hashed again.
+            for inode, path, fresh in members:
+                changes.skip(inode)
+            continue
+        dedup_members(tt, members, opts, changes, log, window)
 
+
+def dedup_members(tt, members, opts, changes, log, window):
+    """
+    Clones a hash class, given as (inode, path, fresh) tuples.
+
+    The source stays open while destinations are handled
+    window files at a time.
+    """
+
+    # Read-only then known files first, so that they are used
+    # as the source and new files get cloned from them.
+    members.sort(key=lambda member: (
+        not member[0].vol.readonly, member[2]))
+
+    with ExitStack() as stack:
+        source = open_source(tt, members, opts, changes, stack)
+        if source is None:
+            return
+        # Commented out, defragmentation can unshare extents.
+        # It can also disable compression as a side-effect.
+        if False:
+            defragment(source[2].fileno())
+        # Nothing can be cloned into read-only snapshots
+        dests = [
+            member for member in members if not member[0].vol.readonly]
+        for start in xrange(0, len(dests), window):
+            clone_window(
+                tt, source, dests[start:start + window],
+                opts, changes, log)